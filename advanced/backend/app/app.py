@@ -3,19 +3,38 @@ import json
 import logging
 import os
 import sys
+import time
 import traceback
-from typing import Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 from uuid import uuid4
 
 import chromadb
+import openai
 import redis  # type: ignore
+from answer_cache import AnswerCache
 from chromadb.config import Settings
-from flask import Flask, jsonify, redirect, request
+from collection_alias import CollectionAlias
+from embedding_cache import EmbeddingCache
+from flask import Flask, Response, jsonify, redirect, request, stream_with_context
 from flask_cors import CORS
+from ingest_job import IngestJob
+from ingest_queue import IngestQueue
 from minio import Minio
 from minio.error import S3Error
 from openai import OpenAI
-from werkzeug.exceptions import HTTPException, UnprocessableEntity
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from vector_replica import AliasedReplica
+from werkzeug.exceptions import HTTPException, NotFound, UnprocessableEntity
 
 # The flask api for serving predictions
 app = Flask(__name__)
@@ -23,6 +42,18 @@ app.config["JSONIFY_PRETTYPRINT_REGULAR"] = True
 CORS(app)
 
 
+# Metrics, children are looked up once so that the hot path only updates them
+STAGE_SECONDS = Histogram("chat_stage_seconds", "Time spent in each stage of answering a question", ["stage"])
+EMBED_SECONDS = STAGE_SECONDS.labels("embed")
+RETRIEVE_SECONDS = STAGE_SECONDS.labels("retrieve")
+PROMPT_SECONDS = STAGE_SECONDS.labels("prompt_build")
+COMPLETION_SECONDS = STAGE_SECONDS.labels("completion")
+FIRST_TOKEN_SECONDS = STAGE_SECONDS.labels("completion_first_token")
+TOKENS = Counter("openai_tokens_total", "Tokens used by OpenAI requests", ["model", "kind"])
+CACHE_LOOKUPS = Counter("cache_lookups_total", "Cache lookups", ["cache", "result"])
+RETRIEVALS = Counter("retrievals_total", "Nearest neighbour queries", ["source"])
+IN_FLIGHT = Gauge("http_requests_in_flight", "Requests being handled", multiprocess_mode="livesum")
+
 # Set up logger
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 log = logging.getLogger(__name__)
@@ -46,15 +77,33 @@ minio_client = Minio(
 
 bucket_name = os.environ["S3_BUCKET_NAME"]
 
+# Ingest requests are added to the priority lanes consumed by the build-index workers. Requests are interactive unless
+# they ask for ?priority=bulk, and bulk requests for files under INGEST_SMALL_BYTES go to the small lane.
+ingest_queue = IngestQueue(redis.StrictRedis(connection_pool=redis_pool))
+INGEST_SMALL_BYTES = int(os.environ.get("INGEST_SMALL_BYTES", str(64 * 1024)))
+INGEST_BATCH_MAX_PATHS = int(os.environ.get("INGEST_BATCH_MAX_PATHS", "10000"))
+INGEST_LATEST = "ingest:latest"  # upload_id of the latest request for each path, older ones are skipped
+
 
 # Initialize Open AI client
 client = OpenAI()
+EMBEDDING_MODEL = "text-embedding-ada-002"
 
+# Embeddings cache shared with the ingest workers
+EMBEDDING_CACHE_MAX_BYTES = int(os.environ.get("EMBEDDING_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+embedding_cache = EmbeddingCache(redis.StrictRedis(connection_pool=redis_pool), EMBEDDING_CACHE_MAX_BYTES)
 
-# Initialize Chroma Client
-# create client and a new collection
-chroma_collection_name = "blogs"
+# Answers to similar questions that retrieved the same chunks, invalidated by the ingest workers
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", "0.95"))
+ANSWER_CACHE_TTL = int(os.environ.get("ANSWER_CACHE_TTL", "86400"))  # seconds, 0 disables the cache
+answer_cache = AnswerCache(redis.StrictRedis(connection_pool=redis_pool), ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_TTL)
+
+# Limits for /chat/batch
+CHAT_BATCH_MAX_QUESTIONS = int(os.environ.get("CHAT_BATCH_MAX_QUESTIONS", "500"))
+CHAT_BATCH_CONCURRENCY = int(os.environ.get("CHAT_BATCH_CONCURRENCY", "8"))  # completions in flight per request
 
+
+# Initialize Chroma Client
 chroma_client = chromadb.HttpClient(
     host=os.environ["CHROMA_URL"],
     port=os.environ["CHROMA_PORT"],
@@ -65,20 +114,75 @@ chroma_client = chromadb.HttpClient(
 )
 chroma_client.heartbeat()
 
-try:
-    # Create the collection
-    chroma_collection = chroma_client.get_collection(chroma_collection_name)
-except (Exception, ValueError):
-    # Create the collection if it doesn't exist
-    chroma_collection = chroma_client.create_collection(chroma_collection_name)
+# The collection is looked up through the "blogs" alias, so that a rebuilt collection can be swapped in
+CHROMA_ALIAS_REFRESH = float(os.environ.get("CHROMA_ALIAS_REFRESH", "5"))  # seconds between alias lookups
+collection_alias = CollectionAlias(
+    redis.StrictRedis(connection_pool=redis_pool), chroma_client, "blogs", CHROMA_ALIAS_REFRESH
+)
+
+# Local replica of the collection's vectors, queries fall back to Chroma while it is stale
+VECTOR_REPLICA = os.environ.get("VECTOR_REPLICA", "true").lower() == "true"
+vector_replica = AliasedReplica(collection_alias, redis.StrictRedis(connection_pool=redis_pool), VECTOR_REPLICA)
 
 
 def get_embedding(text: str) -> Any:
     """Use the same embedding generator as what was used on the data!!!"""
     if len(text) > 8000:  # Hack to be under the 8k limit
         text = text[:8000]
-    response = client.embeddings.create(model="text-embedding-ada-002", input=text)
-    return response.data[0].embedding
+    with EMBED_SECONDS.time():
+        embedding = embedding_cache.get(EMBEDDING_MODEL, text)
+        CACHE_LOOKUPS.labels("embedding", "miss" if embedding is None else "hit").inc()
+        if embedding is None:
+            response = client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+            TOKENS.labels(EMBEDDING_MODEL, "embedding").inc(response.usage.total_tokens)
+            embedding = response.data[0].embedding
+            embedding_cache.set(EMBEDDING_MODEL, text, embedding)
+    return embedding
+
+
+def get_embeddings(texts: List[str]) -> List[List[float]]:
+    """Embed many texts, with a single request for the ones that are not cached"""
+    texts = [text[:8000] for text in texts]  # Hack to be under the 8k limit
+    with EMBED_SECONDS.time():
+        embeddings = embedding_cache.get_many(EMBEDDING_MODEL, texts)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        CACHE_LOOKUPS.labels("embedding", "hit").inc(len(texts) - len(missing))
+        CACHE_LOOKUPS.labels("embedding", "miss").inc(len(missing))
+        if missing:
+            response = client.embeddings.create(model=EMBEDDING_MODEL, input=[texts[i] for i in missing])
+            TOKENS.labels(EMBEDDING_MODEL, "embedding").inc(response.usage.total_tokens)
+            computed = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            embedding_cache.set_many(EMBEDDING_MODEL, [texts[i] for i in missing], computed)
+            for i, embedding in zip(missing, computed):
+                embeddings[i] = embedding
+    return embeddings  # type: ignore[return-value]
+
+
+def query_chunks(query_embeddings: List[List[float]], n_results: int = 3) -> Any:
+    """Nearest chunks from the local replica, or from Chroma when the replica is stale"""
+    with RETRIEVE_SECONDS.time():
+        collection, replica = vector_replica.current()
+        results = replica.query(query_embeddings, n_results)
+        if results is None:
+            results = collection.query(query_embeddings=query_embeddings, n_results=n_results)
+            RETRIEVALS.labels("chroma").inc()
+        else:
+            RETRIEVALS.labels("replica").inc()
+    return results
+
+
+def get_cached_answer(embedding: List[float], chunk_ids: List[str]) -> Optional[str]:
+    """Answer of a similar question that retrieved the same chunks, if any"""
+    answer = answer_cache.get(embedding, chunk_ids)
+    CACHE_LOOKUPS.labels("answer", "miss" if answer is None else "hit").inc()
+    return answer
+
+
+def count_completion_tokens(model: str, usage: Any) -> None:
+    """Count the tokens used by a completion"""
+    if usage is not None:
+        TOKENS.labels(model, "prompt").inc(usage.prompt_tokens)
+        TOKENS.labels(model, "completion").inc(usage.completion_tokens)
 
 
 @app.errorhandler(HTTPException)  # type: ignore
@@ -99,6 +203,29 @@ def handle_exception(e: Any) -> Any:
     )
 
 
+@app.before_request  # type: ignore
+def track_request() -> None:
+    """Count the requests in flight"""
+    IN_FLIGHT.inc()
+
+
+@app.teardown_request  # type: ignore
+def untrack_request(_error: Optional[BaseException]) -> None:
+    """Count the requests in flight, called after a streamed response is done too"""
+    IN_FLIGHT.dec()
+
+
+@app.route("/metrics", methods=["GET"])  # type: ignore
+def metrics() -> Any:
+    """Prometheus metrics, of all the gunicorn workers"""
+    registry = REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        # Each worker writes its metrics to the directory, see serve
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
 @app.route("/", methods=["GET"])  # type: ignore
 @app.route("/ping", methods=["GET"])  # type: ignore
 @app.route("/health_check", methods=["GET"])  # type: ignore
@@ -159,41 +286,147 @@ def uploads(folder: str, filename: str) -> Any:
     return redirect(presigned_url, code=307)
 
 
-@app.route("/ingest/<folder>/<filename>", methods=["POST"])  # type: ignore
-def ingest(folder: str, filename: str) -> Any:
-    """Send ingest message for uploaded file to queue"""
-    upload_id = str(uuid4())
-    ingest_obj = {
-        "upload_id": upload_id,
-        "folder": folder,
-        "filename": filename,
-        "bucket_name": bucket_name,
-        "path": f"/uploads/{folder}/{filename}",
-    }
+def ingest_lane(priority: str, size: Optional[int]) -> str:
+    """Lane of an ingest request, small files of a bulk load go ahead of the large ones"""
+    if priority not in ("interactive", "bulk"):
+        raise UnprocessableEntity("priority must be interactive or bulk")
+    if priority == "interactive" or size is None:
+        return priority
+    return "small" if size <= INGEST_SMALL_BYTES else "bulk"
+
+
+def object_size(path: str) -> Optional[int]:
+    """Size of an uploaded object, None if it can't be read"""
+    try:
+        size: Optional[int] = minio_client.stat_object(bucket_name, path).size
+    except S3Error:
+        return None
+    return size
+
+
+def queue_ingests(requests: List[Tuple[str, str, str, str]]) -> List[Dict[str, str]]:
+    """
+    Queue requests to ingest (or delete) uploaded documents, in one round trip to Redis.
+    Takes (folder, filename, lane, op) tuples, returns the queued requests.
+    """
+    ingest_objs = [
+        {
+            "upload_id": str(uuid4()),
+            "folder": folder,
+            "filename": filename,
+            "bucket_name": bucket_name,
+            "path": f"/uploads/{folder}/{filename}",
+            "lane": lane,
+            "op": op,
+        }
+        for folder, filename, lane, op in requests
+    ]
 
     try:
         redis_client = redis.StrictRedis(connection_pool=redis_pool, decode_responses=True)
-        redis_client.lpush("ingest", json.dumps(ingest_obj))
+        pipe = redis_client.pipeline()
+        for ingest_obj in ingest_objs:
+            IngestJob(redis_client, ingest_obj["upload_id"]).update(
+                pipe,
+                state="queued",
+                op=ingest_obj["op"],
+                lane=ingest_obj["lane"],
+                folder=ingest_obj["folder"],
+                filename=ingest_obj["filename"],
+                path=ingest_obj["path"],
+                queued_at=time.time(),
+            )
+            pipe.set(f"{INGEST_LATEST}:{ingest_obj['path']}", ingest_obj["upload_id"], ex=7 * 24 * 3600)
+            ingest_queue.enqueue(ingest_obj["lane"], ingest_obj["folder"], json.dumps(ingest_obj), pipe)
+        pipe.execute()
     except redis.exceptions.RedisError as e:
         raise HTTPException(f"Unable to add to ingest queue: {e}")
+    return ingest_objs
 
-    return jsonify(ingest_obj), 200
 
+@app.route("/uploads/<folder>/<filename>", methods=["DELETE"])  # type: ignore
+def delete_upload(folder: str, filename: str) -> Any:
+    """Delete an uploaded file, and queue the removal of its document from the vector store"""
+    try:
+        minio_client.remove_object(bucket_name, f"/uploads/{folder}/{filename}")
+    except S3Error as err:
+        return str(err), 500
+    return jsonify(queue_ingests([(folder, filename, "interactive", "delete")])[0]), 200
 
-@app.route("/chat", methods=["POST"])  # type: ignore
-def chat():
-    """Answer a question given a context."""
+
+@app.route("/ingest/<folder>/<filename>", methods=["POST"])  # type: ignore
+def ingest(folder: str, filename: str) -> Any:
+    """Send ingest message for uploaded file to queue"""
+    priority = request.args.get("priority", "interactive")
+    size = object_size(f"/uploads/{folder}/{filename}") if priority == "bulk" else None
+    return jsonify(queue_ingests([(folder, filename, ingest_lane(priority, size), "ingest")])[0]), 200
+
+
+@app.route("/ingest/batch", methods=["POST"])  # type: ignore
+def ingest_batch() -> Any:
+    """
+    Send ingest messages for many uploaded files to the queue at once.
+    Takes {"paths": ["<folder>/<filename>", ...], "priority": "bulk"}, results are in the order of the paths, each
+    with either the queued request or an error.
+    """
     request_obj = request.get_json()
-    question = request_obj["question"]
-    embedding = get_embedding(question)
-    results = chroma_collection.query(query_embeddings=[embedding], n_results=3)
-    context = "\n".join([m["text"] for m in results["metadatas"][0]])
+    paths = request_obj.get("paths") if isinstance(request_obj, dict) else None
+    if not isinstance(paths, list):
+        raise UnprocessableEntity("Expected a JSON object with a list of paths")
+    if len(paths) > INGEST_BATCH_MAX_PATHS:
+        raise UnprocessableEntity(f"At most {INGEST_BATCH_MAX_PATHS} paths are accepted per batch")
+    priority = request_obj.get("priority", "bulk")
+    ingest_lane(priority, None)  # validates it
+
+    results: List[Dict[str, Any]] = [{"path": path} for path in paths]
+    valid: List[Tuple[int, str, str]] = []
+    for i, path in enumerate(paths):
+        parts = path.removeprefix("/uploads/").split("/") if isinstance(path, str) else []
+        if len(parts) != 2 or not all(parts) or not parts[1].endswith((".txt", ".md")):
+            results[i]["error"] = "Path must be <folder>/<filename> of a .txt or .md file"
+        else:
+            valid.append((i, parts[0], parts[1]))
+
+    # One listing per folder instead of a request per file, for the size-aware lanes. Files of a folder that can't be
+    # listed go to the bulk lane, as a single ingest does when the size of its file can't be read.
+    sizes: Dict[str, int] = {}
+    if priority == "bulk":
+        for folder in {folder for _, folder, _ in valid}:
+            try:
+                for obj in minio_client.list_objects(bucket_name, prefix=f"uploads/{folder}/"):
+                    sizes[obj.object_name.lstrip("/")] = obj.size
+            except S3Error as err:
+                log.warning("Unable to list uploads/%s/, its files go to the bulk lane: %s", folder, err)
+    requests = [
+        (folder, filename, ingest_lane(priority, sizes.get(f"uploads/{folder}/{filename}")), "ingest")
+        for _, folder, filename in valid
+    ]
+    for (i, _, _), ingest_obj in zip(valid, queue_ingests(requests)):
+        results[i] = ingest_obj
+    return jsonify({"results": results}), 200
+
+
+@app.route("/ingest/<upload_id>", methods=["GET"])  # type: ignore
+def ingest_status(upload_id: str) -> Any:
+    """Status of an ingest job: state, chunk counts, progress and seconds spent in each stage"""
+    try:
+        job = IngestJob(redis.StrictRedis(connection_pool=redis_pool), upload_id).get()
+    except redis.exceptions.RedisError as e:
+        raise HTTPException(f"Unable to read ingest job: {e}")
+    if job is None:
+        raise NotFound(f"No ingest job {upload_id}")
+    return jsonify(job), 200
+
+
+def build_prompt(question: str, metadatas: List[Dict[str, Any]]) -> str:
+    """Combine the retrieved chunks and the question into a prompt."""
+    context = "\n".join([m["text"] for m in metadatas])
 
     if not question.endswith("?"):
         question = question + "?"
 
     # Combine the summaries into a prompt and use SotA GPT-4 to answer.
-    prompt = (
+    return (
         # Identity
         "Your name is Milo. You are a chatbot representing the MLOps Community. "
         # Purpose
@@ -210,10 +443,153 @@ def chat():
         "```"
         f"\nQuestion: {question}"
     )
-    completion = client.chat.completions.create(model="gpt-3.5-turbo", messages=[{"role": "user", "content": prompt}])
-    answer = completion.choices[0].message.content
+
+
+def sse(data: Any, event: Optional[str] = None) -> str:
+    """Format a server-sent event."""
+    message = f"event: {event}\n" if event else ""
+    return f"{message}data: {json.dumps(data)}\n\n"
+
+
+@app.route("/chat", methods=["POST"])  # type: ignore
+def chat():
+    """Answer a question given a context."""
+    if request.accept_mimetypes.best == "text/event-stream":
+        return chat_stream()
+    request_obj = request.get_json()
+    question = request_obj["question"]
+    embedding = get_embedding(question)
+    results = query_chunks([embedding])
+    answer = answer_question(question, embedding, results["ids"][0], results["metadatas"][0])
     return jsonify({"answer": answer}), 200
 
 
+def answer_question(
+    question: str, embedding: List[float], chunk_ids: List[str], metadatas: List[Dict[str, Any]]
+) -> Any:
+    """Answer the question from the retrieved chunks, or from the answer cache."""
+    answer = get_cached_answer(embedding, chunk_ids)
+    if answer is not None:
+        return answer
+    with PROMPT_SECONDS.time():
+        prompt = build_prompt(question, metadatas)
+    with COMPLETION_SECONDS.time():
+        completion = client.chat.completions.create(
+            model="gpt-3.5-turbo", messages=[{"role": "user", "content": prompt}]
+        )
+    count_completion_tokens("gpt-3.5-turbo", completion.usage)
+    answer = completion.choices[0].message.content
+    if answer:  # an empty completion (e.g. filtered) is not worth serving again
+        answer_cache.set(embedding, chunk_ids, [m["path"] for m in metadatas], answer)
+    return answer
+
+
+@app.route("/chat/batch", methods=["POST"])  # type: ignore
+def chat_batch() -> Any:
+    """
+    Answer many questions, with one embeddings request and one vector query for all of them.
+    Results are in the order of the questions, each with either an answer or an error.
+    """
+    request_obj = request.get_json()
+    questions = request_obj.get("questions") if isinstance(request_obj, dict) else None
+    if not isinstance(questions, list):
+        raise UnprocessableEntity("Expected a JSON object with a list of questions")
+    if len(questions) > CHAT_BATCH_MAX_QUESTIONS:
+        raise UnprocessableEntity(f"At most {CHAT_BATCH_MAX_QUESTIONS} questions are accepted per batch")
+
+    results: List[Dict[str, Any]] = [{"question": question} for question in questions]
+    valid = [i for i, question in enumerate(questions) if isinstance(question, str) and question.strip()]
+    for i in set(range(len(questions))) - set(valid):
+        results[i]["error"] = "Question must be a non-empty string"
+    if not valid:
+        return jsonify({"results": results}), 200
+
+    try:
+        embeddings = get_embeddings([questions[i] for i in valid])
+        matches = query_chunks(embeddings)
+    except Exception as e:  # pylint: disable=broad-except
+        traceback.print_exc()
+        for i in valid:
+            results[i]["error"] = f"Unable to retrieve context: {e}"
+        return jsonify({"results": results}), 200
+
+    def answer_item(j: int) -> None:
+        """Answer one of the valid questions"""
+        i = valid[j]
+        try:
+            results[i]["answer"] = answer_question(
+                questions[i], embeddings[j], matches["ids"][j], matches["metadatas"][j]
+            )
+        except Exception as e:  # pylint: disable=broad-except
+            traceback.print_exc()
+            results[i]["error"] = str(e)
+
+    with ThreadPoolExecutor(max_workers=CHAT_BATCH_CONCURRENCY) as executor:
+        list(executor.map(answer_item, range(len(valid))))
+    return jsonify({"results": results}), 200
+
+
+@app.route("/chat/stream", methods=["POST"])  # type: ignore
+def chat_stream() -> Any:
+    """
+    Answer a question given a context, as server-sent events.
+    A 'metadata' event with the retrieved sources comes first, then the answer tokens as they are generated,
+    and finally a 'done' event (or an 'error' event).
+    """
+    request_obj = request.get_json()
+    question = request_obj["question"]
+    embedding = get_embedding(question)
+    results = query_chunks([embedding])
+    chunk_ids = results["ids"][0]
+    metadatas = results["metadatas"][0]
+    sources = [
+        {"id": chunk_id, "path": m["path"], "distance": distance}
+        for chunk_id, m, distance in zip(chunk_ids, metadatas, results["distances"][0])
+    ]
+    cached_answer = get_cached_answer(embedding, chunk_ids)
+
+    def generate() -> Iterator[str]:
+        """Stream the answer"""
+        yield sse({"sources": sources, "cached": cached_answer is not None}, event="metadata")
+        if cached_answer is not None:
+            yield sse({"token": cached_answer})
+            yield sse({}, event="done")
+            return
+        with PROMPT_SECONDS.time():
+            prompt = build_prompt(question, metadatas)
+        tokens: List[str] = []
+        started = time.perf_counter()
+        try:
+            stream = client.chat.completions.create(
+                model="gpt-3.5-turbo",
+                messages=[{"role": "user", "content": prompt}],
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            for chunk in stream:
+                count_completion_tokens("gpt-3.5-turbo", chunk.usage)
+                token = chunk.choices[0].delta.content if chunk.choices else None
+                if token:
+                    if not tokens:
+                        FIRST_TOKEN_SECONDS.observe(time.perf_counter() - started)
+                    tokens.append(token)
+                    yield sse({"token": token})
+            COMPLETION_SECONDS.observe(time.perf_counter() - started)
+        except openai.OpenAIError as e:
+            traceback.print_exc()
+            yield sse({"description": str(e)}, event="error")
+            return
+        if tokens:
+            answer_cache.set(embedding, chunk_ids, [m["path"] for m in metadatas], "".join(tokens))
+        yield sse({}, event="done")
+
+    # X-Accel-Buffering stops nginx from buffering the events
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,9 @@
+"""Gunicorn hooks, see serve."""
+from typing import Any
+
+from prometheus_client import multiprocess
+
+
+def child_exit(_server: Any, worker: Any) -> None:
+    """Drop the live gauges of a worker that exited, its counters are kept"""
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,195 @@
+"""
+    In-process replica of a Chroma collection's vectors, so that nearest neighbour queries skip the HTTP hop.
+    Chroma stays the source of truth: the replica is loaded from it, refreshed per document from the change
+    notifications the ingest workers publish on Redis, and reports itself stale (so that callers fall back to
+    Chroma) until it is loaded, while it is disconnected from the notifications, or when it has missed some.
+"""
+import json
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import redis  # type: ignore
+from collection_alias import CollectionAlias
+
+log = logging.getLogger(__name__)
+
+
+class VectorReplica:
+    """Exact (brute force) nearest neighbour search over an in-memory copy of a Chroma collection."""
+
+    page_size = 1000  # vectors per request when loading from Chroma
+    check_interval = 5.0  # seconds between checks that no change notification was missed
+
+    def __init__(self, collection: Any, redis_client: redis.StrictRedis) -> None:
+        """Initialize the replica, call start() to load it."""
+        self.collection = collection
+        self.redis_client = redis_client
+        self.channel = f"{collection.name}:changes"  # published by the ingest workers
+        self.version_key = f"{collection.name}:version"  # incremented by the ingest workers on every change
+        self.version = -1
+        self.connected = False
+        self._lock = threading.Lock()
+        self._ids: List[str] = []
+        self._metadatas: List[Dict[str, Any]] = []
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._norms = np.zeros(0, dtype=np.float32)  # squared norms of the vectors
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        """Load the replica and keep it up to date in the background"""
+        threading.Thread(target=self._listen, name="vector-replica", daemon=True).start()
+
+    def stop(self) -> None:
+        """Stop keeping the replica up to date, it is stale from now on"""
+        self._stopped.set()
+        self.connected = False
+
+    def fresh(self) -> bool:
+        """Whether the replica can answer queries"""
+        return self.connected and self.version >= 0
+
+    def query(self, query_embeddings: Sequence[Sequence[float]], n_results: int) -> Optional[Dict[str, Any]]:
+        """Nearest neighbours in the same format as collection.query(), or None if the replica is stale"""
+        if not self.fresh():
+            return None
+        with self._lock:
+            ids, metadatas, vectors, norms = self._ids, self._metadatas, self._vectors, self._norms
+        results: Dict[str, Any] = {"ids": [], "metadatas": [], "distances": []}
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if not ids:
+            for _ in queries:
+                results["ids"].append([])
+                results["metadatas"].append([])
+                results["distances"].append([])
+            return results
+        # Squared L2 distance, same as Chroma's default space
+        distances = norms[None, :] + (queries**2).sum(axis=1)[:, None] - 2 * queries @ vectors.T
+        k = min(n_results, len(ids))
+        for row in distances:
+            nearest = np.argpartition(row, k - 1)[:k]
+            nearest = nearest[np.argsort(row[nearest])]
+            results["ids"].append([ids[i] for i in nearest])
+            results["metadatas"].append([metadatas[i] for i in nearest])
+            results["distances"].append([float(max(row[i], 0.0)) for i in nearest])
+        return results
+
+    def load(self) -> None:
+        """Load every vector of the collection"""
+        version = int(self.redis_client.get(self.version_key) or 0)
+        ids: List[str] = []
+        metadatas: List[Dict[str, Any]] = []
+        embeddings: List[Sequence[float]] = []
+        offset = 0
+        while True:
+            page = self.collection.get(include=["embeddings", "metadatas"], limit=self.page_size, offset=offset)
+            ids.extend(page["ids"])
+            metadatas.extend(page["metadatas"])
+            embeddings.extend(page["embeddings"])
+            if len(page["ids"]) < self.page_size:
+                break
+            offset += self.page_size
+        # An empty collection has no dimension to reshape to
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1) if ids else self._vectors[:0]
+        self._swap(ids, metadatas, vectors)
+        self.version = version
+        log.info("Loaded %s vectors of %s (version %s)", len(ids), self.collection.name, version)
+
+    def refresh(self, path: str) -> None:
+        """Replace the vectors of a document with what is in Chroma now"""
+        page = self.collection.get(where={"path": path}, include=["embeddings", "metadatas"])
+        with self._lock:
+            keep = [i for i, metadata in enumerate(self._metadatas) if metadata.get("path") != path]
+            ids = [self._ids[i] for i in keep] + list(page["ids"])
+            metadatas = [self._metadatas[i] for i in keep] + list(page["metadatas"])
+            vectors = self._vectors[keep] if len(self._ids) else self._vectors
+        if page["ids"]:
+            added = np.asarray(page["embeddings"], dtype=np.float32)
+            vectors = np.concatenate([vectors, added]) if len(vectors) else added
+        self._swap(ids, metadatas, vectors)
+
+    def _swap(self, ids: List[str], metadatas: List[Dict[str, Any]], vectors: np.ndarray) -> None:
+        """Replace the replica's contents, queries in progress keep using the previous ones"""
+        norms = (vectors**2).sum(axis=1) if len(vectors) else np.zeros(0, dtype=np.float32)
+        with self._lock:
+            self._ids, self._metadatas, self._vectors, self._norms = ids, metadatas, vectors, norms
+
+    def _listen(self) -> None:
+        """Apply the change notifications, reloading whenever some could have been missed"""
+        while not self._stopped.is_set():
+            pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+            try:
+                # Subscribe before loading, so that changes made during the load are not missed
+                pubsub.subscribe(self.channel)
+                self.load()
+                self.connected = not self._stopped.is_set()
+                last_check = time.monotonic()
+                behind = False
+                while not self._stopped.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        change = json.loads(message["data"])
+                        if change["version"] <= self.version:
+                            continue  # Already part of what we loaded
+                        if change["version"] > self.version + 1:
+                            log.warning("Missed changes to %s, reloading", self.collection.name)
+                            self.load()
+                            continue
+                        self.refresh(change["path"])
+                        self.version = change["version"]
+                    elif time.monotonic() - last_check > self.check_interval:
+                        # Behind for two checks in a row means that it wasn't a notification on its way
+                        last_check = time.monotonic()
+                        was_behind, behind = behind, int(self.redis_client.get(self.version_key) or 0) > self.version
+                        if was_behind and behind:
+                            log.warning("Missed changes to %s, reloading", self.collection.name)
+                            self.load()
+                            behind = False
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Vector replica of %s is stale, retrying", self.collection.name)
+                self.connected = False
+                self._stopped.wait(1)
+            finally:
+                pubsub.close()
+
+
+class AliasedReplica:
+    """
+    Replica of the collection an alias points at. When the alias is flipped, queries stay on the previous collection
+    and its replica until the replica of the new collection is loaded.
+    """
+
+    def __init__(
+        self, collection_alias: CollectionAlias, redis_client: redis.StrictRedis, enabled: bool = True
+    ) -> None:
+        """Initialize the replica of the collection the alias points at, loaded in the background if enabled."""
+        self.collection_alias = collection_alias
+        self.redis_client = redis_client
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.replica = self._replica(collection_alias.collection())
+        self._next: Optional[VectorReplica] = None
+
+    def _replica(self, collection: Any) -> VectorReplica:
+        """A replica of a collection, left stale if replicas are disabled"""
+        replica = VectorReplica(collection, self.redis_client)
+        if self.enabled:
+            replica.start()
+        return replica
+
+    def current(self) -> Tuple[Any, VectorReplica]:
+        """The collection to query and its replica"""
+        collection = self.collection_alias.collection()
+        with self._lock:
+            if collection.name != self.replica.collection.name:
+                if self._next is None or self._next.collection.name != collection.name:
+                    if self._next is not None:
+                        self._next.stop()
+                    self._next = self._replica(collection)
+                if self._next.fresh() or not self.enabled:
+                    log.info("Switching from collection %s to %s", self.replica.collection.name, collection.name)
+                    self.replica.stop()
+                    self.replica, self._next = self._next, None
+            return self.replica.collection, self.replica
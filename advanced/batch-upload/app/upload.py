@@ -1,25 +1,63 @@
 """Uploader script that works instead of front-end"""
+import asyncio
 import glob
+import hashlib
+import json
 import os
+import random
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Tuple, cast
 
 import httpx
 
+UPLOAD_CONCURRENCY = int(os.environ.get("UPLOAD_CONCURRENCY", "16"))  # files uploaded at once
+UPLOAD_MAX_RETRIES = int(os.environ.get("UPLOAD_MAX_RETRIES", "5"))
+UPLOAD_READ_BYTES = 64 * 1024
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", "500"))  # files queued per /ingest/batch request
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
 
-def upload_file(api_url: str, local_file_path: str, destination_folder: str) -> None:
-    """Upload the file from local to s3"""
+# Sync mode: only upload and ingest the files whose content changed since the last sync, as recorded in the manifest,
+# and optionally delete the documents whose file was removed
+UPLOAD_SYNC = os.environ.get("UPLOAD_SYNC", "false").lower() == "true"
+UPLOAD_MANIFEST = os.environ.get("UPLOAD_MANIFEST", ".sync/manifest.json")
+UPLOAD_DELETE_REMOVED = os.environ.get("UPLOAD_DELETE_REMOVED", "false").lower() == "true"
+
+
+async def read_file(local_file_path: str) -> AsyncIterator[bytes]:
+    """Stream the content of a file, so that it is never fully in memory"""
+    with open(local_file_path, "rb") as file:
+        while data := file.read(UPLOAD_READ_BYTES):
+            yield data
+
+
+async def with_retries(send: Callable[[], Awaitable[httpx.Response]], what: str) -> httpx.Response:
+    """Send a request, retrying connection errors and transient responses with jittered exponential backoff"""
+    for attempt in range(UPLOAD_MAX_RETRIES):
+        try:
+            response = await send()
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                return response
+            error = f"{response.status_code} {response.text}"
+        except httpx.TransportError as e:
+            error = repr(e)
+        if attempt == UPLOAD_MAX_RETRIES - 1:
+            raise Exception(f"Failed to {what}: {error}")
+        delay = random.uniform(0, min(2**attempt, 30))
+        print(f"Failed to {what} ({error}), retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+    raise RuntimeError("unreachable")
+
+
+async def upload_file(client: httpx.AsyncClient, api_url: str, local_file_path: str, destination_folder: str) -> int:
+    """Upload the file from local to s3, returns its size"""
     # Extract the filename from the local file path
     filename = os.path.basename(local_file_path)
 
     # Construct the URL for the upload endpoint
     upload_url = f"{api_url}/uploads/{destination_folder}/{filename}"
 
-    # Read the file content
-    with open(local_file_path, "rb") as file:
-        file_content = file.read()
-
-    # Make a POST request to get the presigned URL
-    response = httpx.put(upload_url)
-    print(response.status_code)
+    # Make a PUT request to get the presigned URL
+    response = await with_retries(lambda: client.put(upload_url), f"get presigned URL for {filename}")
 
     # Check if the request was successful
     if response.status_code != 307:
@@ -30,33 +68,163 @@ def upload_file(api_url: str, local_file_path: str, destination_folder: str) ->
     if not presigned_url:
         raise Exception("Presigned URL not found in the response")
 
-    # Upload the file to the presigned URL
-    upload_response = httpx.put(presigned_url, content=file_content)
+    # Stream the file to the presigned URL, S3 needs its length upfront
+    size = os.path.getsize(local_file_path)
+    upload_response = await with_retries(
+        lambda: client.put(presigned_url, content=read_file(local_file_path), headers={"Content-Length": str(size)}),
+        f"upload {filename}",
+    )
 
     # Check if the upload was successful
     if upload_response.status_code != 200:
         raise Exception(f"Failed to upload file: {upload_response.text}")
-
-    print(f"File {filename} uploaded successfully to {destination_folder}")
-
-
-def ingest_file(api_url: str, local_file_path: str, destination_folder: str) -> None:
-    """send a message to backend to begin processing the file"""
-    # Extract the filename from the local file path
-    filename = os.path.basename(local_file_path)
-
-    # Construct the URL for the upload endpoint
-    ingest_url = f"{api_url}/ingest/{destination_folder}/{filename}"
-
-    # Make a POST request to get the presigned URL
-    response = httpx.post(ingest_url)
-    print(response.status_code)
+    return size
+
+
+async def ingest_files(client: httpx.AsyncClient, api_url: str, files: List[Tuple[str, str]]) -> List[str]:
+    """Queue the ingest of the (local path, folder) files in one request, returns the local paths that were queued"""
+    paths = [f"{folder}/{os.path.basename(local_file_path)}" for local_file_path, folder in files]
+
+    # Queue them as bulk requests, so that they don't hold back interactive updates
+    response = await with_retries(
+        lambda: client.post(f"{api_url}/ingest/batch", json={"paths": paths, "priority": "bulk"}),
+        f"queue ingest of {len(paths)} files",
+    )
+    if response.status_code != 200:
+        raise Exception(f"Failed to queue ingest: {response.text}")
+    queued = []
+    for (local_file_path, _), result in zip(files, response.json()["results"]):
+        if "error" in result:
+            print(f"{local_file_path} not queued: {result['error']}")
+        else:
+            queued.append(local_file_path)
+    return queued
+
+
+async def delete_file(client: httpx.AsyncClient, api_url: str, destination_folder: str, filename: str) -> None:
+    """Delete an uploaded file, and its document from the knowledge base"""
+    delete_url = f"{api_url}/uploads/{destination_folder}/{filename}"
+    response = await with_retries(lambda: client.delete(delete_url), f"delete {filename}")
+    if response.status_code not in (200, 404):
+        raise Exception(f"Failed to delete file: {response.text}")
+
+
+async def upload_all(api_url: str, files: List[Tuple[str, str]]) -> List[str]:
+    """
+    Upload and ingest the (local path, folder) files, UPLOAD_CONCURRENCY at a time over pooled connections.
+    Uploaded files are queued for ingest INGEST_BATCH_SIZE at a time. Returns the local paths that were queued.
+    """
+    semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+    stats: Dict[str, int] = {"uploaded": 0, "failed": 0, "bytes": 0}
+    pending: List[Tuple[str, str]] = []  # uploaded, not queued yet
+    queued: List[str] = []
+    started = time.perf_counter()
+
+    async def flush(client: httpx.AsyncClient, batch: List[Tuple[str, str]]) -> None:
+        """Queue a batch of uploaded files for ingest"""
+        try:
+            queued.extend(await ingest_files(client, api_url, batch))
+        except Exception as e:  # pylint: disable=broad-except
+            print(f"{len(batch)} files not queued: {e}")
+
+    async def process(client: httpx.AsyncClient, local_file_path: str, folder_name: str) -> None:
+        """Upload one file, and queue the pending files once there are enough of them"""
+        async with semaphore:
+            try:
+                size = await upload_file(client, api_url, local_file_path, folder_name)
+            except Exception as e:  # pylint: disable=broad-except
+                stats["failed"] += 1
+                print(f"{local_file_path} failed: {e}")
+                return
+            stats["uploaded"] += 1
+            stats["bytes"] += size
+            print(f"[{stats['uploaded'] + stats['failed']}/{len(files)}] {local_file_path} uploaded to {folder_name}")
+        pending.append((local_file_path, folder_name))
+        if len(pending) >= INGEST_BATCH_SIZE:
+            batch = pending[:]
+            pending.clear()
+            await flush(client, batch)
+
+    limits = httpx.Limits(max_connections=UPLOAD_CONCURRENCY * 2, max_keepalive_connections=UPLOAD_CONCURRENCY * 2)
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(60.0)) as client:
+        await asyncio.gather(*(process(client, path, folder) for path, folder in files))
+        if pending:
+            await flush(client, pending)
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"Uploaded {stats['uploaded']} files ({stats['bytes'] / 1e6:.1f} MB) in {elapsed:.1f}s: "
+        f"{stats['uploaded'] / elapsed:.1f} files/s, {stats['bytes'] / 1e6 / elapsed:.2f} MB/s, "
+        f"{stats['failed']} failed, {len(queued)} queued for ingest"
+    )
+    return queued
+
+
+def file_hash(local_file_path: str) -> str:
+    """sha256 of the content of a file"""
+    digest = hashlib.sha256()
+    with open(local_file_path, "rb") as file:
+        while data := file.read(UPLOAD_READ_BYTES):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def load_manifest(manifest_path: str) -> Dict[str, Dict[str, Any]]:
+    """What was synced, by folder/filename, empty on the first sync"""
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, encoding="utf-8") as file:
+        manifest = json.load(file)
+    if not isinstance(manifest, dict) or not all(isinstance(entry, dict) for entry in manifest.values()):
+        raise ValueError(f"{manifest_path} is not a sync manifest, delete it to sync everything again")
+    return cast(Dict[str, Dict[str, Any]], manifest)
+
+
+def save_manifest(manifest_path: str, manifest: Dict[str, Dict[str, Any]]) -> None:
+    """Save the manifest, replacing the previous one at once so that an interrupted sync can't corrupt it"""
+    os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+    with open(f"{manifest_path}.tmp", "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+
+async def sync_all(api_url: str, files: List[Tuple[str, str]]) -> None:
+    """Upload and ingest the files that are new or changed since the last sync, and delete the removed ones"""
+    manifest = load_manifest(UPLOAD_MANIFEST)
+    hashes = {path: file_hash(path) for path, _ in files}
+    keys = {path: f"{folder}/{os.path.basename(path)}" for path, folder in files}
+    changed = [(path, folder) for path, folder in files if manifest.get(keys[path], {}).get("sha256") != hashes[path]]
+    removed = sorted(set(manifest) - set(keys.values()))
+    print(f"{len(files) - len(changed)} files unchanged, {len(changed)} new or changed, {len(removed)} removed")
+
+    for path in await upload_all(api_url, changed):
+        manifest[keys[path]] = {"sha256": hashes[path], "size": os.path.getsize(path), "synced_at": time.time()}
+    save_manifest(UPLOAD_MANIFEST, manifest)
+
+    if removed and UPLOAD_DELETE_REMOVED:
+        async with httpx.AsyncClient(timeout=httpx.Timeout(60.0)) as client:
+            semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+            async def delete(key: str) -> None:
+                """Delete one removed file"""
+                async with semaphore:
+                    try:
+                        await delete_file(client, api_url, *key.split("/", 1))
+                    except Exception as e:  # pylint: disable=broad-except
+                        print(f"{key} failed: {e}")
+                        return
+                    del manifest[key]
+                    print(f"{key} deleted")
+
+            await asyncio.gather(*(delete(key) for key in removed))
+        save_manifest(UPLOAD_MANIFEST, manifest)
 
 
 if __name__ == "__main__":
     api_url = os.environ["BACKEND_URL"]
 
     # Loop through all files in 'files/' directory and its subdirectories
+    files = []
     for file_path in glob.glob("files/**/*", recursive=True):
         # Check if the path is a file and not a directory
         if os.path.isfile(file_path):
@@ -65,6 +233,5 @@ if __name__ == "__main__":
             file_name = os.path.basename(file_path)
             if not (file_name.endswith(".txt") or file_name.endswith(".md")):
                 continue
-            print(f"Folder: {folder_name}, File: {file_name}")
-            upload_file(api_url, f"./files/{folder_name}/{file_name}", folder_name)
-            ingest_file(api_url, f"./files/{folder_name}/{file_name}", folder_name)
+            files.append((f"./files/{folder_name}/{file_name}", folder_name))
+    asyncio.run(sync_all(api_url, files) if UPLOAD_SYNC else upload_all(api_url, files))
@@ -0,0 +1,167 @@
+"""
+    Chunkers that split a document into the pieces we embed.
+    They read the document as an iterable of lines, so that large files can be chunked incrementally,
+    and yield each chunk as soon as it is complete.
+"""
+import itertools
+import re
+from typing import Any, Callable, Dict, Iterable, Iterator, List
+
+HEADING = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+FENCE = re.compile(r"^\s*(```|~~~)")
+SENTENCE = re.compile(r".*?(?:[.!?]\s+|$)")  # a sentence and the whitespace after it
+WORD = re.compile(r"\s*\S+\s*")  # a word and the whitespace around it
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count, one token ~= 4 characters"""
+    return len(text) // 4 + 1
+
+
+def iter_blocks(lines: Iterable[str]) -> Iterator[str]:
+    """Blocks of a markdown document: headings, and paragraphs/lists/code separated by blank lines"""
+    block: List[str] = []
+    in_fence = False
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if FENCE.match(line):
+            in_fence = not in_fence
+        elif not in_fence and HEADING.match(line):
+            if block:
+                yield "\n".join(block)
+            block = []
+            yield line
+            continue
+        elif not in_fence and not line.strip():
+            if block:
+                yield "\n".join(block)
+            block = []
+            continue
+        block.append(line)
+    if block:
+        yield "\n".join(block)
+
+
+def split_units(text: str, max_tokens: int) -> Iterator[str]:
+    """
+    Lines of the text with their newline, and for a line over the limit, its sentences, words or characters.
+    Each unit keeps the whitespace that follows it, so that concatenating them gives back the text.
+    """
+    max_chars = max_tokens * 4
+    for line in text.splitlines(keepends=True):
+        if estimate_tokens(line) <= max_tokens:
+            yield line
+            continue
+        for sentence in filter(None, SENTENCE.findall(line)):
+            if estimate_tokens(sentence) <= max_tokens:
+                yield sentence
+                continue
+            for word in WORD.findall(sentence):
+                # A single word can still be over the limit (e.g. a long URL or base64 blob)
+                yield from (word[i : i + max_chars] for i in range(0, len(word), max_chars))
+
+
+def split_long(text: str, max_tokens: int) -> List[str]:
+    """Split a block that is over the limit at line boundaries, or sentence/word boundaries for a long line"""
+    if estimate_tokens(text) <= max_tokens:
+        return [text]
+    pieces: List[str] = []
+    current = ""
+    for unit in split_units(text, max_tokens):
+        if current and estimate_tokens(current + unit) > max_tokens:
+            pieces.append(current)
+            current = ""
+        current += unit
+    pieces.append(current)
+    return [piece.rstrip() for piece in pieces if piece.strip()]
+
+
+class ParagraphChunker:
+    """One chunk per paragraph, as we used to chunk with content.split("\\n\\n")."""
+
+    def __init__(self, target_tokens: int = 2000, **_: Any) -> None:
+        """Initialize the chunker."""
+        self.target_tokens = target_tokens
+
+    def chunks(self, lines: Iterable[str]) -> Iterator[str]:
+        """Yield the paragraphs of the document, split if they are over the embedding limit"""
+        paragraph: List[str] = []
+        for line in itertools.chain(lines, [""]):
+            line = line.rstrip("\r\n")
+            if line.strip():
+                paragraph.append(line)
+            elif paragraph:
+                yield from split_long("\n".join(paragraph), self.target_tokens)
+                paragraph = []
+
+
+class MarkdownChunker:
+    """
+    Heading-aware chunks of about target_tokens.
+    Blocks of a section are merged until the target size, chunks that continue a section start with the
+    section's headings and overlap the end of the previous chunk, and fragments under min_tokens are merged
+    into the next chunk instead of being embedded on their own.
+    """
+
+    def __init__(self, target_tokens: int = 400, overlap_tokens: int = 40, min_tokens: int = 60) -> None:
+        """Initialize the chunker."""
+        self.target_tokens = target_tokens
+        self.overlap_tokens = overlap_tokens
+        self.min_tokens = min_tokens
+
+    def chunks(self, lines: Iterable[str]) -> Iterator[str]:
+        """Yield the chunks of the document"""
+        headings: List[str] = []  # the heading of each level of the current section
+        current: List[str] = []
+        current_tokens = 0
+
+        for block in iter_blocks(lines):
+            heading = HEADING.match(block)
+            if heading:
+                # A new section, emit what we have unless it is too small to stand on its own
+                if current and current_tokens >= self.min_tokens:
+                    yield "\n\n".join(current)
+                    current, current_tokens = [], 0
+                level = len(heading.group(1))
+                headings = headings[: level - 1] + [block]
+                current.append(block)
+                current_tokens += estimate_tokens(block)
+                continue
+
+            for piece in split_long(block, self.target_tokens):
+                tokens = estimate_tokens(piece)
+                # A fragment under min_tokens (e.g. a lone heading) goes with the piece, even over the target
+                if current and current_tokens >= self.min_tokens and current_tokens + tokens > self.target_tokens:
+                    yield "\n\n".join(current)
+                    current = self._continuation(headings, current[-1])
+                    current_tokens = sum(estimate_tokens(part) for part in current)
+                current.append(piece)
+                current_tokens += tokens
+
+        if current:
+            yield "\n\n".join(current)
+
+    def _continuation(self, headings: List[str], previous: str) -> List[str]:
+        """Start of a chunk that continues a section: its headings, and the end of the previous chunk"""
+        start = list(headings)
+        max_chars = self.overlap_tokens * 4
+        if max_chars and previous not in headings:
+            tail = previous[-max_chars:]
+            if len(previous) > max_chars and " " in tail:
+                # Start at a word boundary
+                tail = tail[tail.find(" ") + 1 :]
+            start.append(tail)
+        return start
+
+
+CHUNKERS: Dict[str, Callable[..., Any]] = {
+    "paragraph": ParagraphChunker,
+    "markdown": MarkdownChunker,
+}
+
+
+def get_chunker(name: str, **kwargs: Any) -> Any:
+    """Chunker by name, see CHUNKERS"""
+    if name not in CHUNKERS:
+        raise ValueError(f"Unknown chunker {name}, expected one of {', '.join(CHUNKERS)}")
+    return CHUNKERS[name](**kwargs)
@@ -1,31 +1,123 @@
 """Ingest Message Queue Processor"""
+import codecs
+import hashlib
 import json
 import logging
 import os
+import queue
+import random
+import signal
+import socket
 import sys
+import threading
+import time
 import traceback
-from io import StringIO
-from typing import Any, Dict, Optional
+import urllib.parse
+from contextlib import contextmanager
+from types import FrameType
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 from uuid import uuid4
 
 import chromadb
+import openai
 import redis  # type: ignore
+from answer_cache import AnswerCache
 from chromadb.config import Settings
+from chunker import estimate_tokens, get_chunker
+from collection_alias import CollectionAlias
+from embedding_cache import EmbeddingCache
+from ingest_job import IngestJob
+from ingest_queue import IngestQueue
 from minio import Minio
 from minio.error import S3Error
 from openai import OpenAI
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 
 # Set up logger
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 log = logging.getLogger(__name__)
 
+# Worker pool: consumer threads per process, and in-flight embedding requests shared by them
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", "4"))
+EMBEDDING_CONCURRENCY = int(os.environ.get("EMBEDDING_CONCURRENCY", "4"))
+QUEUE_POLL_TIMEOUT = 5  # seconds a consumer blocks on the queue before checking for shutdown
+JOB_PROGRESS_INTERVAL = 1  # seconds between updates of the chunks read in a job's status
+shutdown = threading.Event()
+
+# Ingest queue: priority lanes of per-folder Redis streams read by a consumer group, see ingest_queue. Entries are acked
+# once ingested; entries left pending by a crashed consumer or a failed ingest are reclaimed, and dead-lettered after
+# too many deliveries.
+INGEST_GROUP = "build-index"
+INGEST_LANE_WEIGHTS = {
+    lane: int(weight)
+    for lane, weight in (
+        item.split(":") for item in os.environ.get("INGEST_LANE_WEIGHTS", "interactive:8,small:3,bulk:1").split(",")
+    )
+}
+INGEST_DEAD_LETTER_STREAM = "ingest:dead"
+INGEST_ERRORS = "ingest:errors"  # last error of failed entries, by stream/entry id
+INGEST_CLAIM_IDLE_MS = int(os.environ.get("INGEST_CLAIM_IDLE_MS", "60000"))  # no heartbeat for longer = consumer died
+INGEST_HEARTBEAT_MS = int(os.environ.get("INGEST_HEARTBEAT_MS", "10000"))  # consumers reclaim their entries this often
+INGEST_RETRY_BASE_MS = int(os.environ.get("INGEST_RETRY_BASE_MS", "10000"))  # doubles on every retry
+INGEST_RETRY_MAX_MS = int(os.environ.get("INGEST_RETRY_MAX_MS", "900000"))
+INGEST_MAX_DELIVERIES = int(os.environ.get("INGEST_MAX_DELIVERIES", "5"))
+INGEST_RECLAIM_INTERVAL = 10  # seconds between a consumer's checks for entries to reclaim
+# Requests are coalesced per path: the backend records the latest request of each path, older ones are skipped, or
+# cancelled at their next batch if they are in flight, and a path is locked so that one version is ingested at a time.
+INGEST_LATEST = "ingest:latest"
+INGEST_LOCKS = "ingest:lock"
+RELEASE_LOCK = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+REFRESH_LOCK = (
+    "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end return 0"
+)
+# Versions are published in the order they are incremented, replicas reload when they see a gap
+NOTIFY_CHANGE = """
+local version = redis.call('incr', KEYS[1])
+redis.call('publish', KEYS[2], cjson.encode({path = ARGV[1], version = version}))
+return version
+"""
+# Bucket notifications: MinIO pushes the events of objects created under uploads/ to a Redis list when it is started
+# with INGEST_BUCKET_EVENTS too (see common/docker-compose.yaml). With INGEST_BUCKET_EVENTS, the workers queue an
+# ingest for every uploaded document themselves, once per burst of events for the same object, so that clients don't
+# have to POST /ingest.
+INGEST_BUCKET_EVENTS = os.environ.get("INGEST_BUCKET_EVENTS", "false").lower() == "true"
+INGEST_BUCKET_EVENTS_KEY = os.environ.get("INGEST_BUCKET_EVENTS_KEY", "minio:events")
+INGEST_BUCKET_EVENTS_LANE = os.environ.get("INGEST_BUCKET_EVENTS_LANE", "interactive")
+INGEST_DEBOUNCE = "ingest:debounce"  # uploaded objects to queue, scored by when
+INGEST_DEBOUNCE_MS = int(os.environ.get("INGEST_DEBOUNCE_MS", "2000"))
+S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME", "data")
+
+# Metrics, served on METRICS_PORT (+ the pm2 instance number when running several processes)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9100")) + int(os.environ.get("NODE_APP_INSTANCE", "0"))
+STAGE_SECONDS = Histogram(
+    "ingest_stage_seconds",
+    "Time spent in each stage of ingesting a document",
+    ["stage"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+INGEST_SECONDS = STAGE_SECONDS.labels("ingest")
+TOKENS = Counter("openai_tokens_total", "Tokens used by OpenAI requests", ["model", "kind"])
+CACHE_LOOKUPS = Counter("cache_lookups_total", "Cache lookups", ["cache", "result"])
+CHUNKS = Counter("ingest_chunks_total", "Chunks of ingested documents", ["result"])
+DOCUMENTS = Counter("ingest_documents_total", "Ingest requests processed", ["result"])
+IN_FLIGHT = Gauge("ingest_documents_in_flight", "Documents being ingested by this process")
+
+# Ingest pipeline: batches queued between stages, embedding workers and chroma write size per document
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", "2"))
+PIPELINE_EMBED_WORKERS = int(os.environ.get("PIPELINE_EMBED_WORKERS", "2"))
+CHROMA_WRITE_BATCH_SIZE = int(os.environ.get("CHROMA_WRITE_BATCH_SIZE", "500"))
+
 # Initialize Redis Client
 REDIS_URL = os.environ["REDIS_URL"]
 REDIS_PASSWORD = os.environ["REDIS_PASSWORD"]
 REDIS_DB = os.environ.get("REDIS_DB", "0")  # Default to DB 0 if not specified
 REDIS_PROTOCOL = os.environ.get("REDIS_PROTOCOL", "redis")
 REDIS_CONNECTION_STRING = f"{REDIS_PROTOCOL}://:{REDIS_PASSWORD}@{REDIS_URL}/{REDIS_DB}"
-redis_pool = redis.ConnectionPool.from_url(REDIS_CONNECTION_STRING)
+# Shared by all consumers, blocks (instead of failing) when all connections are in use. Each consumer uses one for
+# itself, one for its heartbeat and one per embedding worker, plus the bucket events watcher and the queue depth gauge
+REDIS_MAX_CONNECTIONS = WORKER_CONCURRENCY * (PIPELINE_EMBED_WORKERS + 2) + 2
+redis_pool = redis.BlockingConnectionPool.from_url(REDIS_CONNECTION_STRING, max_connections=REDIS_MAX_CONNECTIONS)
+ingest_queue = IngestQueue(redis.StrictRedis(connection_pool=redis_pool), INGEST_LANE_WEIGHTS, INGEST_GROUP)
 
 # Initialize MinIO client
 minio_client = Minio(
@@ -36,14 +128,45 @@ minio_client = Minio(
     secure=(os.environ["S3_SECURE"].lower() == "true"),
 )
 
+# Objects are streamed, larger ones in ranged requests
+S3_RANGE_BYTES = int(os.environ.get("S3_RANGE_BYTES", str(8 * 1024 * 1024)))
+S3_READ_BYTES = 64 * 1024
+S3_MAX_LINE_CHARS = 64 * 1024
+
 # Initialize Open AI client
 client = OpenAI()
 
+# Chunking, CHUNKER is one of chunker.CHUNKERS
+chunker = get_chunker(
+    os.environ.get("CHUNKER", "markdown"),
+    target_tokens=int(os.environ.get("CHUNK_TARGET_TOKENS", "400")),
+    overlap_tokens=int(os.environ.get("CHUNK_OVERLAP_TOKENS", "40")),
+    min_tokens=int(os.environ.get("CHUNK_MIN_TOKENS", "60")),
+)
 
-# Initialize Chroma Client
-# create client and a new collection
-chroma_collection_name = "blogs"
+# Embedding batching, the embeddings API accepts a list of inputs per request
+EMBEDDING_MODEL = "text-embedding-ada-002"
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "256"))  # max inputs per request
+EMBEDDING_BATCH_TOKENS = int(os.environ.get("EMBEDDING_BATCH_TOKENS", "100000"))  # max tokens per request
+EMBEDDING_MAX_RETRIES = int(os.environ.get("EMBEDDING_MAX_RETRIES", "5"))
+EMBEDDING_MAX_CHARS = 8000  # Hack to be under the 8k limit
+embedding_slots = threading.BoundedSemaphore(EMBEDDING_CONCURRENCY)
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+# Embeddings cache shared with the backend
+EMBEDDING_CACHE_MAX_BYTES = int(os.environ.get("EMBEDDING_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+embedding_cache = EmbeddingCache(redis.StrictRedis(connection_pool=redis_pool), EMBEDDING_CACHE_MAX_BYTES)
+
+# The backend's cache of answers, which we invalidate when a document they cited changes
+answer_cache = AnswerCache(redis.StrictRedis(connection_pool=redis_pool), similarity=1.0, ttl=0)
 
+
+# Initialize Chroma Client
 chroma_client = chromadb.HttpClient(
     host=os.environ["CHROMA_URL"],
     port=os.environ["CHROMA_PORT"],
@@ -54,109 +177,773 @@ chroma_client = chromadb.HttpClient(
 )
 chroma_client.heartbeat()
 
-try:
-    # Create the collection
-    chroma_collection = chroma_client.get_collection(chroma_collection_name)
-except (Exception, ValueError):
-    # Create the collection if it doesn't exist
-    chroma_collection = chroma_client.create_collection(chroma_collection_name)
+# Documents are written to the collection the "blogs" alias points at, looked up once per document
+CHROMA_ALIAS_REFRESH = float(os.environ.get("CHROMA_ALIAS_REFRESH", "5"))  # seconds between alias lookups
+collection_alias = CollectionAlias(
+    redis.StrictRedis(connection_pool=redis_pool), chroma_client, "blogs", CHROMA_ALIAS_REFRESH
+)
+collection_alias.collection()  # Created now if it doesn't exist yet
 
 
-def get_embedding(text: str) -> Any:
-    """Use the same embedding generator as what was used on the data!!!"""
-    if len(text) > 8000:  # Hack to be under the 8k limit
-        text = text[:8000]
-    response = client.embeddings.create(model="text-embedding-ada-002", input=text)
-    return response.data[0].embedding
+def batch_texts(texts: List[str]) -> Iterator[List[int]]:
+    """Group text indices into batches under the item and token limits"""
+    batch: List[int] = []
+    batch_tokens = 0
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if batch and (len(batch) >= EMBEDDING_BATCH_SIZE or batch_tokens + tokens > EMBEDDING_BATCH_TOKENS):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        yield batch
 
 
-def fetch_content(bucket_name: str, path: str) -> Optional[str]:
-    """Fetch content from S3"""
+def embed_batch(texts: List[str]) -> List[List[float]]:
+    """Embed one batch in a single request, retrying transient errors with exponential backoff"""
+    for attempt in range(EMBEDDING_MAX_RETRIES):
+        try:
+            with embedding_slots:
+                response = client.embeddings.create(model=EMBEDDING_MODEL, input=texts)
+            TOKENS.labels(EMBEDDING_MODEL, "embedding").inc(response.usage.total_tokens)
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        except RETRYABLE_ERRORS as e:
+            if attempt == EMBEDDING_MAX_RETRIES - 1:
+                raise
+            delay = min(2**attempt, 30) + random.random()
+            log.warning("Embedding batch of %s failed (%s), retrying in %.1fs", len(texts), e, delay)
+            time.sleep(delay)
+    raise RuntimeError("unreachable")
+
+
+def get_embeddings(texts: List[str]) -> List[Optional[List[float]]]:
+    """
+    Use the same embedding generator as what was used on the data!!!
+    Embeds the texts that are not cached in batches. Items that could not be embedded are returned as None.
+    """
+    texts = [text[:EMBEDDING_MAX_CHARS] for text in texts]
+    embeddings = embedding_cache.get_many(EMBEDDING_MODEL, texts)
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    CACHE_LOOKUPS.labels("embedding", "hit").inc(len(texts) - len(missing))
+    CACHE_LOOKUPS.labels("embedding", "miss").inc(len(missing))
+    pending = [[missing[j] for j in batch] for batch in batch_texts([texts[i] for i in missing])]
+    while pending:
+        batch = pending.pop(0)
+        try:
+            inputs = [texts[i] for i in batch]
+            batch_embeddings = embed_batch(inputs)
+            embedding_cache.set_many(EMBEDDING_MODEL, inputs, batch_embeddings)
+            for i, embedding in zip(batch, batch_embeddings):
+                embeddings[i] = embedding
+        except openai.OpenAIError as e:
+            if len(batch) > 1 and not isinstance(e, RETRYABLE_ERRORS):
+                # Split the batch to isolate the input that the API rejected
+                middle = len(batch) // 2
+                pending[:0] = [batch[:middle], batch[middle:]]
+            else:
+                log.error("Unable to embed %s chunks: %s", len(batch), e)
+    return embeddings
+
+
+def observe(stage: str, seconds: float, job: IngestJob) -> None:
+    """Record the time spent in a stage of ingesting a document, in the metrics and the job's status"""
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    job.add_time(stage, seconds)
+
+
+@contextmanager
+def timer(stage: str, job: IngestJob) -> Iterator[None]:
+    """Time a stage of ingesting a document"""
+    started = time.perf_counter()
     try:
-        # Get the object from the bucket
-        response = minio_client.get_object(bucket_name, path)
+        yield
+    finally:
+        observe(stage, time.perf_counter() - started, job)
 
-        # Read the response into StringIO
-        file_content = StringIO(response.read().decode("utf-8"))
 
-        # Now, you can use file_content as a file-like object
-        # For example, to read its contents you can do:
-        content = file_content.read()
+def iter_object_lines(bucket_name: str, path: str, size: int, etag: str, job: IngestJob) -> Iterator[str]:
+    """
+    Stream the lines of a text object from S3, decoding incrementally.
+    Large objects are read in ranged requests, all pinned to the ETag of the version we are ingesting.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    fetch_seconds = 0.0
+    try:
+        for offset in range(0, size, S3_RANGE_BYTES):
+            started = time.perf_counter()
+            response = minio_client.get_object(
+                bucket_name,
+                path,
+                offset=offset,
+                length=min(S3_RANGE_BYTES, size - offset),
+                request_headers={"If-Match": etag},
+            )
+            try:
+                for data in response.stream(S3_READ_BYTES):
+                    fetch_seconds += time.perf_counter() - started
+                    pending += decoder.decode(data)
+                    *lines, pending = pending.split("\n")
+                    yield from lines
+                    if len(pending) > S3_MAX_LINE_CHARS:
+                        # Don't buffer a huge line, the chunker splits long blocks anyway
+                        cut = pending.rfind(" ", 0, S3_MAX_LINE_CHARS) + 1 or S3_MAX_LINE_CHARS
+                        yield pending[:cut]
+                        pending = pending[cut:]
+                    started = time.perf_counter()
+            finally:
+                # Give the connection back to the pool
+                response.close()
+                response.release_conn()
+        pending += decoder.decode(b"", final=True)
+        if pending:
+            yield pending
+    finally:
+        observe("s3_fetch", fetch_seconds, job)
 
-        # Remember to close the StringIO object when done
-        file_content.close()
-        return content
-    except S3Error:
-        log.error("Cannot get content from S3")
-        return None
+
+class Superseded(Exception):
+    """A newer ingest request was queued for the same document"""
+
+
+class DocumentMissing(Exception):
+    """The document to ingest is not in the bucket, retrying won't help"""
 
 
-def ingest(request_obj: Dict[str, str]) -> None:
+def check_superseded(redis_client: redis.StrictRedis, request_obj: Dict[str, str]) -> None:
+    """Raise Superseded if a newer request was queued for the document"""
+    latest = redis_client.get(f"{INGEST_LATEST}:{request_obj['path']}")
+    if latest is not None and latest.decode("utf-8") != request_obj["upload_id"]:
+        raise Superseded(f"{request_obj['upload_id']} superseded by {latest.decode('utf-8')}")
+
+
+def lock_path(redis_client: redis.StrictRedis, request_obj: Dict[str, str], heartbeat: "Heartbeat") -> None:
+    """Wait until no other request for the document is in flight, raises Superseded if a newer one is queued"""
+    key = f"{INGEST_LOCKS}:{request_obj['path']}"
+    token = f"{request_obj['upload_id']}:{uuid4()}"  # a redelivered copy of the request is another holder
+    # Extended by the heartbeat, expires when the consumer dies, at the same time as its entry can be reclaimed
+    while not redis_client.set(key, token, nx=True, px=INGEST_CLAIM_IDLE_MS):
+        check_superseded(redis_client, request_obj)
+        # Held by an older request, which stops at its next batch, or by an earlier delivery of this one, until its
+        # consumer is gone
+        time.sleep(1)
+    heartbeat.lock = (key, token)
+
+
+def unlock_path(redis_client: redis.StrictRedis, heartbeat: "Heartbeat") -> None:
+    """Let the next request for the document in"""
+    if heartbeat.lock is not None:
+        key, token = heartbeat.lock
+        heartbeat.lock = None
+        redis_client.eval(RELEASE_LOCK, 1, key, token)
+
+
+def ingest(request_obj: Dict[str, str], job: IngestJob, heartbeat: "Heartbeat") -> None:
     """Ingest a document from MQ"""
     upload_id = request_obj["upload_id"]
     bucket_name = request_obj["bucket_name"]
     path = request_obj["path"]
     log.info("Ingesting %s: %s/%s", upload_id, bucket_name, path)
 
-    content = fetch_content(bucket_name, path)
-    if content:
-        upsert(content, request_obj)
+    redis_client = redis.StrictRedis(connection_pool=redis_pool)
+    check_superseded(redis_client, request_obj)
+    collection = collection_alias.collection()
+    lock_path(redis_client, request_obj, heartbeat)
+    try:
+        if request_obj.get("op") == "delete":
+            delete_document(path, job, collection)
+        else:
+            try:
+                stat = minio_client.stat_object(bucket_name, path)
+            except S3Error as e:
+                if e.code != "NoSuchKey":
+                    raise  # S3 is down or throttling us, retried with backoff
+                raise DocumentMissing(f"{bucket_name}/{path} does not exist") from e
+            upsert(iter_object_lines(bucket_name, path, stat.size, stat.etag, job), request_obj, job, collection)
+    finally:
+        unlock_path(redis_client, heartbeat)
+    job.update(state="done", finished_at=time.time())
+
+
+def delete_document(path: str, job: IngestJob, collection: Any) -> None:
+    """Remove the chunks of a deleted document from the vector store"""
+    job.update(state="writing")
+    existing = collection.get(where={"path": path}, include=[])
+    if existing["ids"]:
+        with timer("upsert", job):
+            collection.delete(ids=existing["ids"])
+        notify_change(collection, path)
+        log.info("Invalidated %s cached answers citing %s", answer_cache.invalidate([path]), path)
+    job.update(chunks_removed=len(existing["ids"]))
+    CHUNKS.labels("removed").inc(len(existing["ids"]))
+    log.info("Deleted %s chunks for %s", len(existing["ids"]), path)
+
+
+def notify_change(collection: Any, path: str) -> None:
+    """Tell the backends' vector replicas of the collection that the vectors of a document changed"""
+    redis_client = redis.StrictRedis(connection_pool=redis_pool)
+    redis_client.eval(NOTIFY_CHANGE, 2, f"{collection.name}:version", f"{collection.name}:changes", path)
+
+
+def content_hash(text: str) -> str:
+    """Fingerprint of a chunk, stored in its metadata to detect unchanged chunks on re-ingest"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
 
+class Stopwatch:
+    """An iterable that measures the time spent waiting for its items"""
 
-def upsert(content: str, context: Dict[str, str]) -> None:
-    """Upsert embeddings for document chunks in db"""
+    def __init__(self, iterable: Iterable[str]) -> None:
+        """Initialize the stopwatch."""
+        self.iterator = iter(iterable)
+        self.seconds = 0.0
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterate, adding up the time spent in next()"""
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(self.iterator)
+            except StopIteration:
+                return
+            finally:
+                self.seconds += time.perf_counter() - started
+            yield item
+
+
+def timed(iterable: Iterable[str], stage: str, job: IngestJob, inner: Optional[Stopwatch] = None) -> Iterator[str]:
+    """
+    Iterate, observing the time spent waiting for the items.
+    The time spent waiting for the items of an inner stage that the iterable pulls from is not counted.
+    """
+    stopwatch = Stopwatch(iterable)
+    try:
+        yield from stopwatch
+    finally:
+        observe(stage, stopwatch.seconds - (inner.seconds if inner is not None else 0.0), job)
+
+
+class IngestPipeline:
+    """
+    Embedding and writing stages for the new chunks of a document, connected by bounded queues.
+    The caller feeds batches of chunks while it reads and chunks the document, embedding workers embed the batches,
+    and a writer adds them to the collection in size-bounded batches, so that the network waits of every stage
+    overlap. Full queues make the earlier stages wait, so memory stays bounded.
+    """
+
+    def __init__(self, context: Dict[str, str], job: IngestJob, collection: Any) -> None:
+        """Start the stages."""
+        self.context = context
+        self.job = job
+        self.collection = collection
+        self.embed_queue: "queue.Queue[Optional[List[Tuple[str, int, str]]]]" = queue.Queue(PIPELINE_QUEUE_SIZE)
+        self.write_queue: "queue.Queue[Optional[List[Tuple[str, Dict[str, Any], List[float]]]]]" = queue.Queue(
+            PIPELINE_QUEUE_SIZE
+        )
+        self.abort = threading.Event()
+        self.errors: List[BaseException] = []
+        self.written = 0
+        self._lock = threading.Lock()
+        self.threads = [
+            threading.Thread(target=self._run, args=(self._embed,), name=f"{threading.current_thread().name}-embed")
+            for _ in range(PIPELINE_EMBED_WORKERS)
+        ]
+        self.threads.append(
+            threading.Thread(target=self._run, args=(self._write,), name=f"{threading.current_thread().name}-write")
+        )
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, batch: List[Tuple[str, int, str]]) -> None:
+        """Queue a batch of (content hash, index, text) chunks to embed, waiting while the stages are busy"""
+        if not self._put(self.embed_queue, batch):
+            self.close()
+
+    def close(self) -> int:
+        """Wait for the queued batches to be written, returns how many chunks were written"""
+        for _ in range(PIPELINE_EMBED_WORKERS):
+            self._put(self.embed_queue, None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+        return self.written
+
+    def _put(self, q: "queue.Queue[Any]", item: Any) -> bool:
+        """Put an item on a queue unless the pipeline was aborted"""
+        while not self.abort.is_set():
+            try:
+                q.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q: "queue.Queue[Any]") -> Any:
+        """Get an item from a queue, None once the pipeline was aborted"""
+        while not self.abort.is_set():
+            try:
+                return q.get(timeout=1)
+            except queue.Empty:
+                continue
+        return None
+
+    def _run(self, stage: Callable[[], None]) -> None:
+        """Run a stage, aborting the whole pipeline if it fails"""
+        try:
+            stage()
+        except BaseException as e:  # pylint: disable=broad-except
+            self.errors.append(e)
+            self.abort.set()
+
+    def _embed(self) -> None:
+        """Embedding stage"""
+        try:
+            while (batch := self._get(self.embed_queue)) is not None:
+                with timer("embed", self.job):
+                    embeddings = get_embeddings([chunk for _, _, chunk in batch])
+                rows = []
+                for (chunk_hash, i, chunk), embedding in zip(batch, embeddings):
+                    if embedding is None:
+                        continue
+                    metadata = {**self.context, "text": chunk, "content_hash": chunk_hash, "chunk_index": i}
+                    rows.append((chunk_hash, metadata, embedding))
+                self._put(self.write_queue, rows)
+        finally:
+            self._put(self.write_queue, None)
+
+    def _write(self) -> None:
+        """Writing stage"""
+        folder = self.context["folder"]
+        filename = self.context["filename"]
+        rows: List[Tuple[str, Dict[str, Any], List[float]]] = []
+        running = PIPELINE_EMBED_WORKERS
+        while running:
+            batch = self._get(self.write_queue)
+            if self.abort.is_set():
+                return
+            if batch is None:
+                running -= 1
+                if not running and rows:
+                    self.job.update(state="writing")  # everything is embedded
+            else:
+                rows.extend(batch)
+            while rows and (len(rows) >= CHROMA_WRITE_BATCH_SIZE or not running):
+                write, rows = rows[:CHROMA_WRITE_BATCH_SIZE], rows[CHROMA_WRITE_BATCH_SIZE:]
+                with timer("upsert", self.job):
+                    self.collection.add(
+                        ids=[f"{folder}/{filename}/{chunk_hash}" for chunk_hash, _, _ in write],
+                        metadatas=[metadata for _, metadata, _ in write],
+                        embeddings=[embedding for _, _, embedding in write],
+                    )
+                with self._lock:
+                    self.written += len(write)
+                self.job.add(chunks_written=len(write))
+
+
+def upsert(lines: Iterable[str], context: Dict[str, str], job: IngestJob, collection: Any) -> None:
+    """
+    Upsert embeddings for document chunks in db, only embedding new or changed chunks.
+    The document is chunked, embedded and written in pipelined batches as it is read, so memory doesn't grow
+    with its size.
+    """
     path = context["path"]
     filename = context["filename"]
     folder = context["folder"]
 
-    # Delete existing for this doc
-    chroma_collection.delete(where={"path": path})
-
-    # Dummy chunking
-    chunks = [chunk for chunk in content.split("\n\n") if chunk.strip()]
-    log.info("Upserting %s chunks for %s/%s", len(chunks), folder, filename)
-    embeddings = []
-    metadatas = []
-    ids = []
-    for i, chunk in enumerate(chunks):
-        chunk_id = f"{folder}/{filename}/{i}"
-        log.info(chunk_id)
-        embedding = get_embedding(chunk)
-        embeddings.append(embedding)
-        request_obj["text"] = chunk
-        metadatas.append(request_obj)
-        ids.append(chunk_id)
-    chroma_collection.add(embeddings=embeddings, metadatas=metadatas, ids=ids)
-    log.info("Done.")
+    # What is stored for this doc, by content hash
+    existing = collection.get(where={"path": path}, include=["metadatas"])
+    stored: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+    stale_ids = []
+    for chunk_id, metadata in zip(existing["ids"], existing["metadatas"]):
+        chunk_hash = metadata.get("content_hash")
+        if chunk_hash is None or chunk_hash in stored:
+            stale_ids.append(chunk_id)
+        else:
+            stored[chunk_hash] = (chunk_id, metadata)
 
+    seen: Set[str] = set()
+    moved_ids = []
+    moved_metadatas = []
+    batch: List[Tuple[str, int, str]] = []
+    batch_tokens = 0
+    new_chunks = 0
+    read = 0
+    last_progress = time.monotonic()
+    redis_client = redis.StrictRedis(connection_pool=redis_pool)
+    pipeline = IngestPipeline(context, job, collection)
 
-if __name__ == "__main__":
-    log.info("Starting queue...")
-    while True:
+    def embed(batch: List[Tuple[str, int, str]]) -> None:
+        """Hand a batch of new chunks to the pipeline"""
+        # Stop before spending embeddings on a version that is already outdated
+        check_superseded(redis_client, context)
+        job.update(state="embedding", chunks_read=read, chunks_new=new_chunks)
+        pipeline.put(batch)
+
+    try:
+        # The chunker pulls the lines from S3, whose time is observed as s3_fetch
+        fetched = Stopwatch(lines)
+        for i, chunk in enumerate(timed(chunker.chunks(fetched), "chunk", job, inner=fetched)):
+            read = i + 1
+            if time.monotonic() - last_progress >= JOB_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                job.update(chunks_read=read, chunks_new=new_chunks)
+            # Fingerprint the chunk, a chunk repeated within the doc is stored once
+            chunk_hash = content_hash(chunk)
+            if chunk_hash in seen:
+                continue
+            seen.add(chunk_hash)
+            if chunk_hash in stored:
+                chunk_id, metadata = stored[chunk_hash]
+                if metadata.get("chunk_index") != i:
+                    # Unchanged chunk at a new position, no need to embed it again
+                    moved_ids.append(chunk_id)
+                    moved_metadatas.append({**metadata, "chunk_index": i})
+                continue
+            tokens = estimate_tokens(chunk)
+            if batch and (len(batch) >= EMBEDDING_BATCH_SIZE or batch_tokens + tokens > EMBEDDING_BATCH_TOKENS):
+                embed(batch)
+                batch, batch_tokens = [], 0
+            batch.append((chunk_hash, i, chunk))
+            batch_tokens += tokens
+            new_chunks += 1
+        if batch:
+            embed(batch)
+        job.update(chunks_read=read, chunks_new=new_chunks)
+    except BaseException:
+        pipeline.abort.set()
+        raise
+    finally:
+        written = pipeline.close()
+    stale_ids.extend(chunk_id for chunk_hash, (chunk_id, _) in stored.items() if chunk_hash not in seen)
+    unchanged = len(seen) - new_chunks
+    log.info(
+        "Upserted %s chunks for %s/%s: %s new or changed, %s unchanged, %s removed",
+        len(seen),
+        folder,
+        filename,
+        new_chunks,
+        unchanged,
+        len(stale_ids),
+    )
+
+    job.update(chunks_unchanged=unchanged, chunks_removed=len(stale_ids))
+
+    # Deleted last so that the doc never disappears from search
+    with timer("upsert", job):
+        if moved_ids:
+            collection.update(ids=moved_ids, metadatas=moved_metadatas)
+        if stale_ids:
+            collection.delete(ids=stale_ids)
+    CHUNKS.labels("embedded").inc(written)
+    CHUNKS.labels("unchanged").inc(unchanged)
+    CHUNKS.labels("removed").inc(len(stale_ids))
+    if written or moved_ids or stale_ids:
+        notify_change(collection, path)
+        log.info("Invalidated %s cached answers citing %s", answer_cache.invalidate([path]), path)
+    if written < new_chunks:
+        # Fail the message so that it is retried
+        raise RuntimeError(f"{new_chunks - written} chunks for {folder}/{filename} could not be embedded")
+    log.info("Done. Embedding cache: %s", embedding_cache.stats())
+
+
+def retry_backoff_ms(deliveries: int) -> int:
+    """How long a failed entry waits before it is retried"""
+    backoff_ms: int = INGEST_RETRY_BASE_MS << (deliveries - 1)  # doubles on every delivery
+    return min(backoff_ms, INGEST_RETRY_MAX_MS)
+
+
+def reclaim(redis_client: redis.StrictRedis, consumer: str) -> Optional[Tuple[bytes, bytes, Dict[bytes, bytes], int]]:
+    """Claim a pending entry that failed and is due for a retry, or whose consumer died"""
+    for stream in ingest_queue.streams():
+        pending = redis_client.xpending_range(
+            stream, INGEST_GROUP, min="-", max="+", count=10, idle=min(INGEST_RETRY_BASE_MS, INGEST_CLAIM_IDLE_MS)
+        )
+        if not pending:
+            continue
+        failed = redis_client.hmget(INGEST_ERRORS, [error_key(stream, entry["message_id"]) for entry in pending])
+        for entry, error in zip(pending, failed):
+            deliveries = entry["times_delivered"]
+            due_ms = retry_backoff_ms(deliveries) if error else INGEST_CLAIM_IDLE_MS
+            if entry["time_since_delivered"] < due_ms:
+                continue
+            # min_idle_time makes sure that only one consumer gets it
+            claimed = redis_client.xclaim(stream, INGEST_GROUP, consumer, due_ms, [entry["message_id"]])
+            if claimed and claimed[0][1]:
+                msg_id, fields = claimed[0]
+                return stream, msg_id, fields, deliveries + 1
+    return None
+
+
+class Heartbeat:
+    """
+    Claims an entry for its consumer again every INGEST_HEARTBEAT_MS while it is processed, so that it is never idle
+    for INGEST_CLAIM_IDLE_MS and isn't reclaimed as lost, however long the document takes. It extends the lock on the
+    document too, once the entry holds it.
+    """
+
+    def __init__(self, redis_client: redis.StrictRedis, stream: bytes, msg_id: bytes, consumer: str) -> None:
+        """Initialize the heartbeat, use it as a context manager around the processing of the entry."""
+        self.redis_client = redis_client
+        self.stream = stream
+        self.msg_id = msg_id
+        self.consumer = consumer
+        self.lock: Optional[Tuple[str, str]] = None  # key and token of the document's lock, see lock_path
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"{threading.current_thread().name}-heartbeat")
+
+    def __enter__(self) -> "Heartbeat":
+        """Start beating"""
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        """Stop beating"""
+        self._stopped.set()
+        self._thread.join()
+
+    def beat(self) -> None:
+        """Reset the idle time of the entry without counting a delivery, and extend the lock on the document"""
+        self.redis_client.xclaim(self.stream, INGEST_GROUP, self.consumer, 0, [self.msg_id], justid=True)
+        lock = self.lock
+        if lock is not None and not self.redis_client.eval(REFRESH_LOCK, 1, *lock, INGEST_CLAIM_IDLE_MS):
+            log.warning("Lock %s of %s expired", lock[0], self.msg_id)
+
+    def _run(self) -> None:
+        """Beat until stopped"""
+        while not self._stopped.wait(INGEST_HEARTBEAT_MS / 1000):
+            try:
+                self.beat()
+            except redis.exceptions.RedisError as e:
+                log.warning("Heartbeat of %s failed: %s", self.msg_id, e)
+
+
+def error_key(stream: bytes, msg_id: bytes) -> bytes:
+    """Field of an entry in the INGEST_ERRORS hash, entry ids are only unique within a stream"""
+    return stream + b"/" + msg_id
+
+
+def ack(redis_client: redis.StrictRedis, stream: bytes, msg_id: bytes) -> None:
+    """Acknowledge and drop a processed entry"""
+    pipe = redis_client.pipeline()
+    pipe.xack(stream, INGEST_GROUP, msg_id)
+    pipe.xdel(stream, msg_id)
+    pipe.hdel(INGEST_ERRORS, error_key(stream, msg_id))
+    pipe.execute()
+
+
+def job_of(redis_client: redis.StrictRedis, fields: Dict[bytes, bytes]) -> Optional[IngestJob]:
+    """Status record of the job of an entry, None if the entry is malformed"""
+    try:
+        return IngestJob(redis_client, json.loads(fields[b"data"].decode("utf-8"))["upload_id"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def fail(
+    redis_client: redis.StrictRedis,
+    stream: bytes,
+    msg_id: bytes,
+    fields: Dict[bytes, bytes],
+    deliveries: int,
+    error: str,
+) -> None:
+    """Leave a failed entry pending for a retry, or move it to the dead letter stream"""
+    job = job_of(redis_client, fields)
+    if deliveries < INGEST_MAX_DELIVERIES:
+        DOCUMENTS.labels("failed").inc()
+        log.warning("Ingest of %s failed (attempt %s), retrying later", msg_id, deliveries)
+        redis_client.hset(INGEST_ERRORS, error_key(stream, msg_id), error)
+        if job is not None:
+            job.update(state="queued", error=error)
+        return
+    DOCUMENTS.labels("dead_lettered").inc()
+    if job is not None:
+        job.update(state="failed", error=error, finished_at=time.time())
+    log.error("Ingest of %s failed %s times, moving it to %s", msg_id, deliveries, INGEST_DEAD_LETTER_STREAM)
+    dead_letter: Dict[str, Union[bytes, str, int]] = {
+        **{field.decode("utf-8"): value for field, value in fields.items()},
+        "stream": stream,
+        "id": msg_id,
+        "deliveries": deliveries,
+        "error": error,
+    }
+    redis_client.xadd(INGEST_DEAD_LETTER_STREAM, dead_letter)
+    ack(redis_client, stream, msg_id)
+
+
+def consume(redis_client: redis.StrictRedis, consumer: str) -> None:
+    """Process ingest messages until shutdown, finishing the current one first"""
+    last_reclaim = 0.0
+    while not shutdown.is_set():
         try:
-            # Wait for predict request on request topic
-            log.info("Waiting for request message...")
             try:
-                redis_client = redis.StrictRedis(connection_pool=redis_pool, decode_responses=True)
-                _, msg = redis_client.brpop("ingest")
+                message = None
+                if time.monotonic() - last_reclaim > INGEST_RECLAIM_INTERVAL:
+                    last_reclaim = time.monotonic()
+                    message = reclaim(redis_client, consumer)
+                if message is None:
+                    entry = ingest_queue.dequeue(consumer)
+                    if entry is None:
+                        # Wait for an ingest request to be queued
+                        ingest_queue.wait(QUEUE_POLL_TIMEOUT)
+                        continue
+                    message = (*entry, 1)
             except redis.exceptions.RedisError as e:
-                raise SystemExit(f"Unable to read from ingest queue: {e}")
-            request_obj = json.loads(msg.decode("utf-8"))
+                log.error("Unable to read from ingest queue: %s", e)
+                shutdown.set()
+                break
+            stream, msg_id, fields, deliveries = message
+            if deliveries > INGEST_MAX_DELIVERIES:
+                # The consumers holding it kept dying
+                fail(redis_client, stream, msg_id, fields, deliveries, "Consumer died while ingesting")
+                continue
+            # Keeps the entry ours while we ingest it
+            heartbeat = Heartbeat(redis_client, stream, msg_id, consumer)
 
             # request_obj example:
             # {
             #     "upload_id": upload_id,
             #     "folder": folder,
             #     "filename": filename,
+            #     "bucket_name": bucket_name,
+            #     "path": path,
+            #     "lane": lane,
+            #     "op": "ingest" or "delete",
             # }
+            try:
+                with IN_FLIGHT.track_inprogress(), INGEST_SECONDS.time(), heartbeat:
+                    request_obj = json.loads(fields[b"data"].decode("utf-8"))
+                    job = IngestJob(redis_client, request_obj["upload_id"])
+                    # Counts start over on a retry, stage times add up over the attempts
+                    job.update(
+                        state="fetching",
+                        attempt=deliveries,
+                        started_at=time.time(),
+                        chunks_read=0,
+                        chunks_new=0,
+                        chunks_written=0,
+                    )
+                    ingest(request_obj, job, heartbeat)
+            except Superseded as e:
+                # The newer request ingests the document, reusing what this one already embedded
+                log.info("Skipping %s: %s", msg_id, e)
+                job.update(state="superseded", finished_at=time.time())
+                ack(redis_client, stream, msg_id)
+                DOCUMENTS.labels("superseded").inc()
+                continue
+            except DocumentMissing as e:
+                log.error("Cannot get content from S3: %s", e)
+                job.update(state="failed", error="Cannot get content from S3", finished_at=time.time())
+                ack(redis_client, stream, msg_id)
+                DOCUMENTS.labels("missing").inc()
+                continue
+            except Exception as e:  # pylint: disable=broad-except
+                traceback.print_exc()
+                fail(redis_client, stream, msg_id, fields, deliveries, repr(e))
+                continue
+            ack(redis_client, stream, msg_id)
+            DOCUMENTS.labels("ingested").inc()
+
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc()
+
+
+def upload_of(record: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    """(folder, filename) of the document a bucket event record created, None for other events"""
+    if not record.get("eventName", "").startswith("s3:ObjectCreated:"):
+        return None
+    if record["s3"]["bucket"]["name"] != S3_BUCKET_NAME:
+        return None
+    # Keys are URL encoded in the events
+    parts = urllib.parse.unquote_plus(record["s3"]["object"]["key"]).strip("/").split("/")
+    if len(parts) != 3 or parts[0] != "uploads" or not parts[2].endswith((".txt", ".md")):
+        return None
+    return parts[1], parts[2]
 
-            # We need an id so that our response message can include
-            # the identifier. We extract it before the validation,
-            # in order to send the error message in case the validation fails.
-            _id = request_obj.get("id", str(uuid4()))
 
-            # Ingest
-            ingest(request_obj)
+def queue_upload(redis_client: redis.StrictRedis, folder: str, filename: str) -> None:
+    """Queue an ingest of an uploaded document, as POST /ingest/<folder>/<filename> does"""
+    upload_id = str(uuid4())
+    request_obj = {
+        "upload_id": upload_id,
+        "folder": folder,
+        "filename": filename,
+        "bucket_name": S3_BUCKET_NAME,
+        "path": f"/uploads/{folder}/{filename}",
+        "lane": INGEST_BUCKET_EVENTS_LANE,
+        "op": "ingest",
+    }
+    pipe = redis_client.pipeline()
+    IngestJob(redis_client, upload_id).update(
+        pipe,
+        state="queued",
+        lane=INGEST_BUCKET_EVENTS_LANE,
+        folder=folder,
+        filename=filename,
+        path=request_obj["path"],
+        queued_at=time.time(),
+    )
+    pipe.set(f"{INGEST_LATEST}:{request_obj['path']}", upload_id, ex=7 * 24 * 3600)
+    ingest_queue.enqueue(INGEST_BUCKET_EVENTS_LANE, folder, json.dumps(request_obj), pipe)
+    pipe.execute()
+    log.info("Queued %s for %s", upload_id, request_obj["path"])
 
+
+def watch_bucket_events(redis_client: redis.StrictRedis) -> None:
+    """Queue an ingest for the documents MinIO notifies us of, INGEST_DEBOUNCE_MS after their last event"""
+    while not shutdown.is_set():
+        try:
+            popped = redis_client.blpop([INGEST_BUCKET_EVENTS_KEY], timeout=1)
+            if popped is not None:
+                # One access format entry: [{"Event": [records], "EventTime": ...}]
+                for entry in json.loads(popped[1]):
+                    for record in entry["Event"]:
+                        upload = upload_of(record)
+                        if upload is not None:
+                            due = time.time() + INGEST_DEBOUNCE_MS / 1000
+                            redis_client.zadd(INGEST_DEBOUNCE, {json.dumps(upload): due})
+            for member in redis_client.zrangebyscore(INGEST_DEBOUNCE, "-inf", time.time(), start=0, num=100):
+                # Removing it first makes sure that only one worker queues it
+                if redis_client.zrem(INGEST_DEBOUNCE, member):
+                    queue_upload(redis_client, *json.loads(member))
         except Exception:  # pylint: disable=broad-except
-            traceback.print_exc()
+            log.exception("Unable to process bucket events")
+            time.sleep(1)
+
+
+def stop(signum: int, _frame: Optional[FrameType]) -> None:
+    """Stop taking new messages and let the consumers drain"""
+    log.info("Received signal %s, draining...", signum)
+    shutdown.set()
+
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    log.info("Starting queue with %s consumers...", WORKER_CONCURRENCY)
+    redis_client = redis.StrictRedis(connection_pool=redis_pool)
+
+    # Queue depth is read from Redis when the metrics are scraped
+    queue_depth = Gauge("ingest_queue_depth", "Ingest requests waiting or in flight (all consumers)")
+    queue_depth.set_function(ingest_queue.depth)
+    dead_letters = Gauge("ingest_dead_letters", "Ingest requests in the dead letter stream")
+    dead_letters.set_function(lambda: redis_client.xlen(INGEST_DEAD_LETTER_STREAM))
+    start_http_server(METRICS_PORT)
+    consumer_prefix = f"{socket.gethostname()}-{os.getpid()}"
+    consumers = [
+        threading.Thread(target=consume, args=(redis_client, f"{consumer_prefix}-{i}"), name=f"consumer-{i}")
+        for i in range(WORKER_CONCURRENCY)
+    ]
+    if INGEST_BUCKET_EVENTS:
+        consumers.append(threading.Thread(target=watch_bucket_events, args=(redis_client,), name="bucket-events"))
+    for consumer in consumers:
+        consumer.start()
+    # Join with a timeout so that the main thread keeps handling signals
+    while any(consumer.is_alive() for consumer in consumers):
+        for consumer in consumers:
+            consumer.join(timeout=1)
+    log.info("Drained, exiting.")
@@ -0,0 +1,91 @@
+"""
+    Semantic answer cache for the chat endpoint.
+    Answers are bucketed by the chunks that were retrieved for the question, and a new question gets a cached
+    answer when the same chunks were retrieved for it and its embedding is close enough to a cached question's.
+    Each answer expires ttl seconds after it was cached, and the ingest workers invalidate the answers that cited a
+    document when it is re-ingested.
+"""
+import base64
+import hashlib
+import json
+import time
+from typing import Iterable, List, Optional, Sequence
+
+import numpy as np
+import redis  # type: ignore
+
+
+class AnswerCache:
+    """A cache of answers in Redis, keyed on the retrieved chunks and the question embedding."""
+
+    def __init__(
+        self,
+        redis_client: redis.StrictRedis,
+        similarity: float,
+        ttl: int,
+        max_answers_per_bucket: int = 20,
+        prefix: str = "answer",
+    ) -> None:
+        """Initialize the cache."""
+        self.redis_client = redis_client
+        self.similarity = similarity  # minimum cosine similarity between the questions
+        self.ttl = ttl  # seconds
+        self.max_answers_per_bucket = max_answers_per_bucket
+        self.prefix = prefix
+
+    def bucket_key(self, chunk_ids: Iterable[str]) -> str:
+        """Key of the answers for questions that retrieved these chunks"""
+        digest = hashlib.sha256("\n".join(sorted(chunk_ids)).encode("utf-8")).hexdigest()
+        return f"{self.prefix}:{digest}"
+
+    def path_key(self, path: str) -> str:
+        """Key of the buckets with answers that cited the document"""
+        return f"{self.prefix}:path:{path}"
+
+    def get(self, embedding: Sequence[float], chunk_ids: Sequence[str]) -> Optional[str]:
+        """The cached answer of the most similar question that retrieved the same chunks, or None"""
+        if self.ttl <= 0:
+            return None
+        entries = self.redis_client.lrange(self.bucket_key(chunk_ids), 0, -1)
+        if not entries:
+            return None
+        question = np.asarray(embedding, dtype=np.float32)
+        question /= np.linalg.norm(question)
+        best_similarity, best_answer = self.similarity, None
+        now = time.time()
+        for entry in map(json.loads, entries):
+            if entry.get("expires_at", 0) <= now:
+                continue  # The bucket lives as long as answers are added to it, its answers don't
+            cached = np.frombuffer(base64.b64decode(entry["embedding"]), dtype=np.float32)
+            similarity = float(np.dot(question, cached) / np.linalg.norm(cached))
+            if similarity >= best_similarity:
+                best_similarity, best_answer = similarity, entry["answer"]
+        return best_answer
+
+    def set(self, embedding: Sequence[float], chunk_ids: Sequence[str], paths: Iterable[str], answer: str) -> None:
+        """Cache the answer to the question, and remember which documents it cited"""
+        if self.ttl <= 0:
+            return
+        bucket_key = self.bucket_key(chunk_ids)
+        entry = {
+            "embedding": base64.b64encode(np.asarray(embedding, dtype=np.float32).tobytes()).decode("ascii"),
+            "answer": answer,
+            "expires_at": time.time() + self.ttl,
+        }
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.rpush(bucket_key, json.dumps(entry))
+        pipe.ltrim(bucket_key, -self.max_answers_per_bucket, -1)
+        pipe.expire(bucket_key, self.ttl)
+        for path in set(paths):
+            pipe.sadd(self.path_key(path), bucket_key)
+            pipe.expire(self.path_key(path), self.ttl)
+        pipe.execute()
+
+    def invalidate(self, paths: Iterable[str]) -> int:
+        """Drop the answers that cited any of the documents, returns the number of buckets dropped"""
+        path_keys: List[str] = [self.path_key(path) for path in paths]
+        if not path_keys:
+            return 0
+        bucket_keys = self.redis_client.sunion(path_keys)
+        self.redis_client.delete(*bucket_keys, *path_keys)
+        return len(bucket_keys)
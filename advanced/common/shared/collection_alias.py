@@ -0,0 +1,54 @@
+"""
+    Aliases of Chroma collections, shared by the backend and the ingest workers.
+    The services open their collection through an alias (e.g. "blogs") that points at the collection serving it, so
+    that a rebuilt collection is swapped in at once by pointing the alias at it (SET chroma:alias:blogs <collection>).
+    Until the alias is set, it is the name of the collection itself.
+"""
+import threading
+import time
+from typing import Any, Optional
+
+import redis  # type: ignore
+
+
+class CollectionAlias:
+    """A Chroma collection looked up through an alias in Redis, at most every refresh_interval seconds."""
+
+    def __init__(
+        self,
+        redis_client: redis.StrictRedis,
+        chroma_client: Any,
+        alias: str,
+        refresh_interval: float = 5.0,
+        prefix: str = "chroma:alias",
+    ) -> None:
+        """Initialize the alias."""
+        self.redis_client = redis_client
+        self.chroma_client = chroma_client
+        self.alias = alias
+        self.refresh_interval = refresh_interval
+        self.key = f"{prefix}:{alias}"
+        self._lock = threading.Lock()
+        self._collection: Optional[Any] = None
+        self._checked_at = 0.0
+
+    def target(self) -> str:
+        """Name of the collection the alias points at"""
+        target = self.redis_client.get(self.key)
+        return target.decode("utf-8") if target else self.alias
+
+    def collection(self) -> Any:
+        """The collection the alias points at, created if it doesn't exist"""
+        with self._lock:
+            if self._collection is not None and time.monotonic() - self._checked_at < self.refresh_interval:
+                return self._collection
+            try:
+                target = self.target()
+            except redis.exceptions.RedisError:
+                if self._collection is None:
+                    raise
+                return self._collection  # Keep the one we have until Redis is back
+            if self._collection is None or self._collection.name != target:
+                self._collection = self.chroma_client.get_or_create_collection(target)
+            self._checked_at = time.monotonic()
+            return self._collection
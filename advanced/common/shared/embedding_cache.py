@@ -0,0 +1,97 @@
+"""
+    Embedding cache shared by the backend and the ingest workers.
+    Embeddings are stored in Redis as float32 bytes, keyed by model and the sha256 of the normalized text
+    (see embedding_codec), and the least recently used ones are evicted once the cache grows over its size limit.
+"""
+import threading
+import time
+from typing import Dict, List, Optional, Sequence
+
+import redis  # type: ignore
+from embedding_codec import decode, encode, text_digest
+
+
+class EmbeddingCache:
+    """An LRU cache of embeddings in Redis."""
+
+    def __init__(self, redis_client: redis.StrictRedis, max_bytes: int, prefix: str = "embedding") -> None:
+        """Initialize the cache."""
+        self.redis_client = redis_client
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.lru_key = f"{prefix}:lru"  # cache keys scored by last use
+        self.bytes_key = f"{prefix}:bytes"  # total size of the cached embeddings
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, model: str, text: str) -> str:
+        """Cache key for the text embedded with the model"""
+        return f"{self.prefix}:{model}:{text_digest(text)}"
+
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """Cached embeddings for the texts, None for the ones that are not cached"""
+        if not texts:
+            return []
+        keys = [self.key(model, text) for text in texts]
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.mget(keys)
+        # Only touches the keys that are cached
+        pipe.zadd(self.lru_key, {key: time.time() for key in keys}, xx=True)
+        values, _ = pipe.execute()
+        embeddings = [decode(value) if value is not None else None for value in values]
+        hits = sum(1 for embedding in embeddings if embedding is not None)
+        with self._lock:
+            self.hits += hits
+            self.misses += len(embeddings) - hits
+        return embeddings
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        """Cached embedding for the text, or None"""
+        return self.get_many(model, [text])[0]
+
+    def set_many(self, model: str, texts: Sequence[str], embeddings: Sequence[Sequence[float]]) -> None:
+        """Cache the embeddings of the texts"""
+        entries: Dict[str, bytes] = {self.key(model, text): encode(e) for text, e in zip(texts, embeddings)}
+        if not entries:
+            return
+        pipe = self.redis_client.pipeline(transaction=False)
+        for key, value in entries.items():
+            pipe.set(key, value, nx=True)
+        pipe.zadd(self.lru_key, {key: time.time() for key in entries})
+        created = pipe.execute()[: len(entries)]
+        added_bytes = sum(len(value) for value, is_new in zip(entries.values(), created) if is_new)
+        if added_bytes and self.redis_client.incrby(self.bytes_key, added_bytes) > self.max_bytes:
+            self.evict()
+
+    def set(self, model: str, text: str, embedding: Sequence[float]) -> None:
+        """Cache the embedding of the text"""
+        self.set_many(model, [text], [embedding])
+
+    def evict(self) -> None:
+        """Drop least recently used embeddings until the cache is under 90% of its size limit"""
+        target = int(self.max_bytes * 0.9)
+        while int(self.redis_client.get(self.bytes_key) or 0) > target:
+            keys = self.redis_client.zrange(self.lru_key, 0, 99)
+            if not keys:
+                self.redis_client.set(self.bytes_key, 0)
+                return
+            pipe = self.redis_client.pipeline(transaction=False)
+            for key in keys:
+                pipe.strlen(key)
+            sizes = pipe.execute()
+            pipe.delete(*keys)
+            pipe.zrem(self.lru_key, *keys)
+            pipe.decrby(self.bytes_key, sum(sizes))
+            pipe.execute()
+
+    def stats(self) -> Dict[str, float]:
+        """Hits and misses of this process, and the size of the shared cache"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": self.redis_client.zcard(self.lru_key),
+            "bytes": int(self.redis_client.get(self.bytes_key) or 0),
+        }
@@ -0,0 +1,29 @@
+"""
+    How embedding caches key and store embeddings, shared by the Redis cache of the services and the SQLite cache of
+    the poc: by the sha256 of the normalized text, as float32 bytes.
+"""
+import hashlib
+from array import array
+from typing import List, Sequence
+
+
+def normalize(text: str) -> str:
+    """Collapse whitespace so that trivially different texts share a cache entry"""
+    return " ".join(text.split())
+
+
+def text_digest(text: str) -> str:
+    """Fingerprint of the normalized text"""
+    return hashlib.sha256(normalize(text).encode("utf-8")).hexdigest()
+
+
+def encode(embedding: Sequence[float]) -> bytes:
+    """Compact float32 representation of an embedding"""
+    return array("f", embedding).tobytes()
+
+
+def decode(data: bytes) -> List[float]:
+    """Embedding from its float32 representation"""
+    vector = array("f")
+    vector.frombytes(data)
+    return vector.tolist()
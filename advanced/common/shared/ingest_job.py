@@ -0,0 +1,74 @@
+"""
+    Status of ingest jobs, shared by the backend and the ingest workers.
+    The backend records a job as queued when it enqueues it, the workers record its state, chunk counts and the
+    time spent in each stage as they process it, and GET /ingest/<upload_id> returns the record.
+"""
+import time
+from typing import Any, Dict, Optional
+
+import redis  # type: ignore
+
+STATES = ("queued", "fetching", "embedding", "writing", "done", "failed", "superseded")
+COUNTS = ("attempt", "chunks_read", "chunks_new", "chunks_written", "chunks_unchanged", "chunks_removed")
+TIMESTAMPS = ("queued_at", "started_at", "updated_at", "finished_at")
+STAGE_PREFIX = "seconds:"  # time spent in each stage, summed over the stage's threads
+
+
+class IngestJob:
+    """The status record of an ingest job, a Redis hash that expires ttl seconds after its last update."""
+
+    def __init__(
+        self, redis_client: redis.StrictRedis, upload_id: str, ttl: int = 7 * 24 * 3600, prefix: str = "ingest:job"
+    ) -> None:
+        """Initialize the record."""
+        self.redis_client = redis_client
+        self.upload_id = upload_id
+        self.ttl = ttl
+        self.key = f"{prefix}:{upload_id}"
+
+    def update(self, pipe: Optional[Any] = None, **fields: Any) -> None:
+        """Set fields of the record, in the given pipeline if any"""
+        if "state" in fields and fields["state"] not in STATES:
+            raise ValueError(f"Unknown ingest job state {fields['state']}")
+        client = pipe if pipe is not None else self.redis_client.pipeline(transaction=False)
+        client.hset(self.key, mapping={**fields, "updated_at": time.time()})
+        client.expire(self.key, self.ttl)
+        if pipe is None:
+            client.execute()
+
+    def add(self, **counts: int) -> None:
+        """Increment chunk counts of the record"""
+        pipe = self.redis_client.pipeline(transaction=False)
+        for field, count in counts.items():
+            pipe.hincrby(self.key, field, count)
+        pipe.expire(self.key, self.ttl)
+        pipe.execute()
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        """Add to the time spent in a stage"""
+        self.redis_client.hincrbyfloat(self.key, f"{STAGE_PREFIX}{stage}", seconds)
+
+    def get(self) -> Optional[Dict[str, Any]]:
+        """The record, with its progress (written / new chunks so far), or None if it doesn't exist or expired"""
+        raw = self.redis_client.hgetall(self.key)
+        if not raw:
+            return None
+        job: Dict[str, Any] = {"upload_id": self.upload_id, "stages": {}}
+        for field, value in raw.items():
+            field = field.decode("utf-8") if isinstance(field, bytes) else field
+            value = value.decode("utf-8") if isinstance(value, bytes) else value
+            if field.startswith(STAGE_PREFIX):
+                job["stages"][field[len(STAGE_PREFIX) :]] = round(float(value), 3)
+            elif field in COUNTS:
+                job[field] = int(value)
+            elif field in TIMESTAMPS:
+                job[field] = float(value)
+            else:
+                job[field] = value
+        if job.get("state") == "done":
+            job["progress"] = 1.0
+        elif job.get("chunks_new"):
+            job["progress"] = round(min(job.get("chunks_written", 0) / job["chunks_new"], 1.0), 3)
+        else:
+            job["progress"] = 0.0
+        return job
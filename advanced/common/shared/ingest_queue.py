@@ -0,0 +1,121 @@
+"""
+    Ingest queue shared by the backend and the ingest workers.
+    Requests go to a Redis stream per priority lane and folder, read by a consumer group. Workers pick a lane at
+    random in proportion to its weight, and take the folders of a lane round robin, so that a bulk load of one folder
+    neither starves interactive updates nor the other folders.
+"""
+import random
+from typing import Any, Dict, List, Optional, Tuple
+
+import redis  # type: ignore
+
+LANES = ("interactive", "small", "bulk")
+
+# KEYS: stream, ready folders list, ready folders set, streams set, signal list; ARGV: folder, data, group
+ENQUEUE = """
+pcall(redis.call, 'xgroup', 'create', KEYS[1], ARGV[3], '0', 'MKSTREAM')
+local id = redis.call('xadd', KEYS[1], '*', 'data', ARGV[2])
+if redis.call('sadd', KEYS[3], ARGV[1]) == 1 then
+    redis.call('rpush', KEYS[2], ARGV[1])
+end
+redis.call('sadd', KEYS[4], KEYS[1])
+redis.call('rpush', KEYS[5], 1)
+redis.call('ltrim', KEYS[5], -1000, -1)
+return id
+"""
+
+# KEYS: ready folders list, ready folders set, then the stream of each folder; ARGV: group, consumer, then the folders
+# Folders made ready after the caller listed them are left for the next call, their streams are not in KEYS
+DEQUEUE = """
+local streams = {}
+for i = 3, #ARGV do
+    streams[ARGV[i]] = KEYS[i]
+end
+for _ = 1, redis.call('llen', KEYS[1]) do
+    local folder = redis.call('lmove', KEYS[1], KEYS[1], 'LEFT', 'RIGHT')
+    local stream = streams[folder]
+    if stream then
+        local entries = redis.call('xreadgroup', 'GROUP', ARGV[1], ARGV[2], 'COUNT', 1, 'STREAMS', stream, '>')
+        if entries then
+            local entry = entries[1][2][1]
+            return {stream, entry[1], entry[2]}
+        end
+        redis.call('lrem', KEYS[1], 1, folder)
+        redis.call('srem', KEYS[2], folder)
+    end
+end
+return false
+"""
+
+
+class IngestQueue:
+    """Weighted priority lanes of per-folder Redis streams."""
+
+    def __init__(
+        self,
+        redis_client: redis.StrictRedis,
+        weights: Optional[Dict[str, int]] = None,
+        group: str = "build-index",
+        prefix: str = "ingest",
+    ) -> None:
+        """Initialize the queue."""
+        self.redis_client = redis_client
+        self.weights = weights or {"interactive": 8, "small": 3, "bulk": 1}
+        self.group = group
+        self.prefix = prefix
+        self.streams_key = f"{prefix}:streams"  # every folder stream, for reclaiming and metrics
+        self.signal_key = f"{prefix}:signal"  # pushed on every enqueue, idle workers block on it
+        self._enqueue = redis_client.register_script(ENQUEUE)
+        self._dequeue = redis_client.register_script(DEQUEUE)
+
+    def stream_key(self, lane: str, folder: str) -> str:
+        """Stream of a folder's requests in a lane"""
+        return f"{self.prefix}:stream:{lane}:{folder}"
+
+    def enqueue(self, lane: str, folder: str, data: str, pipe: Optional[Any] = None) -> Any:
+        """Add a request to a lane, in the given pipeline if any. Returns its entry id (unless pipelined)"""
+        if lane not in LANES:
+            raise ValueError(f"Unknown ingest lane {lane}, expected one of {', '.join(LANES)}")
+        keys = [
+            self.stream_key(lane, folder),
+            f"{self.prefix}:ready:{lane}",
+            f"{self.prefix}:ready:{lane}:set",
+            self.streams_key,
+            self.signal_key,
+        ]
+        return self._enqueue(keys=keys, args=[folder, data, self.group], client=pipe)
+
+    def dequeue(self, consumer: str) -> Optional[Tuple[bytes, bytes, Dict[bytes, bytes]]]:
+        """Read the next request for the consumer as (stream, entry id, fields), or None if all lanes are empty"""
+        # Weighted random order of the lanes, so that a lane is tried first in proportion to its weight
+        lanes = sorted(self.weights, key=lambda lane: random.random() ** (1 / self.weights[lane]), reverse=True)
+        for lane in lanes:
+            ready_key = f"{self.prefix}:ready:{lane}"
+            folders = [
+                folder.decode("utf-8") if isinstance(folder, bytes) else folder
+                for folder in self.redis_client.lrange(ready_key, 0, -1)
+            ]
+            if not folders:
+                continue
+            # The script only touches the keys it is given, as Redis Cluster and script replication require
+            keys = [ready_key, f"{ready_key}:set", *(self.stream_key(lane, folder) for folder in folders)]
+            entry = self._dequeue(keys=keys, args=[self.group, consumer, *folders])
+            if entry:
+                stream, msg_id, fields = entry
+                return stream, msg_id, dict(zip(fields[::2], fields[1::2]))
+        return None
+
+    def wait(self, timeout: int) -> None:
+        """Block until a request is enqueued, or for timeout seconds"""
+        self.redis_client.blpop([self.signal_key], timeout=timeout)
+
+    def streams(self) -> List[bytes]:
+        """Every folder stream"""
+        return sorted(self.redis_client.smembers(self.streams_key))
+
+    def depth(self) -> int:
+        """Requests waiting or in flight in all lanes"""
+        pipe = self.redis_client.pipeline(transaction=False)
+        for stream in self.streams():
+            pipe.xlen(stream)
+        return sum(pipe.execute())
@@ -1,15 +1,30 @@
 """Demo app"""
-from typing import Any
+import json
+from typing import Iterator
 
 import httpx
 import streamlit as st
 
+CHAT_URL = "http://localhost:8080/chat"
 
-def send_question(question: str) -> Any:
-    """Send the question to the chat service and get the response."""
-    url = "http://localhost:8080/chat"
-    response = httpx.post(url, json={"question": question}, timeout=30)
-    return response.json()
+
+def stream_answer(question: str) -> Iterator[str]:
+    """Send the question to the chat service and yield the answer tokens as they arrive."""
+    with httpx.stream("POST", f"{CHAT_URL}/stream", json={"question": question}, timeout=30) as response:
+        response.raise_for_status()
+        event = "message"
+        for line in response.iter_lines():
+            if line.startswith("event:"):
+                event = line[len("event:") :].strip()
+            elif line.startswith("data:"):
+                data = json.loads(line[len("data:") :])
+                if event == "message":
+                    yield data["token"]
+                elif event == "error":
+                    raise RuntimeError(data.get("description", "Failed to get a response."))
+            elif not line:
+                # End of the event
+                event = "message"
 
 
 def main() -> None:
@@ -21,13 +36,20 @@ def main() -> None:
 
     if st.button("Ask Milo"):
         if question:
-            # Send the question to the chat service
-            response = send_question(question)
-            if response:
-                # Display the answer
-                st.success(response.get("answer", "No response from the service."))
-            else:
+            # Send the question to the chat service, and display the answer as it is generated
+            answer_placeholder = st.empty()
+            answer = ""
+            try:
+                for token in stream_answer(question):
+                    answer += token
+                    answer_placeholder.success(answer + " ")
+            except (httpx.HTTPError, RuntimeError):
                 st.error("Failed to get a response.")
+                return
+            if answer:
+                answer_placeholder.success(answer)
+            else:
+                st.error("No response from the service.")
         else:
             st.warning("Please enter a question.")
 
@@ -1,12 +1,19 @@
 """ Build the vector index from the markdown files in the directory. """
+import argparse
 import json
 import logging
 import os
 import sys
+import threading
+import time
 import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, Iterator, Optional
 
+import embedding_store
 import pandas as pd
-from chat_db_helper import Chat, ChatVectorDB
+from chat_db_helper import KB_DIR, Chat, ChatVectorDB, flip_alias, summarize
 from dotenv import load_dotenv
 from openai import OpenAI
 from tqdm import tqdm
@@ -22,9 +29,123 @@ assert os.getenv("OPENAI_API_KEY"), "Please set your OPENAI_API_KEY environment
 
 client = OpenAI()
 
+SUMMARIZE_CONCURRENCY = int(os.getenv("SUMMARIZE_CONCURRENCY", "8"))  # summaries requested at once
+SUMMARIZE_REQUESTS_PER_MINUTE = int(os.getenv("SUMMARIZE_REQUESTS_PER_MINUTE", "500"))
+
+# A rebuilt collection is only swapped in if sampled chats are found among the nearest ones to their own embedding
+REBUILD_RECALL_SAMPLES = int(os.getenv("REBUILD_RECALL_SAMPLES", "20"))
+REBUILD_MIN_RECALL = float(os.getenv("REBUILD_MIN_RECALL", "0.95"))
+
+
+class RateLimiter:
+    """Spaces out the calls of all threads to at most requests_per_minute."""
+
+    def __init__(self, requests_per_minute: int) -> None:
+        """Initialize the limiter."""
+        self.interval = 60.0 / requests_per_minute
+        self.lock = threading.Lock()
+        self.next_at = time.monotonic()
+
+    def wait(self) -> None:
+        """Block until the next call is allowed"""
+        with self.lock:
+            now = time.monotonic()
+            at = max(self.next_at, now)
+            self.next_at = at + self.interval
+        time.sleep(at - now)
+
+
+def load_summaries(checkpoint: str) -> Dict[str, str]:
+    """Summaries completed by earlier runs, by thread_id"""
+    summaries: Dict[str, str] = {}
+    if not os.path.exists(checkpoint):
+        return summaries
+    with open(checkpoint, "rb+") as file:
+        complete = 0
+        for line in file:
+            if not line.endswith(b"\n"):
+                # Cut short by an interruption, it is summarized again
+                file.truncate(complete)
+                break
+            complete += len(line)
+            record = json.loads(line)
+            summaries[record["thread_id"]] = record["summary"]
+    return summaries
+
+
+def summarize_all(chats_df: pd.DataFrame, checkpoint: str) -> Dict[str, str]:
+    """
+    Summarize the chats that have no summary yet, SUMMARIZE_CONCURRENCY at a time within the rate limit.
+    Each summary is appended to the checkpoint as it completes, and the ones in it are not summarized again.
+    """
+    summaries = load_summaries(checkpoint)
+    texts = {
+        row.thread_id: row.chat_text
+        for row in chats_df.itertuples()
+        if not row.summary and row.thread_id not in summaries
+    }
+    print(f"Summaries from earlier runs: {len(summaries)}, to summarize: {len(texts)}")
+    limiter = RateLimiter(SUMMARIZE_REQUESTS_PER_MINUTE)
+
+    def run(text: str) -> str:
+        """Summarize one chat when the rate limit allows it"""
+        limiter.wait()
+        summary: str = summarize(text)
+        return summary
+
+    executor = ThreadPoolExecutor(max_workers=SUMMARIZE_CONCURRENCY)
+    try:
+        with open(checkpoint, "a", encoding="utf-8") as file:
+            futures = {executor.submit(run, text): thread_id for thread_id, text in texts.items()}
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Summarizing"):
+                try:
+                    summary = future.result()
+                except Exception:  # pylint: disable=bare-except
+                    traceback.print_exc()
+                    continue
+                summaries[futures[future]] = summary
+                file.write(json.dumps({"thread_id": futures[future], "summary": summary}) + "\n")
+                file.flush()
+    finally:
+        # Don't start the remaining ones on an interruption
+        executor.shutdown(wait=False, cancel_futures=True)
+    return summaries
+
+
+def rebuild(chats: Iterable[Chat], expected_count: int, serving: Optional[ChatVectorDB] = None) -> None:
+    """
+    Build a new collection of the chats, validate it and flip the alias to it.
+    The collection it replaces is kept for the readers still on it, older ones (and failed rebuilds) are deleted.
+    Chroma's local database can't be shared between processes: to keep answering from the current collection in the
+    meantime, call it from the serving process with its ChatVectorDB, the new collection is built through its client.
+    """
+    previous = ChatVectorDB.resolve_alias()
+    # Named after the version, and unique so that it never is one being served or a failed rebuild
+    chat_vector_db = ChatVectorDB(
+        f"chats-{ChatVectorDB.chat_db_version}-{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:6]}",
+        client=serving.client if serving else None,
+    )
+    chat_vector_db.add(chats)
+    chat_vector_db.validate(expected_count, REBUILD_RECALL_SAMPLES, REBUILD_MIN_RECALL)
+    flip_alias(ChatVectorDB.alias, chat_vector_db.collection_name)
+    print(f"{ChatVectorDB.alias} now points at {chat_vector_db.collection_name} instead of {previous}")
+    for collection in chat_vector_db.client.list_collections():
+        name = getattr(collection, "name", collection)  # newer chromadb versions only list the names
+        if name.startswith("chats-") and name not in (chat_vector_db.collection_name, previous):
+            chat_vector_db.client.delete_collection(name)
+            print(f"Deleted old collection {name}")
+
 
 def main() -> None:
     """Build the vector index from the markdown files in the directory."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="build a new collection and swap it in, instead of updating in place (stop Milo while it runs)",
+    )
+    args = parser.parse_args()
+
     base_dir = os.path.dirname(os.path.abspath(__file__))
     # Each conversation grouped into a single thread_id
     chats_df = pd.read_csv(os.path.join(base_dir, ".content", "chats", "chats.csv"))
@@ -32,56 +153,43 @@ def main() -> None:
     chats_df = chats_df.fillna("")
     print("Number of all conversations: ", len(chats_df))
 
-    # Cache of embeddings from data
+    # Embeddings from data, converted once to a columnar store with memory-mapped vectors
     # The embedding for each conversation with its thread_id (Note: not all embeddings were generated for the chat text)
-    # Create a temp index of the chats
-    chats_index = {}
-    for _, row in tqdm(chats_df.iterrows(), desc="Creating temporary chats index"):
-        chats_index[row["thread_id"]] = row["chat_text"]
-
-    embeddings_df = pd.read_csv(os.path.join(base_dir, ".content", "chats", "chats-embeddings-ada-002.csv"))
-    embeddings_df.head()
-    embeddings_cache = {}
-    for index, row in tqdm(embeddings_df.iterrows(), desc="Creating a cache of embeddings"):
-        if row["thread_id"] not in chats_index:
-            continue
-        chat_text = chats_index[row["thread_id"]]
-        embedding = json.loads(row["embedding"])
-        embeddings_cache[chat_text] = embedding
-
-    chats = []
+    store_dir = os.path.join(KB_DIR, "embeddings")
+    if not embedding_store.exists(store_dir):
+        embeddings_csv = os.path.join(base_dir, ".content", "chats", "chats-embeddings-ada-002.csv")
+        embedding_store.convert(embeddings_csv, chats_df, store_dir)
+    table, vectors = embedding_store.load(store_dir)
+    # Row of each chat's embedding, -1 if there is none for its text (it is then embedded when it is added)
+    embedding_rows = embedding_store.lookup(table, chats_df)
+    print("Conversations with an embedding: ", int((embedding_rows >= 0).sum()))
+
     if "summary" not in chats_df.columns:
         chats_df["summary"] = [""] * len(chats_df)
 
     # NOTE: THIS WILL USE SIGNIFICANT OPENAI API CREDITS TO SUMMARIZE ALL THE CONVERSATIONS
-    for index, row in tqdm(chats_df.iterrows(), total=len(chats_df)):
-        try:
-            if row.get("summary"):
-                chat = Chat(
-                    thread_id=row["thread_id"],
-                    text=row["chat_text"],
-                    summary=row["summary"],
-                    embeddings_cache=embeddings_cache,
-                )
-            else:
-                chat = Chat(thread_id=row["thread_id"], text=row["chat_text"], embeddings_cache=embeddings_cache)
-            chats_df.at[index, "summary"] = chat.summary
-            chats.append(chat)
-            # Save the summary to the csv, overwrite the file
-            if index % 250 == 0:
-                chats_df.to_csv(os.path.join(base_dir, ".content", "chats", "chats.csv"), index=False, quotechar='"')
-        except KeyboardInterrupt as keyi:
-            print("Keyboard Interrupt")
-            raise keyi
-        except Exception:  # pylint: disable=bare-except
-            traceback.print_exc()
-
-    # Save remaining ones (%10)
+    summaries = summarize_all(chats_df, os.path.join(base_dir, ".content", "chats", "summaries.jsonl"))
+    missing = chats_df["summary"] == ""
+    chats_df.loc[missing, "summary"] = chats_df.loc[missing, "thread_id"].map(summaries).fillna("")
+    # Save the summaries to the csv once, the checkpoint has them in the meantime
     chats_df.to_csv(os.path.join(base_dir, ".content", "chats", "chats.csv"), index=False, quotechar='"')
 
-    # Bulk insert them
+    def chats() -> Iterator[Chat]:
+        """The chats to index, built as they are written. Those that failed to summarize wait for the next run"""
+        for index, row in enumerate(chats_df.itertuples()):
+            if not row.summary:
+                continue
+            embedding_row = embedding_rows[index]
+            embedding = vectors[embedding_row].tolist() if embedding_row >= 0 else None
+            yield Chat(thread_id=row.thread_id, text=row.chat_text, summary=row.summary, embedding=embedding)
+
+    if args.rebuild:
+        rebuild(chats(), expected_count=chats_df.loc[chats_df["summary"] != "", "thread_id"].nunique())
+        return
+
+    # Bulk insert them into the collection being served, streamed in batches
     chat_vector_db = ChatVectorDB()
-    chat_vector_db.add(chats)
+    chat_vector_db.add(chats())
 
 
 if __name__ == "__main__":
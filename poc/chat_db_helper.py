@@ -4,12 +4,16 @@
     functions for data preparation and data querying chatbot.
 """
 
+import json
 import os
-from typing import Any, Dict, List, Optional
+import random
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple, cast
 
 import chromadb
 from dotenv import load_dotenv
 from openai import OpenAI
+from sqlite_embedding_cache import EmbeddingCache
 from tqdm import tqdm
 
 # Load the .env file
@@ -20,100 +24,203 @@ assert os.getenv("OPENAI_API_KEY"), "Please set your OPENAI_API_KEY environment
 
 client = OpenAI()
 
+EMBEDDING_MODEL = "text-embedding-ada-002"
+CHROMA_WRITE_BATCH_SIZE = int(os.getenv("CHROMA_WRITE_BATCH_SIZE", "500"))  # chats per upsert
 
-def get_embedding(text: str, embeddings_cache: Optional[Dict[str, List[float]]] = None) -> Any:
+# Persistent cache of the embeddings we computed, so that repeated texts skip the API call
+KB_DIR = os.getenv("KB_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".kb"))
+os.makedirs(KB_DIR, exist_ok=True)
+embedding_cache = EmbeddingCache(
+    os.path.join(KB_DIR, "embeddings.sqlite"),
+    max_bytes=int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+)
+
+# Which collection each alias points at, so that a rebuilt collection is swapped in at once
+ALIASES_FILE = os.path.join(KB_DIR, "aliases.json")
+
+
+def get_embedding(text: str) -> Any:
     """Use the same embedding generator as what was used on the data!!!"""
-    if embeddings_cache and text in embeddings_cache:
-        return embeddings_cache[text]
     if len(text) > 8000:  # Hack to be under the 8k limit
         text = text[:8000]
-    response = client.embeddings.create(model="text-embedding-ada-002", input=text)
-    return response.data[0].embedding
+    embedding = embedding_cache.get(EMBEDDING_MODEL, text)
+    if embedding is None:
+        response = client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+        embedding = response.data[0].embedding
+        embedding_cache.set(EMBEDDING_MODEL, text, embedding)
+    return embedding
+
+
+def summarize(text: str) -> Any:
+    """Summarize conversations since individually they are long and go over 8k limit"""
+    if len(text) / 4 > 3800:  # Hack to be under the 4k limit, one token ~= 4 characters
+        text = text[:3800]
+    prompt = (
+        "Summarize the following Slack conversation. Do not use ids, usernames, mentions, \
+and links in the summary. \
+If there is a question asked, please include the question, and the summarized answer. \
+If there is no question, generate a question that might be used to retrieve this summary.```"
+        + text
+        + "```"
+    )
+    completion = client.chat.completions.create(model="gpt-3.5-turbo", messages=[{"role": "user", "content": prompt}])
+    return completion.choices[0].message.content
 
 
 class Chat:
     """A chat conversation."""
 
+    __slots__ = ("thread_id", "text", "summary", "_embedding")
+
     def __init__(
         self,
         thread_id: str,
         text: str,
         summary: Optional[str] = None,
-        embeddings_cache: Optional[Dict[str, List[float]]] = None,
+        embedding: Optional[List[float]] = None,
     ) -> None:
-        """Initialize the chat."""
+        """Initialize the chat, summarizing it if no summary is given."""
         self.thread_id = thread_id
         self.text = text
-        if summary:
+        if summary is not None:
             self.summary = summary
         else:
-            self.summary = self._summarize(text)
-        self.embedding = get_embedding(text, embeddings_cache)
-
-    def _summarize(self, text: str) -> Any:
-        """Summarize conversations since individually they are long and go over 8k limit"""
-        if len(text) / 4 > 3800:  # Hack to be under the 4k limit, one token ~= 4 characters
-            text = text[:3800]
-        prompt = (
-            "Summarize the following Slack conversation. Do not use ids, usernames, mentions, \
-and links in the summary. \
-If there is a question asked, please include the question, and the summarized answer. \
-If there is no question, generate a question that might be used to retrieve this summary.```"
-            + text
-            + "```"
-        )
-        completion = client.chat.completions.create(
-            model="gpt-3.5-turbo", messages=[{"role": "user", "content": prompt}]
-        )
-        return completion.choices[0].message.content
+            self.summary = summarize(text)
+        self._embedding = embedding
+
+    @property
+    def embedding(self) -> Any:
+        """Embedding of the chat text, computed on first use unless it was given (e.g. by Chroma)"""
+        if self._embedding is None:
+            self._embedding = get_embedding(self.text)
+        return self._embedding
 
     def __repr__(self) -> str:
         return f"ChatDocument(thread_id={self.thread_id})"
 
 
+def read_aliases() -> Dict[str, str]:
+    """The collection each alias points at"""
+    if not os.path.exists(ALIASES_FILE):
+        return {}
+    with open(ALIASES_FILE, encoding="utf-8") as file:
+        return cast(Dict[str, str], json.load(file))
+
+
+def flip_alias(alias: str, collection_name: str) -> None:
+    """Point an alias at a collection, replacing the aliases file at once so that readers never see it half written"""
+    aliases = {**read_aliases(), alias: collection_name}
+    with open(f"{ALIASES_FILE}.tmp", "w", encoding="utf-8") as file:
+        json.dump(aliases, file, indent=1, sort_keys=True)
+    os.replace(f"{ALIASES_FILE}.tmp", ALIASES_FILE)
+
+
 class ChatVectorDB:
     """A vector database for chat conversations."""
 
     chat_db_version = "01"  # Version of the chat database
+    alias = "chats"  # Readers open the collection it points at, build_index.py --rebuild flips it
 
-    def __init__(self) -> None:
-        """Initialize the database."""
+    def __init__(self, collection_name: Optional[str] = None, client: Optional[Any] = None) -> None:
+        """
+        Initialize the database, on the given collection or else the one the alias points at.
+        Pass the client of another ChatVectorDB to share it, Chroma's local database can't be opened twice.
+        """
         self.db_name = "chroma.db"
-        self.collection_name = f"chats-{ChatVectorDB.chat_db_version}"
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        db_path = os.path.join(base_dir, ".kb")
-        os.makedirs(db_path, exist_ok=True)
-        self.client = chromadb.PersistentClient(os.path.join(db_path, "chroma.db"))
-        try:
-            self.collection = self.client.get_collection(self.collection_name)
-        except ValueError:
-            # Create the collection if it doesn't exist
-            self.collection = self.client.create_collection(self.collection_name)
-
-    def search_index(self, text: str) -> List[Chat]:
-        """Search the index for the top 3 results."""
+        self.client = client or chromadb.PersistentClient(os.path.join(KB_DIR, "chroma.db"))
+        self.follows_alias = collection_name is None
+        self.aliases_mtime = self._aliases_mtime()
+        self._open(collection_name or self.resolve_alias())
+
+    @classmethod
+    def resolve_alias(cls) -> str:
+        """The collection the alias points at, the version's own collection until a rebuild flipped it"""
+        return read_aliases().get(cls.alias, f"chats-{cls.chat_db_version}")
+
+    @staticmethod
+    def _aliases_mtime() -> float:
+        """When the aliases were last flipped"""
+        return os.path.getmtime(ALIASES_FILE) if os.path.exists(ALIASES_FILE) else 0.0
+
+    def _open(self, collection_name: str) -> None:
+        """Use a collection, creating it if it doesn't exist"""
+        self.collection_name = collection_name
+        self.collection = self.client.get_or_create_collection(self.collection_name)
+
+    def _follow_alias(self) -> None:
+        """Switch to the collection the alias points at if it was flipped since we opened ours"""
+        if not self.follows_alias or self._aliases_mtime() == self.aliases_mtime:
+            return
+        self.aliases_mtime = self._aliases_mtime()
+        collection_name = self.resolve_alias()
+        if collection_name != self.collection_name:
+            self._open(collection_name)
+
+    def validate(self, expected_count: int, samples: int = 20, min_recall: float = 0.95) -> None:
+        """Check that the collection has expected_count chats, and that sampled chats are found by their embedding"""
+        count = self.collection.count()
+        if count != expected_count:
+            raise ValueError(f"{self.collection_name} has {count} chats, expected {expected_count}")
+        if not count:
+            return
+        sample = random.sample(self.collection.get(include=[])["ids"], min(samples, count))
+        stored = self.collection.get(ids=sample, include=["embeddings"])
+        results = self.collection.query(query_embeddings=stored["embeddings"], n_results=3, include=["distances"])
+        recall = sum(chat_id in nearest for chat_id, nearest in zip(stored["ids"], results["ids"])) / len(sample)
+        if recall < min_recall:
+            raise ValueError(f"{self.collection_name} recall of its own chats is {recall:.2f}, expected {min_recall}")
+
+    def search_index(self, text: str, k: int = 3, with_embeddings: bool = False) -> List[Tuple[Chat, float]]:
+        """Search the index for the top k results, as (chat, distance) pairs nearest first."""
+        self._follow_alias()
         embedding = get_embedding(text)
-        results = self.collection.query(query_embeddings=[embedding], n_results=3)
+        include = ["metadatas", "distances"] + (["embeddings"] if with_embeddings else [])
+        results = self.collection.query(query_embeddings=[embedding], n_results=k, include=include)
+        embeddings = results["embeddings"][0] if with_embeddings else [None] * len(results["ids"][0])
         return [
-            Chat(thread_id=m["thread_id"], text=m["text"], summary=m.get("summary", ""))
-            for m in results["metadatas"][0]
+            (Chat(thread_id=m["thread_id"], text=m["text"], summary=m.get("summary", ""), embedding=e), distance)
+            for m, e, distance in zip(results["metadatas"][0], embeddings, results["distances"][0])
         ]
 
-    def add(self, chats: List[Chat]) -> None:
-        """Add the embeddings, metadata, and ids to the database."""
-
-        embeddings_list = []
-        metadata_list = []
-        id_list = []
-
-        for chat in tqdm(chats):
-            metadata = {
-                "thread_id": chat.thread_id,
-                "text": chat.text,
-                "summary": chat.summary,
-            }
-            metadata_list.append(metadata)
-            embeddings_list.append(chat.embedding)
-            id_list.append(chat.thread_id)
-
-        self.collection.add(embeddings=embeddings_list, metadatas=metadata_list, ids=id_list)
+    def add(self, chats: Iterable[Chat], batch_size: int = CHROMA_WRITE_BATCH_SIZE) -> None:
+        """
+        Upsert the chats by thread_id, batch_size at a time (at most Chroma's max batch size), as they are generated.
+        Chats already in the collection are skipped before they are embedded, so that an interrupted load resumes
+        where it stopped.
+        """
+        batch_size = min(batch_size, self.client.get_max_batch_size())
+        written = 0
+        skipped = 0
+        started = time.perf_counter()
+
+        def write(batch: Dict[str, Chat]) -> None:
+            """Upsert the chats of a batch that aren't in the collection yet"""
+            nonlocal written, skipped
+            for thread_id in self.collection.get(ids=list(batch), include=[])["ids"]:
+                del batch[thread_id]
+                skipped += 1
+            if not batch:
+                return
+            self.collection.upsert(
+                ids=list(batch),
+                embeddings=[chat.embedding for chat in batch.values()],
+                metadatas=[
+                    {"thread_id": chat.thread_id, "text": chat.text, "summary": chat.summary} for chat in batch.values()
+                ],
+            )
+            written += len(batch)
+
+        batch: Dict[str, Chat] = {}  # by thread_id, as ids must be unique in a batch
+        for chat in tqdm(chats, unit="chat"):
+            batch[chat.thread_id] = chat
+            if len(batch) >= batch_size:
+                write(batch)
+                batch = {}
+        if batch:
+            write(batch)
+
+        elapsed = time.perf_counter() - started
+        print(
+            f"Upserted {written} chats into {self.collection_name} in {elapsed:.1f}s: {written / elapsed:.1f} chats/s, "
+            f"skipped {skipped} already there"
+        )
@@ -0,0 +1,88 @@
+"""
+    Columnar store of the precomputed chat embeddings.
+    chats-embeddings-ada-002.csv is converted once into a Parquet table of thread_ids and the content hashes of the
+    chats they embed, and a float32 .npy matrix of the vectors (row i of the matrix is row i of the table). The matrix
+    is memory-mapped on load, so only the vectors that are used are read from disk.
+"""
+import hashlib
+import json
+import os
+from typing import Iterable, List, Tuple
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+TABLE_FILE = "embeddings.parquet"
+VECTORS_FILE = "embeddings.npy"
+
+
+def content_hash(text: str) -> str:
+    """Fingerprint of a chat text, to only reuse an embedding for the text it was computed from"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def content_hashes(texts: Iterable[str]) -> List[str]:
+    """Fingerprints of chat texts"""
+    return [content_hash(text) for text in texts]
+
+
+def exists(store_dir: str) -> bool:
+    """Whether the store was converted already"""
+    return os.path.exists(os.path.join(store_dir, TABLE_FILE)) and os.path.exists(os.path.join(store_dir, VECTORS_FILE))
+
+
+def convert(embeddings_csv: str, chats_df: pd.DataFrame, store_dir: str, chunksize: int = 5000) -> None:
+    """One-time conversion of the embeddings CSV, for the chats (thread_id, chat_text) they were computed from"""
+    texts = chats_df.drop_duplicates("thread_id", keep="last").set_index("thread_id")["chat_text"]
+    rows = sum(len(chunk) for chunk in pd.read_csv(embeddings_csv, usecols=["thread_id"], chunksize=chunksize))
+    os.makedirs(store_dir, exist_ok=True)
+    vectors = None
+    thread_ids: List[str] = []
+    offset = 0
+    with tqdm(total=rows, desc="Converting embeddings") as progress:
+        for chunk in pd.read_csv(embeddings_csv, usecols=["thread_id", "embedding"], chunksize=chunksize):
+            if chunk.empty:
+                continue
+            batch = np.array([json.loads(embedding) for embedding in chunk["embedding"]], dtype=np.float32)
+            if vectors is None:
+                vectors = np.lib.format.open_memmap(
+                    os.path.join(store_dir, f"{VECTORS_FILE}.tmp"),
+                    mode="w+",
+                    dtype=np.float32,
+                    shape=(rows, batch.shape[1]),
+                )
+            vectors[offset : offset + len(batch)] = batch
+            offset += len(batch)
+            thread_ids.extend(chunk["thread_id"])
+            progress.update(len(chunk))
+    if vectors is None:
+        raise ValueError(f"No embeddings in {embeddings_csv}")
+    vectors.flush()
+    del vectors
+
+    # Embeddings of chats we don't have get an empty hash, they never match
+    table = pd.DataFrame({"thread_id": thread_ids})
+    table["content_hash"] = [
+        content_hash(text) if isinstance(text, str) else "" for text in table["thread_id"].map(texts)
+    ]
+    table.to_parquet(os.path.join(store_dir, f"{TABLE_FILE}.tmp"), index=False)
+    # Renamed last, so that an interrupted conversion is started over
+    os.replace(os.path.join(store_dir, f"{VECTORS_FILE}.tmp"), os.path.join(store_dir, VECTORS_FILE))
+    os.replace(os.path.join(store_dir, f"{TABLE_FILE}.tmp"), os.path.join(store_dir, TABLE_FILE))
+
+
+def load(store_dir: str) -> Tuple[pd.DataFrame, np.ndarray]:
+    """The table of thread_ids and content hashes, and the memory-mapped vectors"""
+    table = pd.read_parquet(os.path.join(store_dir, TABLE_FILE))
+    vectors = np.load(os.path.join(store_dir, VECTORS_FILE), mmap_mode="r")
+    return table, vectors
+
+
+def lookup(table: pd.DataFrame, chats_df: pd.DataFrame) -> np.ndarray:
+    """Row of the vectors of each chat (thread_id, chat_text), -1 for the chats that have no embedding for their text"""
+    keys = pd.DataFrame(
+        {"thread_id": chats_df["thread_id"].to_numpy(), "content_hash": content_hashes(chats_df["chat_text"])}
+    )
+    rows = table.reset_index(names="row").drop_duplicates(["thread_id", "content_hash"], keep="last")
+    return keys.merge(rows, on=["thread_id", "content_hash"], how="left")["row"].fillna(-1).astype(np.int64).to_numpy()
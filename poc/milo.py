@@ -35,7 +35,7 @@ def get_answer(question: str) -> Tuple[str, Any]:
     # Get answer to the question by finding the three conversations that are nearest
     # to the question and then using them to generate the answer.
     print("Searching documents nearest to the question.")
-    chats = chat_vector_db.search_index(question)
+    chats = [chat for chat, _ in chat_vector_db.search_index(question)]
     summaries = "\n".join([chat.summary for chat in chats])
     return summaries, extract_answer([chat.summary for chat in chats], question)
 
@@ -0,0 +1,94 @@
+"""
+    Persistent embedding cache for the poc, stored in a local SQLite file.
+    Embeddings are stored as float32 bytes, keyed by model and the sha256 of the normalized text (see embedding_codec),
+    and the least recently used ones are evicted once the cache grows over its size limit.
+"""
+import os
+import sqlite3
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Sequence
+
+# The keys and the encoding of the embeddings are the ones of the services' Redis cache
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "advanced", "common", "shared"))
+from embedding_codec import decode, encode, text_digest  # noqa: E402
+
+
+class EmbeddingCache:
+    """An LRU cache of embeddings in SQLite."""
+
+    def __init__(self, db_path: str, max_bytes: int) -> None:
+        """Initialize the cache."""
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(key TEXT PRIMARY KEY, vector BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.connection.commit()
+        self.total_bytes = self._total_bytes()
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        """Cache key for the text embedded with the model"""
+        return f"{model}:{text_digest(text)}"
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        """Cached embedding for the text, or None"""
+        key = self.key(model, text)
+        with self._lock:
+            row = self.connection.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute("UPDATE embeddings SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.connection.commit()
+        return decode(row[0])
+
+    def set(self, model: str, text: str, embedding: Sequence[float]) -> None:
+        """Cache the embedding of the text"""
+        vector = encode(embedding)
+        with self._lock:
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO embeddings (key, vector, size, last_used) VALUES (?, ?, ?, ?)",
+                (self.key(model, text), vector, len(vector), time.time()),
+            )
+            self.total_bytes += len(vector) * cursor.rowcount
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self.connection.commit()
+
+    def _total_bytes(self) -> int:
+        """Size of the cached embeddings"""
+        (total,) = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()
+        return int(total)
+
+    def _evict(self) -> None:
+        """Drop least recently used embeddings until the cache is under 90% of its size limit"""
+        excess = self.total_bytes - int(self.max_bytes * 0.9)
+        self.connection.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM "
+            "(SELECT key, size, SUM(size) OVER (ORDER BY last_used, key) AS freed FROM embeddings) "
+            "WHERE freed - size < ?)",
+            (excess,),
+        )
+        self.total_bytes = self._total_bytes()
+
+    def stats(self) -> Dict[str, float]:
+        """Hits, misses and size of the cache"""
+        with self._lock:
+            (entries,) = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": self.total_bytes,
+        }
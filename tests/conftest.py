@@ -0,0 +1,119 @@
+""" Fixtures: the services' modules, imported against an in-memory Redis, an in-memory Chroma and a fake API key """
+import importlib
+import os
+import sys
+from typing import Any, Iterator
+
+import chromadb
+import fakeredis
+import prometheus_client
+import pytest
+import redis
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUILD_INDEX_APP = os.path.join(ROOT, "advanced", "build-index", "app")
+BACKEND_APP = os.path.join(ROOT, "advanced", "backend", "app")
+SHARED = os.path.join(ROOT, "advanced", "common", "shared")
+BATCH_UPLOAD_APP = os.path.join(ROOT, "advanced", "batch-upload", "app")
+POC = os.path.join(ROOT, "poc")
+
+# The services are not packages, their modules are imported by name, along with the modules they share (copied into
+# their images). The poc goes last.
+sys.path[:0] = [BUILD_INDEX_APP, BACKEND_APP, SHARED, BATCH_UPLOAD_APP]
+sys.path.append(POC)
+
+REDIS_SERVER = fakeredis.FakeServer()
+
+ENV = {
+    "OPENAI_API_KEY": "sk-test",
+    "REDIS_URL": "localhost:6379",
+    "REDIS_PASSWORD": "password",
+    "S3_URL": "localhost:9000",
+    "S3_REGION": "us-east-1",
+    "S3_ACCESS_KEY_ID": "minio",
+    "S3_SECRET_ACCESS_KEY": "minio123",
+    "S3_SECURE": "false",
+    "S3_BUCKET_NAME": "data",
+    "CHROMA_URL": "localhost",
+    "CHROMA_PORT": "8000",
+    "CHROMA_AUTH_TOKEN": "token",
+}
+
+
+def fake_pool(pool_class: Any) -> Any:
+    """from_url of a connection pool, connecting to the in-memory Redis instead"""
+
+    def from_url(_url: str, **kwargs: Any) -> Any:
+        return pool_class(connection_class=fakeredis.FakeRedisConnection, server=REDIS_SERVER, **kwargs)
+
+    return from_url
+
+
+@pytest.fixture(scope="session")
+def mq() -> Iterator[Any]:
+    """The ingest worker module"""
+    with pytest.MonkeyPatch.context() as patch:
+        for name, value in ENV.items():
+            patch.setenv(name, value)
+        patch.setattr(redis.BlockingConnectionPool, "from_url", fake_pool(redis.BlockingConnectionPool))
+        patch.setattr(chromadb, "HttpClient", lambda **_: chromadb.EphemeralClient())
+        # The services both define their metrics, which can only be registered once in a process
+        patch.setattr(prometheus_client.REGISTRY, "register", lambda _collector: None)
+        yield importlib.import_module("mq")
+
+
+@pytest.fixture(scope="session")
+def backend() -> Iterator[Any]:
+    """The backend's flask app module"""
+    with pytest.MonkeyPatch.context() as patch:
+        for name, value in ENV.items():
+            patch.setenv(name, value)
+        patch.setattr(redis.ConnectionPool, "from_url", fake_pool(redis.ConnectionPool))
+        patch.setattr(chromadb, "HttpClient", lambda **_: chromadb.EphemeralClient())
+        patch.setattr(prometheus_client.REGISTRY, "register", lambda _collector: None)
+        yield importlib.import_module("app")
+
+
+@pytest.fixture(scope="session")
+def chat_db_helper(tmp_path_factory: pytest.TempPathFactory) -> Iterator[Any]:
+    """The poc's chat database module, keeping its Chroma database and embedding cache in a temporary directory"""
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv("OPENAI_API_KEY", ENV["OPENAI_API_KEY"])
+        patch.setenv("KB_DIR", str(tmp_path_factory.mktemp("kb")))
+        yield importlib.import_module("chat_db_helper")
+
+
+@pytest.fixture(scope="session")
+def build_index(chat_db_helper: Any) -> Iterator[Any]:
+    """The poc's index builder"""
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv("OPENAI_API_KEY", ENV["OPENAI_API_KEY"])
+        yield importlib.import_module("build_index")
+
+
+@pytest.fixture
+def redis_client() -> Iterator[redis.StrictRedis]:
+    """A client of the in-memory Redis, emptied after the test"""
+    client = fakeredis.FakeStrictRedis(server=REDIS_SERVER)
+    yield client
+    client.flushall()
+
+
+@pytest.fixture(params=["fakeredis", "redis"])
+def script_client(request: pytest.FixtureRequest) -> Iterator[redis.StrictRedis]:
+    """
+    A client for testing Lua scripts: of the in-memory Redis over RESP2 (over RESP3 fakeredis doesn't hand the replies
+    to scripts the way Redis does), and of the Redis server at REDIS_TEST_URL if any. That database is emptied!
+    """
+    if request.param == "fakeredis":
+        client = fakeredis.FakeStrictRedis(server=REDIS_SERVER, protocol=2)
+    else:
+        if "REDIS_TEST_URL" not in os.environ:
+            pytest.skip("REDIS_TEST_URL is not set")
+        client = redis.StrictRedis.from_url(os.environ["REDIS_TEST_URL"])
+        try:
+            client.flushdb()
+        except redis.exceptions.ConnectionError as e:
+            pytest.skip(f"Redis at REDIS_TEST_URL is not reachable: {e}")
+    yield client
+    client.flushdb()
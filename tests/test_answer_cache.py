@@ -0,0 +1,44 @@
+"""Test the semantic answer cache"""
+import time
+
+import pytest
+import redis
+from answer_cache import AnswerCache
+
+CHUNKS = ["blogs/a.md/1", "blogs/b.md/2"]
+
+
+def test_similar_question_same_chunks(redis_client: redis.StrictRedis) -> None:
+    """A similar question that retrieved the same chunks gets the cached answer, in any chunk order."""
+    cache = AnswerCache(redis_client, similarity=0.95, ttl=60)
+    cache.set([1.0, 0.0], CHUNKS, ["/uploads/blogs/a.md"], "answer")
+    assert cache.get([0.99, 0.05], list(reversed(CHUNKS))) == "answer"
+
+
+def test_different_question_or_chunks(redis_client: redis.StrictRedis) -> None:
+    """A different question, or the same question with other chunks, is a miss."""
+    cache = AnswerCache(redis_client, similarity=0.95, ttl=60)
+    cache.set([1.0, 0.0], CHUNKS, ["/uploads/blogs/a.md"], "answer")
+    assert cache.get([0.0, 1.0], CHUNKS) is None
+    assert cache.get([1.0, 0.0], CHUNKS[:1]) is None
+
+
+def test_answers_expire_in_a_busy_bucket(redis_client: redis.StrictRedis, monkeypatch: pytest.MonkeyPatch) -> None:
+    """An answer expires after the TTL even when newer answers keep the bucket alive."""
+    cache = AnswerCache(redis_client, similarity=0.95, ttl=60)
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+    cache.set([1.0, 0.0], CHUNKS, [], "old answer")
+    monkeypatch.setattr(time, "time", lambda: now + 50)
+    cache.set([0.0, 1.0], CHUNKS, [], "new answer")
+    monkeypatch.setattr(time, "time", lambda: now + 70)
+    assert cache.get([1.0, 0.0], CHUNKS) is None
+    assert cache.get([0.0, 1.0], CHUNKS) == "new answer"
+
+
+def test_invalidate_cited_document(redis_client: redis.StrictRedis) -> None:
+    """Re-ingesting a document drops the answers that cited it."""
+    cache = AnswerCache(redis_client, similarity=0.95, ttl=60)
+    cache.set([1.0, 0.0], CHUNKS, ["/uploads/blogs/a.md"], "answer")
+    assert cache.invalidate(["/uploads/blogs/a.md"]) == 1
+    assert cache.get([1.0, 0.0], CHUNKS) is None
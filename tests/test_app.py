@@ -0,0 +1,162 @@
+"""Test the backend's endpoints"""
+import json
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import openai
+import pytest
+from minio.error import S3Error
+
+EMBEDDING = [1.0, 0.0]
+CHUNK_IDS = ["/uploads/blog/a.md/0", "/uploads/blog/b.md/3"]
+
+
+class FakeCompletions:
+    """Chat completions of the answer, or of its tokens when streamed, failing with error after them if it is set"""
+
+    def __init__(self, tokens: List[Optional[str]]) -> None:
+        """Initialize the completions."""
+        self.tokens = tokens
+        self.error: Optional[Exception] = None
+        self.requests = 0
+
+    def create(self, stream: bool = False, **_: Any) -> Any:
+        """A completion, or an iterator of completion chunks"""
+        self.requests += 1
+        if not stream:
+            if self.error:
+                raise self.error
+            content = "".join(token or "" for token in self.tokens) or None
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=None)
+        return self.chunks()
+
+    def chunks(self) -> Iterator[Any]:
+        """The streamed completion"""
+        for token in self.tokens:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=token))], usage=None)
+        if self.error:
+            raise self.error
+
+
+def events(response: Any) -> List[Tuple[Optional[str], Any]]:
+    """The (event, data) server-sent events of a response"""
+    parsed: List[Tuple[Optional[str], Any]] = []
+    for message in response.get_data(as_text=True).split("\n\n")[:-1]:
+        fields = dict(line.split(": ", 1) for line in message.split("\n"))
+        parsed.append((fields.get("event"), json.loads(fields["data"])))
+    return parsed
+
+
+@pytest.fixture
+def http(backend: Any, redis_client: Any) -> Any:
+    """A test client of the backend, on a clean Redis"""
+    return backend.app.test_client()
+
+
+@pytest.fixture
+def completions(backend: Any, monkeypatch: pytest.MonkeyPatch) -> FakeCompletions:
+    """Completions of the answer "Hello world", for a question that retrieves CHUNK_IDS"""
+    results: Dict[str, List[Any]] = {
+        "ids": [CHUNK_IDS],
+        "metadatas": [[{"path": "/uploads/blog/a.md", "text": "a"}, {"path": "/uploads/blog/b.md", "text": "b"}]],
+        "distances": [[0.1, 0.2]],
+    }
+    monkeypatch.setattr(backend, "get_embedding", lambda _question: EMBEDDING)
+    monkeypatch.setattr(backend, "get_embeddings", lambda questions: [EMBEDDING for _ in questions])
+    monkeypatch.setattr(
+        backend, "query_chunks", lambda embeddings: {k: v * len(embeddings) for k, v in results.items()}
+    )
+    fake = FakeCompletions(["Hello", " world"])
+    monkeypatch.setattr(backend, "client", SimpleNamespace(chat=SimpleNamespace(completions=fake)))
+    return fake
+
+
+def test_ingest_batch(backend: Any, http: Any, redis_client: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Files are queued in the lane of their size, and to the bulk lane when their folder can't be listed."""
+
+    def list_objects(_bucket: str, prefix: str) -> Iterator[Any]:
+        if prefix == "uploads/missing/":
+            raise S3Error(
+                code="NoSuchBucket", message="gone", resource=prefix, request_id="", host_id="", response=None
+            )
+        yield SimpleNamespace(object_name="/uploads/blog/small.md", size=100)
+        yield SimpleNamespace(object_name="/uploads/blog/large.md", size=10**6)
+
+    monkeypatch.setattr(backend.minio_client, "list_objects", list_objects)
+    paths = ["blog/small.md", "blog/large.md", "missing/a.md", "blog/image.png"]
+    response = http.post("/ingest/batch", json={"paths": paths})
+    assert response.status_code == 200
+    results: List[Any] = response.get_json()["results"]
+    assert [result.get("lane") for result in results] == ["small", "bulk", "bulk", None]
+    assert [result["path"] for result in results[:3]] == [
+        "/uploads/blog/small.md",
+        "/uploads/blog/large.md",
+        "/uploads/missing/a.md",
+    ]
+    assert "error" in results[3]
+    queued = {
+        (lane, folder): redis_client.xlen(backend.ingest_queue.stream_key(lane, folder))
+        for lane, folder in [("small", "blog"), ("bulk", "blog"), ("bulk", "missing")]
+    }
+    assert queued == {("small", "blog"): 1, ("bulk", "blog"): 1, ("bulk", "missing"): 1}
+
+
+def test_ingest_batch_rejects(http: Any) -> None:
+    """A batch that isn't a list of paths, or with an unknown priority, is rejected with a JSON error."""
+    response = http.post("/ingest/batch", json={"path": "blog/a.md"})
+    assert response.status_code == 422
+    assert response.get_json()["name"] == "Unprocessable Entity"
+    assert http.post("/ingest/batch", json={"paths": [], "priority": "urgent"}).status_code == 422
+
+
+def test_chat_caches_answer(backend: Any, http: Any, redis_client: Any, completions: FakeCompletions) -> None:
+    """An answer is cached for the next similar question, an empty one isn't."""
+    completions.tokens = [None]
+    assert http.post("/chat", json={"question": "hi"}).get_json() == {"answer": None}
+    assert not redis_client.exists(backend.answer_cache.bucket_key(CHUNK_IDS))
+    completions.tokens = ["Hello", " world"]
+    assert http.post("/chat", json={"question": "hi"}).get_json() == {"answer": "Hello world"}
+    assert http.post("/chat", json={"question": "hi"}).get_json() == {"answer": "Hello world"}
+    assert completions.requests == 2
+
+
+def test_chat_stream(http: Any, completions: FakeCompletions) -> None:
+    """The sources come first, then the tokens as they are generated, then the end of the answer, which is cached."""
+    response = http.post("/chat", json={"question": "hi"}, headers={"Accept": "text/event-stream"})
+    assert response.mimetype == "text/event-stream"
+    assert response.headers["X-Accel-Buffering"] == "no"
+    sources = [
+        {"id": CHUNK_IDS[0], "path": "/uploads/blog/a.md", "distance": 0.1},
+        {"id": CHUNK_IDS[1], "path": "/uploads/blog/b.md", "distance": 0.2},
+    ]
+    assert events(response) == [
+        ("metadata", {"sources": sources, "cached": False}),
+        (None, {"token": "Hello"}),
+        (None, {"token": " world"}),
+        ("done", {}),
+    ]
+    assert events(http.post("/chat/stream", json={"question": "hi"})) == [
+        ("metadata", {"sources": sources, "cached": True}),
+        (None, {"token": "Hello world"}),
+        ("done", {}),
+    ]
+    assert completions.requests == 1
+
+
+def test_chat_stream_error(backend: Any, http: Any, redis_client: Any, completions: FakeCompletions) -> None:
+    """A completion that fails midway ends the stream with an error event, and the partial answer isn't cached."""
+    completions.error = openai.OpenAIError("connection reset")
+    received = events(http.post("/chat/stream", json={"question": "hi"}))
+    assert [event for event, _ in received] == ["metadata", None, None, "error"]
+    assert received[-1][1] == {"description": "connection reset"}
+    assert not redis_client.exists(backend.answer_cache.bucket_key(CHUNK_IDS))
+
+
+def test_chat_batch(http: Any, completions: FakeCompletions) -> None:
+    """Each valid question gets an answer, in the order of the questions, and the others an error."""
+    completions.tokens = ["Hello"]
+    response = http.post("/chat/batch", json={"questions": ["hi", " ", 3, "hello"]})
+    results = response.get_json()["results"]
+    assert [result.get("answer") for result in results] == ["Hello", None, None, "Hello"]
+    assert [("error" in result) for result in results] == [False, True, True, False]
+    assert http.post("/chat/batch", json={"question": "hi"}).status_code == 422
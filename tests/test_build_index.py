@@ -0,0 +1,55 @@
+"""Test rebuilding the poc's chat collection and swapping it in"""
+from typing import Any, Iterator, List
+
+import pytest
+
+
+@pytest.fixture
+def kb(chat_db_helper: Any, tmp_path: Any, monkeypatch: pytest.MonkeyPatch) -> Any:
+    """An empty Chroma database and aliases file"""
+    monkeypatch.setattr(chat_db_helper, "KB_DIR", str(tmp_path))
+    monkeypatch.setattr(chat_db_helper, "ALIASES_FILE", str(tmp_path / "aliases.json"))
+    return chat_db_helper
+
+
+def chats(kb: Any, count: int) -> List[Any]:
+    """Chats with their summary and an embedding of their own"""
+    return [
+        kb.Chat(thread_id=f"t{i}", text=f"chat {i}", summary=f"summary {i}", embedding=[float(i), 1.0])
+        for i in range(count)
+    ]
+
+
+def test_rebuild_flips_alias(build_index: Any, kb: Any) -> None:
+    """A rebuild is served once it is validated, the collection it replaced is kept and older ones are deleted."""
+    serving = kb.ChatVectorDB()
+    serving.add(chats(kb, 3))
+    assert serving.collection_name == "chats-01"  # the version's own collection before any rebuild
+    build_index.rebuild(chats(kb, 4), expected_count=4, serving=serving)
+    first = kb.read_aliases()["chats"]
+    assert first.startswith("chats-01-")
+    assert serving.collection_name == "chats-01"  # until its next search follows the alias
+    serving._follow_alias()
+    assert (serving.collection_name, serving.collection.count()) == (first, 4)
+
+    build_index.rebuild(chats(kb, 5), expected_count=5, serving=serving)
+    second = kb.read_aliases()["chats"]
+    assert second != first
+    assert sorted(c.name for c in serving.client.list_collections()) == sorted([first, second])
+
+
+@pytest.mark.parametrize("failure", ["count", "chats"])
+def test_failed_rebuild_keeps_alias(build_index: Any, kb: Any, failure: str) -> None:
+    """A rebuild that fails to validate or to read its chats leaves the alias on the current collection."""
+
+    def failing_chats() -> Iterator[Any]:
+        yield from chats(kb, 2)
+        raise OSError("chats.csv is truncated")
+
+    serving = kb.ChatVectorDB()
+    serving.add(chats(kb, 3))
+    with pytest.raises(ValueError if failure == "count" else OSError):
+        build_index.rebuild(chats(kb, 3) if failure == "count" else failing_chats(), expected_count=4, serving=serving)
+    assert kb.read_aliases() == {}
+    serving._follow_alias()
+    assert (serving.collection_name, serving.collection.count()) == ("chats-01", 3)
@@ -0,0 +1,68 @@
+"""Test loading the poc's chats into Chroma"""
+import uuid
+from typing import Any, List
+
+import pytest
+
+
+@pytest.fixture
+def chat_vector_db(chat_db_helper: Any) -> Any:
+    """A ChatVectorDB on a collection of its own"""
+    return chat_db_helper.ChatVectorDB(f"chats-test-{uuid.uuid4().hex[:6]}")
+
+
+def chats(chat_db_helper: Any, count: int, embedded: bool = True) -> List[Any]:
+    """Chats with their summary, and their embedding unless it is to be computed"""
+    return [
+        chat_db_helper.Chat(
+            thread_id=f"t{i}", text=f"chat {i}", summary=f"summary {i}", embedding=[float(i), 1.0] if embedded else None
+        )
+        for i in range(count)
+    ]
+
+
+def test_add_in_batches(chat_db_helper: Any, chat_vector_db: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Chats are upserted in batches of at most Chroma's max batch size."""
+    monkeypatch.setattr(chat_vector_db.client, "get_max_batch_size", lambda: 3)
+    upserts: List[List[str]] = []
+    upsert = chat_vector_db.collection.upsert
+
+    def recording_upsert(ids: List[str], **kwargs: Any) -> None:
+        upserts.append(ids)
+        upsert(ids=ids, **kwargs)
+
+    monkeypatch.setattr(chat_vector_db.collection, "upsert", recording_upsert)
+    chat_vector_db.add(chats(chat_db_helper, 7), batch_size=5)
+    assert [len(ids) for ids in upserts] == [3, 3, 1]
+    assert chat_vector_db.collection.count() == 7
+
+
+def test_resume_skips_loaded_chats(chat_db_helper: Any, chat_vector_db: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    """A load run again after an interruption only embeds the chats that weren't loaded."""
+    chat_vector_db.add(chats(chat_db_helper, 4), batch_size=2)
+    embedded: List[str] = []
+
+    def get_embedding(text: str) -> List[float]:
+        embedded.append(text)
+        return [0.0, 0.0]
+
+    monkeypatch.setattr(chat_db_helper, "get_embedding", get_embedding)
+    chat_vector_db.add(chats(chat_db_helper, 6, embedded=False), batch_size=2)
+    assert embedded == ["chat 4", "chat 5"]
+    stored = chat_vector_db.collection.get(ids=["t0", "t5"], include=["embeddings"])
+    assert [list(e) for e in stored["embeddings"]] == [[0.0, 1.0], [0.0, 0.0]]
+
+
+def test_search_only_embeds_question(chat_db_helper: Any, chat_vector_db: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Found chats come with their summary and Chroma's embedding, only the question is embedded."""
+    chat_vector_db.add(chats(chat_db_helper, 3))
+    embedded: List[str] = []
+
+    def get_embedding(text: str) -> List[float]:
+        embedded.append(text)
+        return [2.0, 1.0]
+
+    monkeypatch.setattr(chat_db_helper, "get_embedding", get_embedding)
+    (chat, distance), _ = chat_vector_db.search_index("question", k=2, with_embeddings=True)
+    assert (chat.thread_id, chat.summary, list(chat.embedding), distance) == ("t2", "summary 2", [2.0, 1.0], 0.0)
+    assert embedded == ["question"]
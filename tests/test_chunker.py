@@ -0,0 +1,72 @@
+"""Test the chunkers of the ingest worker"""
+from typing import List
+
+from chunker import MarkdownChunker, ParagraphChunker, estimate_tokens, split_long
+
+
+def lines_of(document: str) -> List[str]:
+    """The document as the worker reads it, line by line"""
+    return document.splitlines(keepends=True)
+
+
+def test_split_long_keeps_lines() -> None:
+    """A code block over the limit is split between its lines, which keep their indentation."""
+    code = "\n".join(["```python", "def main():"] + [f"    print({i})  # line {i}" for i in range(40)] + ["```"])
+    pieces = split_long(code, 50)
+    assert len(pieces) > 1
+    assert all(estimate_tokens(piece) <= 50 for piece in pieces)
+    assert "\n".join(pieces) == code
+
+
+def test_split_long_keeps_list_items() -> None:
+    """A list over the limit is split between its items."""
+    items = [f"- item {i}: " + " ".join(["word"] * 5) for i in range(30)]
+    pieces = split_long("\n".join(items), 40)
+    assert [line for piece in pieces for line in piece.split("\n")] == items
+
+
+def test_split_long_line() -> None:
+    """A single line over the limit is split at sentences, then words, then characters."""
+    line = "This is a sentence. " * 20 + "word " * 100 + "x" * 200
+    pieces = split_long(line, 20)
+    assert all(estimate_tokens(piece) <= 21 for piece in pieces)
+    assert "".join(pieces).replace(" ", "") == line.replace(" ", "")
+    assert pieces[0].startswith("This is a sentence. This is a sentence.")
+
+
+def test_paragraph_chunker() -> None:
+    """One chunk per paragraph."""
+    document = "First paragraph\non two lines\n\n\nSecond paragraph\n"
+    assert list(ParagraphChunker().chunks(lines_of(document))) == ["First paragraph\non two lines", "Second paragraph"]
+
+
+def test_markdown_chunker_keeps_fences() -> None:
+    """Blank lines in a code block don't split it, and its lines are kept as they are."""
+    code = "```\nfirst()\n\n    second()\n```"
+    document = f"# Title\n\nSome text before the code.\n\n{code}\n"
+    chunks = list(MarkdownChunker(min_tokens=0).chunks(lines_of(document)))
+    assert chunks == [f"# Title\n\nSome text before the code.\n\n{code}"]
+
+
+def test_markdown_chunker_overlap() -> None:
+    """A chunk that continues a section starts with the section's headings and the end of the previous chunk."""
+    paragraphs = [f"Paragraph {i} " + " ".join(["text"] * 30) for i in range(6)]
+    document = "# Title\n\n## Section\n\n" + "\n\n".join(paragraphs)
+    chunks = list(MarkdownChunker(target_tokens=100, overlap_tokens=10, min_tokens=5).chunks(lines_of(document)))
+    assert len(chunks) > 1
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert chunk.startswith("# Title\n\n## Section\n\n")
+        overlap = chunk.split("\n\n")[2]
+        assert previous.endswith(overlap)
+        assert 0 < len(overlap) <= 40
+
+
+def test_markdown_chunker_merges_small_fragments() -> None:
+    """A heading isn't embedded on its own, even when the next block fills the chunk."""
+    block = " ".join(["text"] * 75)  # just under the target
+    document = f"# Title\n\n{block}\n\n## Small\n\nshort\n\n## Next\n\n{block}\n"
+    chunks = list(MarkdownChunker(target_tokens=100, overlap_tokens=0, min_tokens=20).chunks(lines_of(document)))
+    assert chunks == [
+        f"# Title\n\n{block}",
+        f"## Small\n\nshort\n\n## Next\n\n{block}",
+    ]
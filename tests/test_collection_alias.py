@@ -0,0 +1,99 @@
+"""Test reading the collection through its alias, and switching the backend's replica when it is flipped"""
+import time
+import uuid
+from typing import Any
+
+import chromadb
+import pytest
+import redis
+from collection_alias import CollectionAlias
+from vector_replica import AliasedReplica, VectorReplica
+
+
+@pytest.fixture
+def chroma_client() -> Any:
+    """An in-memory Chroma"""
+    return chromadb.EphemeralClient()
+
+
+@pytest.fixture
+def alias(redis_client: redis.StrictRedis, chroma_client: Any) -> CollectionAlias:
+    """An alias of its own, looked up on every read"""
+    return CollectionAlias(redis_client, chroma_client, f"blogs-{uuid.uuid4().hex[:6]}", refresh_interval=0)
+
+
+def test_alias_defaults_to_collection(alias: CollectionAlias) -> None:
+    """Until the alias is set, it is the name of the collection itself."""
+    assert alias.target() == alias.alias
+    assert alias.collection().name == alias.alias
+
+
+def test_alias_flip(alias: CollectionAlias, redis_client: redis.StrictRedis, monkeypatch: pytest.MonkeyPatch) -> None:
+    """A flipped alias is followed on the first read after the refresh interval."""
+    alias.refresh_interval = 5.0
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    assert alias.collection().name == alias.alias
+    redis_client.set(alias.key, "blogs-rebuilt")
+    assert alias.collection().name == alias.alias
+    monkeypatch.setattr(time, "monotonic", lambda: now + 5.0)
+    assert alias.collection().name == "blogs-rebuilt"
+
+
+def test_alias_without_redis(alias: CollectionAlias, monkeypatch: pytest.MonkeyPatch) -> None:
+    """The collection in use is kept while Redis is unreachable, and there is none before it was read once."""
+
+    def unreachable(_key: str) -> None:
+        raise redis.exceptions.ConnectionError("unreachable")
+
+    monkeypatch.setattr(alias.redis_client, "get", unreachable)
+    with pytest.raises(redis.exceptions.ConnectionError):
+        alias.collection()
+    monkeypatch.undo()
+    collection = alias.collection()
+    monkeypatch.setattr(alias.redis_client, "get", unreachable)
+    assert alias.collection() is collection
+
+
+def wait_for_switch(replicas: AliasedReplica, name: str, timeout: float = 5.0) -> None:
+    """Read the alias until the replica serves the collection"""
+    deadline = time.monotonic() + timeout
+    while replicas.current()[0].name != name:
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_replica_switches_once_loaded(
+    alias: CollectionAlias, chroma_client: Any, redis_client: redis.StrictRedis, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """After a flip, queries stay on the previous collection until the replica of the new one is loaded."""
+    replicas = AliasedReplica(alias, redis_client)
+    wait_for_switch(replicas, alias.alias)
+    rebuilt = chroma_client.create_collection(f"{alias.alias}-rebuilt").name
+    redis_client.set(alias.key, rebuilt)
+    load = VectorReplica.load
+    loading = True
+
+    def slow_load(self: VectorReplica) -> None:
+        while loading:
+            time.sleep(0.01)
+        load(self)
+
+    monkeypatch.setattr(VectorReplica, "load", slow_load)
+    collection, replica = replicas.current()
+    assert (collection.name, replica.collection.name) == (alias.alias, alias.alias)
+    loading = False
+    wait_for_switch(replicas, rebuilt)
+    assert replicas.current()[1].fresh()
+    replicas.replica.stop()
+
+
+def test_disabled_replica_switches_at_once(
+    alias: CollectionAlias, chroma_client: Any, redis_client: redis.StrictRedis
+) -> None:
+    """Without replicas, queries go to the collection the alias points at as soon as it is flipped."""
+    replicas = AliasedReplica(alias, redis_client, enabled=False)
+    rebuilt = chroma_client.create_collection(f"{alias.alias}-rebuilt").name
+    redis_client.set(alias.key, rebuilt)
+    collection, replica = replicas.current()
+    assert (collection.name, replica.fresh()) == (rebuilt, False)
@@ -0,0 +1,59 @@
+"""Test the batching of embedding requests in the ingest worker"""
+from typing import Any, List
+
+import openai
+import pytest
+import redis
+
+
+def test_batch_texts_item_limit(mq: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Batches hold at most EMBEDDING_BATCH_SIZE texts."""
+    monkeypatch.setattr(mq, "EMBEDDING_BATCH_SIZE", 3)
+    assert list(mq.batch_texts(["a"] * 7)) == [[0, 1, 2], [3, 4, 5], [6]]
+
+
+def test_batch_texts_token_limit(mq: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Batches stay under EMBEDDING_BATCH_TOKENS, a text over the limit gets a batch of its own."""
+    monkeypatch.setattr(mq, "EMBEDDING_BATCH_TOKENS", 10)
+    texts = ["x" * 16, "x" * 16, "x" * 100, "x"]  # 5, 5, 26 and 1 tokens
+    assert list(mq.batch_texts(texts)) == [[0, 1], [2], [3]]
+
+
+def test_batch_texts_empty(mq: Any) -> None:
+    """No texts, no batches."""
+    assert not list(mq.batch_texts([]))
+
+
+def fake_embed_batch(calls: List[List[str]]) -> Any:
+    """embed_batch that records its inputs, and rejects the batches with a text starting with "bad" """
+
+    def embed_batch(texts: List[str]) -> List[List[float]]:
+        calls.append(texts)
+        if any(text.startswith("bad") for text in texts):
+            raise openai.OpenAIError("invalid input")
+        return [[float(len(text)), 1.0] for text in texts]
+
+    return embed_batch
+
+
+def test_get_embeddings_isolates_rejected_input(
+    mq: Any, monkeypatch: pytest.MonkeyPatch, redis_client: redis.StrictRedis
+) -> None:
+    """A rejected batch is split until the rejected input is alone, the others are still embedded."""
+    calls: List[List[str]] = []
+    monkeypatch.setattr(mq, "embed_batch", fake_embed_batch(calls))
+    texts = ["a", "bb", "bad", "cccc"]
+    embeddings = mq.get_embeddings(texts)
+    assert embeddings == [[1.0, 1.0], [2.0, 1.0], None, [4.0, 1.0]]
+    assert calls[0] == texts
+    assert ["bad"] in calls
+
+
+def test_get_embeddings_uses_cache(mq: Any, monkeypatch: pytest.MonkeyPatch, redis_client: redis.StrictRedis) -> None:
+    """Texts embedded before are not sent again."""
+    calls: List[List[str]] = []
+    monkeypatch.setattr(mq, "embed_batch", fake_embed_batch(calls))
+    mq.get_embeddings(["a", "bb"])
+    calls.clear()
+    assert mq.get_embeddings(["bb", "ccc"]) == [[2.0, 1.0], [3.0, 1.0]]
+    assert calls == [["ccc"]]
@@ -0,0 +1,54 @@
+"""Test the poc's columnar store of precomputed embeddings"""
+import json
+from typing import Any
+
+import embedding_store
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def write_csv(tmp_path: Any, rows: Any) -> str:
+    """An embeddings CSV like chats-embeddings-ada-002.csv, of (thread_id, embedding) rows"""
+    path = tmp_path / "embeddings.csv"
+    pd.DataFrame(
+        {"thread_id": [thread_id for thread_id, _ in rows], "embedding": [json.dumps(e) for _, e in rows]}
+    ).to_csv(path, index=False)
+    return str(path)
+
+
+def test_convert_and_lookup(tmp_path: Any) -> None:
+    """Chats find the vector computed from their text, whatever the chunks the CSV was read in."""
+    chats = pd.DataFrame({"thread_id": ["t1", "t2", "t3"], "chat_text": ["one", "two", "three"]})
+    csv = write_csv(tmp_path, [("t1", [1.0, 0.0]), ("t2", [0.0, 1.0]), ("t3", [1.0, 1.0]), ("t9", [9.0, 9.0])])
+    store_dir = str(tmp_path / "store")
+    assert not embedding_store.exists(store_dir)
+    embedding_store.convert(csv, chats, store_dir, chunksize=3)
+    assert embedding_store.exists(store_dir)
+
+    table, vectors = embedding_store.load(store_dir)
+    assert vectors.dtype == np.float32
+    assert vectors.shape == (4, 2)
+    assert table["content_hash"].iloc[3] == ""  # a chat we don't have
+
+    rows = embedding_store.lookup(table, chats.iloc[::-1])
+    assert rows.tolist() == [2, 1, 0]
+    assert vectors[rows].tolist() == [[1.0, 1.0], [0.0, 1.0], [1.0, 0.0]]
+
+
+def test_lookup_changed_text(tmp_path: Any) -> None:
+    """A chat whose text changed since its embedding was computed has none, and the last of duplicates wins."""
+    chats = pd.DataFrame({"thread_id": ["t1", "t2"], "chat_text": ["one", "two"]})
+    csv = write_csv(tmp_path, [("t1", [1.0]), ("t2", [2.0]), ("t2", [3.0])])
+    embedding_store.convert(csv, chats, str(tmp_path))
+    table, _ = embedding_store.load(str(tmp_path))
+    changed = pd.DataFrame({"thread_id": ["t1", "t2", "t3"], "chat_text": ["one edited", "two", "three"]})
+    assert embedding_store.lookup(table, changed).tolist() == [-1, 2, -1]
+
+
+def test_convert_empty_csv(tmp_path: Any) -> None:
+    """An empty CSV is not converted into an empty store."""
+    csv = write_csv(tmp_path, [])
+    with pytest.raises(ValueError):
+        embedding_store.convert(csv, pd.DataFrame({"thread_id": [], "chat_text": []}), str(tmp_path / "store"))
+    assert not embedding_store.exists(str(tmp_path / "store"))
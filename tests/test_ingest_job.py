@@ -0,0 +1,46 @@
+"""Test the status records of ingest jobs"""
+import pytest
+import redis
+from ingest_job import IngestJob
+
+
+def test_progress(redis_client: redis.StrictRedis) -> None:
+    """Progress is the share of the new chunks written so far, and 1 once the job is done."""
+    job = IngestJob(redis_client, "u1")
+    assert job.get() is None
+    job.update(state="queued", lane="bulk")
+    assert job.get() == {
+        "upload_id": "u1",
+        "state": "queued",
+        "lane": "bulk",
+        "stages": {},
+        "updated_at": pytest.approx(job.get()["updated_at"]),  # type: ignore[index]
+        "progress": 0.0,
+    }
+    job.update(state="embedding", attempt=1, chunks_read=0, chunks_new=0, chunks_written=0)
+    job.add(chunks_read=10, chunks_new=8)
+    job.add(chunks_written=3)
+    job.add_time("embed", 0.25)
+    job.add_time("embed", 0.5)
+    record = job.get()
+    assert record is not None
+    assert (record["attempt"], record["chunks_read"], record["chunks_new"]) == (1, 10, 8)
+    assert record["progress"] == 0.375
+    assert record["stages"] == {"embed": 0.75}
+    job.update(state="done")
+    assert job.get()["progress"] == 1.0  # type: ignore[index]
+
+
+def test_unknown_state(redis_client: redis.StrictRedis) -> None:
+    """A typo in a state is not recorded."""
+    with pytest.raises(ValueError):
+        IngestJob(redis_client, "u1").update(state="finished")
+    assert IngestJob(redis_client, "u1").get() is None
+
+
+def test_expires_after_last_update(redis_client: redis.StrictRedis) -> None:
+    """The record expires ttl seconds after its last update."""
+    job = IngestJob(redis_client, "u1", ttl=60)
+    job.update(state="queued")
+    job.add(chunks_new=1)
+    assert 0 < redis_client.ttl(job.key) <= 60
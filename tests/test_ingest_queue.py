@@ -0,0 +1,74 @@
+"""Test the scheduling of the ingest queue's lanes and folders"""
+import random
+from collections import Counter
+from typing import List
+
+import pytest
+import redis
+from ingest_queue import IngestQueue
+
+
+def dequeue_all(ingest_queue: IngestQueue) -> List[str]:
+    """lane/folder/request of every entry, in the order a consumer reads them"""
+    order = []
+    while entry := ingest_queue.dequeue("worker-0"):
+        stream, _, fields = entry
+        lane, folder = stream.decode("utf-8").split(":")[2:]
+        order.append(f"{lane}/{folder}/{fields[b'data'].decode('utf-8')}")
+    return order
+
+
+def test_folders_round_robin(script_client: redis.StrictRedis) -> None:
+    """The folders of a lane take turns, so that a bulk load of one folder doesn't hold back the others."""
+    ingest_queue = IngestQueue(script_client, {"bulk": 1})
+    for i in range(3):
+        ingest_queue.enqueue("bulk", "big", f"{i}")
+    ingest_queue.enqueue("bulk", "small", "0")
+    assert dequeue_all(ingest_queue) == ["bulk/big/0", "bulk/small/0", "bulk/big/1", "bulk/big/2"]
+    assert ingest_queue.depth() == 4  # in flight until acked
+    assert not script_client.exists("ingest:ready:bulk")
+
+
+def test_drained_folder_ready_again(script_client: redis.StrictRedis) -> None:
+    """A folder whose stream was drained is read again when a request is queued for it."""
+    ingest_queue = IngestQueue(script_client, {"interactive": 1})
+    ingest_queue.enqueue("interactive", "blogs", "0")
+    assert dequeue_all(ingest_queue) == ["interactive/blogs/0"]
+    ingest_queue.enqueue("interactive", "blogs", "1")
+    assert dequeue_all(ingest_queue) == ["interactive/blogs/1"]
+
+
+def test_lanes_in_proportion_to_weight(script_client: redis.StrictRedis, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Each lane is read first in proportion to its weight, and an empty lane gives way to the others."""
+    monkeypatch.setattr(random, "random", random.Random(0).random)
+    ingest_queue = IngestQueue(script_client, {"interactive": 8, "small": 3, "bulk": 1})
+    for i in range(600):
+        for lane in ("interactive", "small", "bulk"):
+            ingest_queue.enqueue(lane, "blogs", f"{i}")
+    order = dequeue_all(ingest_queue)
+    assert len(order) == 1800
+    first = Counter(entry.split("/")[0] for entry in order[:600])
+    assert first["interactive"] / 600 == pytest.approx(8 / 12, abs=0.05)
+    assert first["small"] / 600 == pytest.approx(3 / 12, abs=0.05)
+    assert first["bulk"] / 600 == pytest.approx(1 / 12, abs=0.05)
+
+
+def test_empty_lanes_give_way(script_client: redis.StrictRedis) -> None:
+    """Requests of a light lane are read right away when the heavier lanes are empty."""
+    ingest_queue = IngestQueue(script_client, {"interactive": 1000, "bulk": 1})
+    ingest_queue.enqueue("bulk", "blogs", "0")
+    assert dequeue_all(ingest_queue) == ["bulk/blogs/0"]
+    assert ingest_queue.dequeue("worker-0") is None
+
+
+def test_enqueue(script_client: redis.StrictRedis) -> None:
+    """Requests go to the stream of their lane and folder, which is counted in the depth until it is acked."""
+    ingest_queue = IngestQueue(script_client)
+    ingest_queue.enqueue("bulk", "blogs", "{}")
+    ingest_queue.enqueue("bulk", "blogs", "{}")
+    ingest_queue.enqueue("interactive", "docs", "{}")
+    assert ingest_queue.streams() == [b"ingest:stream:bulk:blogs", b"ingest:stream:interactive:docs"]
+    assert ingest_queue.depth() == 3
+    assert script_client.lrange("ingest:ready:bulk", 0, -1) == [b"blogs"]
+    with pytest.raises(ValueError):
+        ingest_queue.enqueue("urgent", "blogs", "{}")
@@ -0,0 +1,137 @@
+"""Test the acks, retries, heartbeats, locks and change notifications of the ingest worker"""
+import json
+import time
+from typing import Any
+
+import pytest
+import redis
+from minio.error import S3Error
+
+STREAM = b"ingest:stream:interactive:blogs"
+
+
+def deliver(mq: Any, redis_client: redis.StrictRedis, consumer: str) -> bytes:
+    """Add an entry to the stream and read it as the consumer, returns its id"""
+    redis_client.xgroup_create(STREAM, mq.INGEST_GROUP, id="0", mkstream=True)
+    redis_client.xadd(STREAM, {"data": "{}"})
+    entries = redis_client.xreadgroup(mq.INGEST_GROUP, consumer, {STREAM: ">"}, count=1)
+    msg_id: bytes = entries[0][1][0][0]
+    return msg_id
+
+
+def idle_ms(mq: Any, redis_client: redis.StrictRedis, msg_id: bytes) -> int:
+    """Time since the entry was last delivered or claimed"""
+    pending = redis_client.xpending_range(STREAM, mq.INGEST_GROUP, min=msg_id, max=msg_id, count=1)
+    idle: int = pending[0]["time_since_delivered"]
+    return idle
+
+
+def test_retry_backoff_doubles_up_to_max(mq: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Retries wait twice as long every time, up to INGEST_RETRY_MAX_MS."""
+    monkeypatch.setattr(mq, "INGEST_RETRY_BASE_MS", 100)
+    monkeypatch.setattr(mq, "INGEST_RETRY_MAX_MS", 500)
+    assert [mq.retry_backoff_ms(deliveries) for deliveries in range(1, 6)] == [100, 200, 400, 500, 500]
+
+
+def test_heartbeat_keeps_entry_claimed(
+    mq: Any, monkeypatch: pytest.MonkeyPatch, redis_client: redis.StrictRedis
+) -> None:
+    """An entry being ingested never gets idle long enough to be reclaimed, and its delivery count doesn't grow."""
+    monkeypatch.setattr(mq, "INGEST_HEARTBEAT_MS", 20)
+    msg_id = deliver(mq, redis_client, "worker-0")
+    with mq.Heartbeat(redis_client, STREAM, msg_id, "worker-0"):
+        time.sleep(0.3)
+        assert idle_ms(mq, redis_client, msg_id) < 200
+    pending = redis_client.xpending_range(STREAM, mq.INGEST_GROUP, min=msg_id, max=msg_id, count=1)
+    assert pending[0]["consumer"] == b"worker-0"
+    assert pending[0]["times_delivered"] == 1
+
+
+def test_reclaim_lost_entry(mq: Any, monkeypatch: pytest.MonkeyPatch, redis_client: redis.StrictRedis) -> None:
+    """An entry without a heartbeat for INGEST_CLAIM_IDLE_MS is claimed by another consumer."""
+    monkeypatch.setattr(mq, "INGEST_CLAIM_IDLE_MS", 50)
+    monkeypatch.setattr(mq.ingest_queue, "streams", lambda: [STREAM])
+    msg_id = deliver(mq, redis_client, "worker-0")
+    assert mq.reclaim(redis_client, "worker-1") is None
+    time.sleep(0.1)
+    stream, claimed_id, fields, deliveries = mq.reclaim(redis_client, "worker-1")
+    assert (stream, claimed_id, fields, deliveries) == (STREAM, msg_id, {b"data": b"{}"}, 2)
+
+
+def test_fail_dead_letters_after_max_deliveries(mq: Any, redis_client: redis.StrictRedis) -> None:
+    """The last failed delivery moves the entry to the dead letter stream."""
+    msg_id = deliver(mq, redis_client, "worker-0")
+    mq.fail(redis_client, STREAM, msg_id, {b"data": b"{}"}, mq.INGEST_MAX_DELIVERIES, "boom")
+    assert redis_client.xlen(STREAM) == 0
+    (_, dead_letter), *_ = redis_client.xrange(mq.INGEST_DEAD_LETTER_STREAM)
+    assert dead_letter[b"id"] == msg_id
+    assert dead_letter[b"error"] == b"boom"
+    assert dead_letter[b"data"] == b"{}"
+
+
+def test_heartbeat_extends_lock(mq: Any, monkeypatch: pytest.MonkeyPatch, redis_client: redis.StrictRedis) -> None:
+    """The lock on the document lasts as long as the heartbeat, and is released after the ingest."""
+    monkeypatch.setattr(mq, "INGEST_CLAIM_IDLE_MS", 100)
+    msg_id = deliver(mq, redis_client, "worker-0")
+    heartbeat = mq.Heartbeat(redis_client, STREAM, msg_id, "worker-0")
+    mq.lock_path(redis_client, {"upload_id": "u1", "path": "blogs/a.md"}, heartbeat)
+    key, _ = heartbeat.lock
+    for _ in range(3):
+        time.sleep(0.05)
+        heartbeat.beat()
+    assert redis_client.pttl(key) > 50
+    mq.unlock_path(redis_client, heartbeat)
+    assert not redis_client.exists(key)
+
+
+def test_lock_waits_for_earlier_delivery(
+    mq: Any, monkeypatch: pytest.MonkeyPatch, redis_client: redis.StrictRedis
+) -> None:
+    """A redelivered copy of a request doesn't get in while the lock of its earlier delivery is alive."""
+    request_obj = {"upload_id": "u1", "path": "blogs/a.md"}
+    msg_id = deliver(mq, redis_client, "worker-0")
+    first = mq.Heartbeat(redis_client, STREAM, msg_id, "worker-0")
+    mq.lock_path(redis_client, request_obj, first)
+    waits = []
+
+    def sleep(seconds: float) -> None:
+        waits.append(seconds)
+        redis_client.delete(first.lock[0])  # the first consumer died, its lock expires
+
+    monkeypatch.setattr(mq.time, "sleep", sleep)
+    second = mq.Heartbeat(redis_client, STREAM, msg_id, "worker-1")
+    mq.lock_path(redis_client, request_obj, second)
+    assert waits == [1]
+    assert second.lock != first.lock
+    assert redis_client.get(second.lock[0]).decode("utf-8") == second.lock[1]
+
+
+@pytest.mark.parametrize("code, error", [("NoSuchKey", "DocumentMissing"), ("SlowDown", "S3Error")])
+def test_ingest_s3_errors(
+    mq: Any, monkeypatch: pytest.MonkeyPatch, redis_client: redis.StrictRedis, code: str, error: str
+) -> None:
+    """Only a missing document fails for good, the other S3 errors are retried."""
+
+    def stat_object(bucket_name: str, path: str) -> None:
+        raise S3Error(code=code, message=code, resource=path, request_id="", host_id="", response=None)
+
+    monkeypatch.setattr(mq.minio_client, "stat_object", stat_object)
+    monkeypatch.setattr(mq.collection_alias, "collection", lambda: None)
+    request_obj = {"upload_id": "u1", "bucket_name": "data", "path": "blogs/a.md"}
+    heartbeat = mq.Heartbeat(redis_client, STREAM, b"0-1", "worker-0")
+    with pytest.raises(getattr(mq, error)):
+        mq.ingest(request_obj, mq.IngestJob(redis_client, "u1"), heartbeat)
+    assert not redis_client.exists(f"{mq.INGEST_LOCKS}:blogs/a.md")
+
+
+def test_notify_change_publishes_versions_in_order(mq: Any, redis_client: redis.StrictRedis) -> None:
+    """Every change gets the next version of the collection, published in order."""
+    collection = mq.collection_alias.collection()
+    pubsub = redis_client.pubsub()
+    pubsub.subscribe(f"{collection.name}:changes")
+    pubsub.get_message(timeout=1)  # subscribed
+    for path in ["blogs/a.md", "blogs/b.md"]:
+        mq.notify_change(collection, path)
+    changes = [json.loads(pubsub.get_message(timeout=1)["data"]) for _ in range(2)]
+    assert changes == [{"path": "blogs/a.md", "version": 1}, {"path": "blogs/b.md", "version": 2}]
+    assert redis_client.get(f"{collection.name}:version") == b"2"
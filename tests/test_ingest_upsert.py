@@ -0,0 +1,212 @@
+"""Test the chunking, embedding and writing of a document by the ingest worker"""
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+from uuid import uuid4
+
+import chromadb
+import pytest
+import redis
+
+
+def slow_lines(count: int, seconds: float) -> Iterator[str]:
+    """Lines that take a while to fetch"""
+    for i in range(count):
+        time.sleep(seconds)
+        yield f"line {i}"
+
+
+def test_chunk_time_excludes_fetch(mq: Any, redis_client: redis.StrictRedis) -> None:
+    """The chunk stage doesn't count the time spent fetching the lines that the chunker pulls."""
+    job = mq.IngestJob(redis_client, "u1")
+    fetched = mq.Stopwatch(slow_lines(5, 0.05))
+    assert len(list(mq.timed(mq.chunker.chunks(fetched), "chunk", job, inner=fetched))) == 1
+    assert fetched.seconds >= 0.25
+    assert job.get()["stages"]["chunk"] < 0.05
+
+
+CONTEXT = {"upload_id": "u1", "bucket_name": "data", "folder": "blogs", "filename": "a.md", "path": "blogs/a.md"}
+
+
+@pytest.fixture
+def collection(mq: Any, monkeypatch: pytest.MonkeyPatch, redis_client: redis.StrictRedis) -> Iterator[Any]:
+    """An empty collection, and an ingest worker chunking by paragraph with fake embeddings, that records them"""
+    monkeypatch.setattr(mq, "chunker", mq.get_chunker("paragraph"))
+    embedded: List[str] = []
+
+    def embed_batch(texts: List[str]) -> List[List[float]]:
+        embedded.extend(texts)
+        return [[float(len(text)), 1.0] for text in texts]
+
+    monkeypatch.setattr(mq, "embed_batch", embed_batch)
+    client = chromadb.EphemeralClient()
+    collection = client.get_or_create_collection(f"test-{uuid4().hex}")
+    collection.embedded = embedded
+    yield collection
+    client.delete_collection(collection.name)
+
+
+class RecordingJob:
+    """A job status that records its updates"""
+
+    def __init__(self, mq: Any, redis_client: redis.StrictRedis) -> None:
+        """Initialize the job."""
+        self.job = mq.IngestJob(redis_client, CONTEXT["upload_id"])
+        self.updates: List[Dict[str, Any]] = []
+
+    def update(self, pipe: Optional[Any] = None, **fields: Any) -> None:
+        """Record the update, and update the job"""
+        self.updates.append(fields)
+        self.job.update(pipe, **fields)
+
+    @property
+    def states(self) -> List[str]:
+        """The states the job went through"""
+        return [fields["state"] for fields in self.updates if "state" in fields]
+
+    def __getattr__(self, name: str) -> Any:
+        """The rest of the job"""
+        return getattr(self.job, name)
+
+
+def document(*paragraphs: str) -> List[str]:
+    """Lines of a document made of paragraphs"""
+    return "\n\n".join(paragraphs).splitlines(keepends=True)
+
+
+def test_job_states(mq: Any, redis_client: redis.StrictRedis, collection: Any) -> None:
+    """A document embedded in one batch goes through the embedding and writing states."""
+    job = RecordingJob(mq, redis_client)
+    mq.upsert(document("one", "two", "three"), CONTEXT, job, collection)
+    assert job.states == ["embedding", "writing"]
+    record = job.get()
+    assert (record["chunks_read"], record["chunks_new"], record["chunks_written"]) == (3, 3, 3)
+
+
+def test_chunks_read_while_reading(
+    mq: Any, monkeypatch: pytest.MonkeyPatch, redis_client: redis.StrictRedis, collection: Any
+) -> None:
+    """The chunks read are counted as they are read, before the first batch is embedded."""
+    monkeypatch.setattr(mq, "JOB_PROGRESS_INTERVAL", 0)
+    job = RecordingJob(mq, redis_client)
+    mq.upsert(document("one", "two", "three"), CONTEXT, job, collection)
+    first_state = next(i for i, fields in enumerate(job.updates) if "state" in fields)
+    assert job.updates[first_state]["state"] == "embedding"
+    assert [fields["chunks_read"] for fields in job.updates[:first_state]] == [1, 2, 3]
+
+
+def test_superseded_before_embedding(mq: Any, redis_client: redis.StrictRedis, collection: Any) -> None:
+    """A document embedded in one batch is not embedded once a newer request for it is queued."""
+
+    def lines() -> Iterator[str]:
+        yield from document("one", "two")
+        redis_client.set(f"{mq.INGEST_LATEST}:{CONTEXT['path']}", "u2")  # queued while reading
+
+    with pytest.raises(mq.Superseded):
+        mq.upsert(lines(), CONTEXT, RecordingJob(mq, redis_client), collection)
+    assert not collection.embedded
+    assert collection.count() == 0
+
+
+def test_reingest_only_embeds_changes(mq: Any, redis_client: redis.StrictRedis, collection: Any) -> None:
+    """On re-ingest unchanged chunks are kept, moved ones reindexed, and the removed ones deleted."""
+    mq.upsert(document("one", "two", "three"), CONTEXT, RecordingJob(mq, redis_client), collection)
+    collection.embedded.clear()
+    job = RecordingJob(mq, redis_client)
+    mq.upsert(document("zero", "one", "three"), CONTEXT, job, collection)
+    assert collection.embedded == ["zero"]
+    stored = collection.get(where={"path": CONTEXT["path"]}, include=["metadatas"])
+    assert sorted((metadata["chunk_index"], metadata["text"]) for metadata in stored["metadatas"]) == [
+        (0, "zero"),
+        (1, "one"),
+        (2, "three"),
+    ]
+    record = job.get()
+    assert (record["chunks_new"], record["chunks_unchanged"], record["chunks_removed"]) == (1, 2, 1)
+
+
+def test_reingest_unchanged_document(mq: Any, redis_client: redis.StrictRedis, collection: Any) -> None:
+    """Re-ingesting the same document embeds and writes nothing, and doesn't notify the replicas."""
+    mq.upsert(document("one", "two"), CONTEXT, RecordingJob(mq, redis_client), collection)
+    version = redis_client.get(f"{collection.name}:version")
+    collection.embedded.clear()
+    mq.upsert(document("one", "two"), CONTEXT, RecordingJob(mq, redis_client), collection)
+    assert not collection.embedded
+    assert collection.count() == 2
+    assert redis_client.get(f"{collection.name}:version") == version
+
+
+@pytest.fixture
+def pipelines(mq: Any, monkeypatch: pytest.MonkeyPatch) -> List[Any]:
+    """The pipelines started by upsert, which embeds one chunk per batch through queues of one batch"""
+    monkeypatch.setattr(mq, "EMBEDDING_BATCH_SIZE", 1)
+    monkeypatch.setattr(mq, "PIPELINE_QUEUE_SIZE", 1)
+    started: List[Any] = []
+
+    class IngestPipeline(mq.IngestPipeline):  # type: ignore[misc]
+        """A pipeline that is recorded when it starts"""
+
+        def __init__(self, *args: Any) -> None:
+            """Start the stages."""
+            super().__init__(*args)
+            started.append(self)
+
+    monkeypatch.setattr(mq, "IngestPipeline", IngestPipeline)
+    return started
+
+
+def upsert_in_thread(mq: Any, lines: Iterable[str], job: Any, collection: Any) -> Optional[BaseException]:
+    """Run upsert, failing the test if it hangs, returns what it raised"""
+    raised: List[BaseException] = []
+
+    def run() -> None:
+        try:
+            mq.upsert(lines, CONTEXT, job, collection)
+        except BaseException as e:  # pylint: disable=broad-except
+            raised.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive(), "upsert hung"
+    return raised[0] if raised else None
+
+
+@pytest.mark.parametrize("stage", ["embed", "write"])
+def test_pipeline_stage_error(
+    mq: Any,
+    monkeypatch: pytest.MonkeyPatch,
+    redis_client: redis.StrictRedis,
+    collection: Any,
+    pipelines: List[Any],
+    stage: str,
+) -> None:
+    """An error in a stage stops the whole pipeline, and is raised by upsert."""
+
+    def fail(*_: Any, **__: Any) -> None:
+        raise RuntimeError(f"{stage} failed")
+
+    if stage == "embed":
+        monkeypatch.setattr(mq, "embed_batch", fail)
+    else:
+        monkeypatch.setattr(collection, "add", fail)
+    error = upsert_in_thread(mq, document(*map(str, range(20))), RecordingJob(mq, redis_client), collection)
+    assert repr(error) == repr(RuntimeError(f"{stage} failed"))
+    (pipeline,) = pipelines
+    assert pipeline.abort.is_set()
+    assert not any(thread.is_alive() for thread in pipeline.threads)
+
+
+def test_reading_error_stops_pipeline(
+    mq: Any, redis_client: redis.StrictRedis, collection: Any, pipelines: List[Any]
+) -> None:
+    """An error while reading the document stops the pipeline, and is raised by upsert."""
+
+    def lines() -> Iterator[str]:
+        yield from document(*map(str, range(10)))
+        raise ConnectionError("S3 went away")
+
+    error = upsert_in_thread(mq, lines(), RecordingJob(mq, redis_client), collection)
+    assert isinstance(error, ConnectionError)
+    (pipeline,) = pipelines
+    assert not any(thread.is_alive() for thread in pipeline.threads)
@@ -0,0 +1,86 @@
+"""Test the manifest of the batch upload's sync mode"""
+import asyncio
+import json
+import os
+from typing import Any, List, Tuple
+
+import pytest
+import upload
+
+
+@pytest.fixture
+def synced(monkeypatch: pytest.MonkeyPatch, tmp_path: Any) -> List[List[str]]:
+    """The files uploaded by each sync, into a manifest in tmp_path. Files named fail* are not queued."""
+    uploads: List[List[str]] = []
+
+    async def upload_all(_api_url: str, files: List[Tuple[str, str]]) -> List[str]:
+        uploads.append(sorted(path for path, _ in files))
+        return [path for path, _ in files if not os.path.basename(path).startswith("fail")]
+
+    monkeypatch.setattr(upload, "upload_all", upload_all)
+    monkeypatch.setattr(upload, "UPLOAD_MANIFEST", str(tmp_path / ".sync" / "manifest.json"))
+    return uploads
+
+
+def write(tmp_path: Any, name: str, content: str) -> Tuple[str, str]:
+    """Write a file of the blogs folder, returns it as sync_all takes it"""
+    path = tmp_path / name
+    path.write_text(content, encoding="utf-8")
+    return str(path), "blogs"
+
+
+def test_sync_uploads_new_and_changed_files(synced: List[List[str]], tmp_path: Any) -> None:
+    """Only the files whose content changed since the last sync are uploaded again."""
+    files = [write(tmp_path, "a.md", "a"), write(tmp_path, "b.md", "b"), write(tmp_path, "fail.md", "c")]
+    asyncio.run(upload.sync_all("http://backend", files))
+    write(tmp_path, "b.md", "b changed")
+    asyncio.run(upload.sync_all("http://backend", files))
+    paths = [path for path, _ in files]
+    assert synced == [sorted(paths), [paths[1], paths[2]]]
+    assert sorted(upload.load_manifest(upload.UPLOAD_MANIFEST)) == ["blogs/a.md", "blogs/b.md"]
+
+
+def test_sync_deletes_removed_files(synced: List[List[str]], monkeypatch: pytest.MonkeyPatch, tmp_path: Any) -> None:
+    """A file removed since the last sync is deleted, and dropped from the manifest, with UPLOAD_DELETE_REMOVED."""
+    deleted: List[Tuple[str, str]] = []
+
+    async def delete_file(_client: Any, _api_url: str, folder: str, filename: str) -> None:
+        deleted.append((folder, filename))
+
+    monkeypatch.setattr(upload, "delete_file", delete_file)
+    asyncio.run(upload.sync_all("http://backend", [write(tmp_path, "a.md", "a"), write(tmp_path, "b.md", "b")]))
+    asyncio.run(upload.sync_all("http://backend", [write(tmp_path, "a.md", "a")]))
+    assert not deleted  # kept unless asked for
+    monkeypatch.setattr(upload, "UPLOAD_DELETE_REMOVED", True)
+    asyncio.run(upload.sync_all("http://backend", [write(tmp_path, "a.md", "a")]))
+    assert deleted == [("blogs", "b.md")]
+    assert list(upload.load_manifest(upload.UPLOAD_MANIFEST)) == ["blogs/a.md"]
+
+
+def test_load_manifest_rejects_other_json(tmp_path: Any) -> None:
+    """A file that isn't a manifest is not taken for one."""
+    path = tmp_path / "manifest.json"
+    path.write_text(json.dumps(["blogs/a.md"]), encoding="utf-8")
+    with pytest.raises(ValueError):
+        upload.load_manifest(str(path))
+
+
+def test_sync_retries_failures(synced: List[List[str]], monkeypatch: pytest.MonkeyPatch, tmp_path: Any) -> None:
+    """A changed file that wasn't queued, or a removed file that wasn't deleted, is tried again on the next sync."""
+    attempts: List[str] = []
+
+    async def delete_file(_client: Any, _api_url: str, _folder: str, filename: str) -> None:
+        attempts.append(filename)
+        if len(attempts) == 1:
+            raise Exception("Failed to delete b.md: 503")
+
+    monkeypatch.setattr(upload, "delete_file", delete_file)
+    monkeypatch.setattr(upload, "UPLOAD_DELETE_REMOVED", True)
+    asyncio.run(upload.sync_all("http://backend", [write(tmp_path, "fail.md", "a"), write(tmp_path, "b.md", "b")]))
+    failed = write(tmp_path, "fail.md", "a changed")
+    asyncio.run(upload.sync_all("http://backend", [failed]))
+    assert sorted(upload.load_manifest(upload.UPLOAD_MANIFEST)) == ["blogs/b.md"]  # still to delete
+    asyncio.run(upload.sync_all("http://backend", [failed]))
+    assert synced[1:] == [[failed[0]], [failed[0]]]
+    assert attempts == ["b.md", "b.md"]
+    assert upload.load_manifest(upload.UPLOAD_MANIFEST) == {}
@@ -0,0 +1,102 @@
+"""Test the batch upload's retries and failures"""
+import asyncio
+import functools
+import json
+import random
+from typing import Any, Iterator, List
+
+import httpx
+import pytest
+import upload
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Retry at once"""
+    monkeypatch.setattr(random, "uniform", lambda _low, _high: 0.0)
+    monkeypatch.setattr(upload, "UPLOAD_MAX_RETRIES", 3)
+
+
+def responses(*outcomes: Any) -> Any:
+    """A send() that fails or responds with each outcome in turn, and counts its attempts"""
+    remaining: Iterator[Any] = iter(outcomes)
+
+    async def send() -> httpx.Response:
+        send.attempts += 1  # type: ignore[attr-defined]
+        outcome = next(remaining)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return httpx.Response(outcome, text="busy" if outcome >= 500 else "")
+
+    send.attempts = 0  # type: ignore[attr-defined]
+    return send
+
+
+def test_retries_transient_failures() -> None:
+    """Connection errors and transient responses are retried."""
+    send = responses(httpx.ConnectError("refused"), 503, 200)
+    assert asyncio.run(upload.with_retries(send, "upload a.md")).status_code == 200
+    assert send.attempts == 3
+
+
+def test_gives_up_after_max_retries() -> None:
+    """The last transient failure is raised once the retries are exhausted."""
+    send = responses(503, 429, 502, 200)
+    with pytest.raises(Exception, match="Failed to upload a.md: 502 busy"):
+        asyncio.run(upload.with_retries(send, "upload a.md"))
+    assert send.attempts == 3
+
+
+def test_does_not_retry_other_responses() -> None:
+    """Any other response, an error or not, is the caller's to handle."""
+    send = responses(404)
+    assert asyncio.run(upload.with_retries(send, "upload a.md")).status_code == 404
+    assert send.attempts == 1
+
+
+@pytest.fixture
+def servers(monkeypatch: pytest.MonkeyPatch) -> List[Any]:
+    """
+    A backend and S3 that the uploads go to, returns the paths of each /ingest/batch request.
+    Uploads of files named denied* are refused by S3, ingests of files named rejected* are rejected by the backend.
+    """
+    batches: List[Any] = []
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        if request.url.host == "backend" and request.url.path.startswith("/uploads/"):
+            return httpx.Response(307, headers={"Location": f"http://s3{request.url.path}"})
+        if request.url.host == "s3":
+            request.read()
+            return httpx.Response(403 if "/denied" in request.url.path else 200)
+        if request.url.path == "/ingest/batch":
+            paths = json.loads(request.content)["paths"]
+            batches.append(paths)
+            return httpx.Response(
+                200, json={"results": [{"error": "no"} if "/rejected" in path else {"path": path} for path in paths]}
+            )
+        return httpx.Response(404)
+
+    monkeypatch.setattr(
+        httpx, "AsyncClient", functools.partial(httpx.AsyncClient, transport=httpx.MockTransport(handle))
+    )
+    return batches
+
+
+def test_upload_all_queues_what_was_uploaded(
+    servers: List[Any], tmp_path: Any, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Files that fail to upload aren't queued, and those the backend rejects aren't reported as queued."""
+    monkeypatch.setattr(upload, "INGEST_BATCH_SIZE", 2)
+    files = []
+    for name in ["a.md", "denied.md", "b.md", "rejected.md", "c.md"]:
+        (tmp_path / name).write_text(name, encoding="utf-8")
+        files.append((str(tmp_path / name), "blogs"))
+    queued = asyncio.run(upload.upload_all("http://backend", files))
+    assert sorted(queued) == sorted(str(tmp_path / name) for name in ["a.md", "b.md", "c.md"])
+    assert sorted(path for batch in servers for path in batch) == [
+        "blogs/a.md",
+        "blogs/b.md",
+        "blogs/c.md",
+        "blogs/rejected.md",
+    ]
+    assert all(len(batch) <= 2 for batch in servers)
@@ -0,0 +1,93 @@
+"""Test the backend's in-process replica of the collection's vectors"""
+import json
+import time
+import uuid
+from typing import Any, Callable, Iterator
+
+import chromadb
+import pytest
+import redis
+from vector_replica import VectorReplica
+
+
+@pytest.fixture
+def collection() -> Any:
+    """A collection of its own, with the chunks of a.md"""
+    collection = chromadb.EphemeralClient().get_or_create_collection(f"blogs-{uuid.uuid4().hex[:6]}")
+    collection.add(ids=["a/0", "a/1"], embeddings=[[1.0, 0.0], [0.9, 0.1]], metadatas=[{"path": "a.md"}] * 2)
+    return collection
+
+
+@pytest.fixture
+def replica(collection: Any, redis_client: redis.StrictRedis) -> Iterator[VectorReplica]:
+    """A replica of the collection, loaded"""
+    replica = VectorReplica(collection, redis_client)
+    replica.start()
+    wait_for(replica.fresh)
+    yield replica
+    replica.stop()
+
+
+def wait_for(condition: Callable[[], Any], timeout: float = 5.0) -> None:
+    """Wait for the replica's thread to catch up"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def publish(redis_client: redis.StrictRedis, collection: Any, path: str, skip: int = 0) -> int:
+    """Notify a change to a document as the ingest workers do, after skipping some versions. Returns its version"""
+    version = int(redis_client.incrby(f"{collection.name}:version", 1 + skip))
+    redis_client.publish(f"{collection.name}:changes", json.dumps({"path": path, "version": version}))
+    return version
+
+
+def nearest(replica: VectorReplica, embedding: Any, k: int = 3) -> Any:
+    """Ids of the nearest vectors in the replica"""
+    results = replica.query([embedding], k)
+    assert results is not None
+    return results["ids"][0]
+
+
+def test_query_like_chroma(collection: Any, replica: VectorReplica) -> None:
+    """The replica finds the same neighbours, with the same distances, as Chroma."""
+    expected = collection.query(query_embeddings=[[0.0, 1.0]], n_results=2)
+    results = replica.query([[0.0, 1.0]], 2)
+    assert results is not None
+    assert results["ids"] == expected["ids"]
+    assert results["distances"][0] == pytest.approx(expected["distances"][0], abs=1e-5)
+
+
+def test_refresh_on_change(collection: Any, replica: VectorReplica, redis_client: redis.StrictRedis) -> None:
+    """Each change notification replaces the vectors of its document with what is in Chroma."""
+    collection.add(ids=["b/0"], embeddings=[[0.0, 1.0]], metadatas=[{"path": "b.md"}])
+    version = publish(redis_client, collection, "b.md")
+    wait_for(lambda: replica.version == version)
+    assert nearest(replica, [0.0, 1.0]) == ["b/0", "a/1", "a/0"]
+
+    collection.delete(where={"path": "a.md"})
+    version = publish(redis_client, collection, "a.md")
+    wait_for(lambda: replica.version == version)
+    assert nearest(replica, [1.0, 0.0]) == ["b/0"]
+
+
+def test_reload_on_missed_change(collection: Any, replica: VectorReplica, redis_client: redis.StrictRedis) -> None:
+    """A notification that skips versions reloads the replica, as the changes in between were missed."""
+    collection.add(ids=["b/0"], embeddings=[[0.0, 1.0]], metadatas=[{"path": "b.md"}])
+    collection.add(ids=["c/0"], embeddings=[[0.5, 0.5]], metadatas=[{"path": "c.md"}])
+    version = publish(redis_client, collection, "c.md", skip=1)  # b.md's notification was lost
+    wait_for(lambda: replica.version == version)
+    assert sorted(nearest(replica, [0.0, 1.0], k=10)) == ["a/0", "a/1", "b/0", "c/0"]
+
+
+def test_stale_replica(collection: Any, redis_client: redis.StrictRedis) -> None:
+    """The replica defers to Chroma until it is loaded and once it is stopped, and loads an empty collection."""
+    collection.delete(ids=["a/0", "a/1"])
+    replica = VectorReplica(collection, redis_client)
+    assert replica.query([[1.0, 0.0]], 3) is None
+    replica.start()
+    wait_for(replica.fresh)
+    assert nearest(replica, [1.0, 0.0]) == []
+    replica.stop()
+    assert replica.query([[1.0, 0.0]], 3) is None